@@ -6,11 +6,12 @@ import torch
 import shutil
 from pathlib import Path
 
-from model.dataset import downsample_hrtf
+from preprocessing.lr_pyramid import get_lr_mask, get_lr_hrtf, read_lr_hrtf
 from preprocessing.cubed_sphere import CubedSphere
-from preprocessing.utils import interpolate_fft
-from preprocessing.convert_coordinates import convert_cube_to_sphere
-from preprocessing.barycentric_calcs import get_triangle_vertices, calc_barycentric_coordinates
+from preprocessing.utils import interpolate_fft, calc_all_triangles, calc_interpolation_matrix
+from preprocessing.convert_coordinates import convert_cube_to_sphere_array
+from preprocessing.projection import load_projection
+from preprocessing.storage import load_hrtf_file
 
 PI_4 = np.pi / 4
 
@@ -27,49 +28,44 @@ def run_barycentric_interpolation(config, barycentric_output_path, subject_file=
     shutil.rmtree(Path(barycentric_output_path), ignore_errors=True)
     Path(barycentric_output_path).mkdir(parents=True, exist_ok=True)
 
-    projection_filename = f'{config.projection_dir}/{config.dataset}_projection_{config.hrtf_size}'
-    with open(projection_filename, "rb") as f:
-        (cube_coords, sphere_coords, euclidean_sphere_triangles, euclidean_sphere_coeffs) = pickle.load(f)
+    projection = load_projection(config)
+    cube_coords, sphere_coords, _, _ = projection.as_legacy()
+    cube_indices = projection.get_cube_indices()
+    lr_mask = get_lr_mask(config.hrtf_size, config.upscale_factor)
 
     for file_name in valid_data_file_names:
-        with open(config.valid_hrtf_merge_dir + file_name, "rb") as f:
-            hr_hrtf = pickle.load(f)
+        hr_hrtf = load_hrtf_file(config.valid_hrtf_merge_dir + file_name)
 
-        lr_hrtf = torch.permute(downsample_hrtf(torch.permute(hr_hrtf, (3, 0, 1, 2)), config.hrtf_size, config.upscale_factor), (1, 2, 3, 0))
+        lr_hrtf = read_lr_hrtf(config.valid_hrtf_merge_dir + file_name, config.upscale_factor)
+        if lr_hrtf is None:
+            lr_hrtf = get_lr_hrtf(hr_hrtf, config.hrtf_size, config.upscale_factor)
 
-        sphere_coords_lr = []
+        cube_coords_lr = []
         sphere_coords_lr_index = []
-        for panel, x, y in cube_coords:
-            # based on cube coordinates, get indices for magnitudes list of lists
-            i = panel - 1
-            j = round(config.hrtf_size * (x - (PI_4 / config.hrtf_size) + PI_4) / (np.pi / 2))
-            k = round(config.hrtf_size * (y - (PI_4 / config.hrtf_size) + PI_4) / (np.pi / 2))
-            if hr_hrtf[i, j, k] in lr_hrtf:
-                sphere_coords_lr.append(convert_cube_to_sphere(panel, x, y))
+        for (panel, x, y), i, j, k in zip(cube_coords, *cube_indices):
+            if lr_mask[i, j, k]:
+                cube_coords_lr.append((panel, x, y))
                 sphere_coords_lr_index.append([int(i), int(j / config.upscale_factor), int(k / config.upscale_factor)])
+        elevation_lr, azimuth_lr, _ = convert_cube_to_sphere_array(*np.array(cube_coords_lr, dtype=float).reshape(-1, 3).T)
+        sphere_coords_lr = list(zip(elevation_lr.tolist(), azimuth_lr.tolist()))
 
-        euclidean_sphere_triangles = []
-        euclidean_sphere_coeffs = []
-        for sphere_coord in sphere_coords:
-            # based on cube coordinates, get indices for magnitudes list of lists
-            triangle_vertices = get_triangle_vertices(elevation=sphere_coord[0], azimuth=sphere_coord[1],
-                                                      sphere_coords=sphere_coords_lr)
-            coeffs = calc_barycentric_coordinates(elevation=sphere_coord[0], azimuth=sphere_coord[1],
-                                                  closest_points=triangle_vertices)
-            euclidean_sphere_triangles.append(triangle_vertices)
-            euclidean_sphere_coeffs.append(coeffs)
+        euclidean_sphere_triangles, euclidean_sphere_coeffs = calc_all_triangles(sphere_coords, sphere_coords_lr)
 
         cs = CubedSphere(sphere_coords=sphere_coords_lr, indices=sphere_coords_lr_index)
+        interpolation_matrix = calc_interpolation_matrix(cs, sphere_coords, euclidean_sphere_triangles,
+                                                         euclidean_sphere_coeffs)
 
         lr_hrtf_left = lr_hrtf[:, :, :, :config.nbins_hrtf]
         lr_hrtf_right = lr_hrtf[:, :, :, config.nbins_hrtf:]
 
         barycentric_hr_left = interpolate_fft(config, cs, lr_hrtf_left, sphere_coords, euclidean_sphere_triangles,
                                          euclidean_sphere_coeffs, cube_coords, fs_original=config.hrir_samplerate,
-                                         edge_len=config.hrtf_size)
+                                         edge_len=config.hrtf_size,
+                                         interpolation_matrix=interpolation_matrix, cube_indices=cube_indices)
         barycentric_hr_right = interpolate_fft(config, cs, lr_hrtf_right, sphere_coords, euclidean_sphere_triangles,
                                               euclidean_sphere_coeffs, cube_coords, fs_original=config.hrir_samplerate,
-                                              edge_len=config.hrtf_size)
+                                              edge_len=config.hrtf_size,
+                                              interpolation_matrix=interpolation_matrix, cube_indices=cube_indices)
 
         barycentric_hr_merged = torch.tensor(np.concatenate((barycentric_hr_left, barycentric_hr_right), axis=3))
 
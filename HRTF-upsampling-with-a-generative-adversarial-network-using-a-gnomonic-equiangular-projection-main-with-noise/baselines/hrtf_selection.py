@@ -7,7 +7,9 @@ import numpy as np
 import shutil
 from pathlib import Path
 
+from model.layout import CubeHRTF
 from model.util import spectral_distortion_metric
+from preprocessing.storage import load_hrtf_file
 
 def run_hrtf_selection(config, hrtf_selection_output_path, subject_file=None):
 
@@ -26,13 +28,13 @@ def run_hrtf_selection(config, hrtf_selection_output_path, subject_file=None):
     hrtf_dict_right = {}
     subj_ids = []
     for file_name in valid_data_file_names:
-        with open(config.valid_hrtf_merge_dir + file_name, "rb") as f:
-            hr_hrtf = pickle.load(f)
+        hr_hrtf = load_hrtf_file(config.valid_hrtf_merge_dir + file_name)
 
         # add to dict for right ears
         subj_id = int(re.findall(r'\d+', file_name)[0])
-        hrtf_dict_left[subj_id] = torch.permute(torch.tensor(np.array([np.array(hr_hrtf).T[0:config.nbins_hrtf]])), (0, 1, 4, 3, 2))
-        hrtf_dict_right[subj_id] = torch.permute(torch.tensor(np.array([np.array(hr_hrtf).T[config.nbins_hrtf:]])), (0, 1, 4, 3, 2))
+        hrtf = CubeHRTF.from_stored(hr_hrtf).as_batch()
+        hrtf_dict_left[subj_id] = hrtf.ear('left', config.nbins_hrtf).channels_first
+        hrtf_dict_right[subj_id] = hrtf.ear('right', config.nbins_hrtf).channels_first
         subj_ids.append(subj_id)
 
     # for each subject, compare their HRTF sets to all other subjects' HRTF sets via SD metric
@@ -62,8 +64,7 @@ def run_hrtf_selection(config, hrtf_selection_output_path, subject_file=None):
     min_id = min(overall_avg_dict, key=overall_avg_dict.get)
     min_val = overall_avg_dict[min_id]
     with open(f'{hrtf_selection_output_path}/minimum.pickle', "wb") as file:
-        with open(f'{config.valid_hrtf_merge_dir}/{config.dataset}_mag_{min_id}.pickle', "rb") as f:
-            hr_hrtf = pickle.load(f)
+        hr_hrtf = load_hrtf_file(f'{config.valid_hrtf_merge_dir}/{config.dataset}_mag_{min_id}.pickle')
         pickle.dump(hr_hrtf, file)
 
     print(f"Minimum is {min_id} with average LSD {min_val}")
@@ -71,8 +72,7 @@ def run_hrtf_selection(config, hrtf_selection_output_path, subject_file=None):
     max_id = max(overall_avg_dict, key=overall_avg_dict.get)
     max_val = overall_avg_dict[max_id]
     with open(f'{hrtf_selection_output_path}/maximum.pickle', "wb") as file:
-        with open(f'{config.valid_hrtf_merge_dir}/{config.dataset}_mag_{max_id}.pickle', "rb") as f:
-            hr_hrtf = pickle.load(f)
+        hr_hrtf = load_hrtf_file(f'{config.valid_hrtf_merge_dir}/{config.dataset}_mag_{max_id}.pickle')
         pickle.dump(hr_hrtf, file)
 
     print(f"Maximum is {max_id} with average LSD {max_val}")
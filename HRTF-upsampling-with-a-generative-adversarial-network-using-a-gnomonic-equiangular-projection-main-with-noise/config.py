@@ -32,11 +32,52 @@ class Config:
         # Data processing parameters
         self.merge_flag = True
         self.gen_sofa_flag = True
+        # write the low resolution HRTFs of every upscale factor next to the high resolution ones in preprocess mode
+        self.gen_lr_pyramid_flag = True
+        # dtype the HRTFs on the cubed sphere are stored with, one of preprocessing.storage.STORAGE_POLICIES
+        # (float16/bfloat16 halve the size again, log_* store log-magnitudes)
+        self.hrtf_storage_policy = 'float32'
         self.nbins_hrtf = 128  # make this a power of 2
         self.hrtf_size = 16
         self.upscale_factor = 2  # can only take values: 2, 4 ,8, 16
         self.train_samples_ratio = 0.8
         self.hrir_samplerate = 48000.0
+        # number of processes used to project subjects in preprocess mode (1 processes them serially)
+        self.num_preprocess_workers = 4
+        # keep decoded subjects in a local cache, such that hrtfdata only decodes each subject once
+        self.use_decode_cache = True
+        # only reprocess subjects that are new or whose source files changed since the last preprocess run
+        self.incremental_preprocess = True
+        # skip main.py stages whose config parameters and inputs are unchanged since they were last run
+        self.use_stage_cache = True
+        # read HRTFs from one memory-mapped store per directory rather than from a pickle per subject
+        self.use_hrtf_store = True
+        # hold the whole dataset on the training device and serve batches from it, rather than through a DataLoader,
+        # for datasets no larger than resident_dataset_max_mb
+        self.use_resident_dataset = True
+        self.resident_dataset_max_mb = 2048
+        # noise colours (see preprocessing.noise.NOISE_COLOURS) and SNRs (dB) of the noisy datasets written to
+        # hr_merge_noisy in build_noisy_datasets mode, one train and one valid folder per combination, along with the
+        # seed the noise of every subject is derived from. Training with the noise argument augment_noise draws the noise added to
+        # each HRTF from the same colours and SNRs
+        self.noise_colours = ['white', 'pink', 'brown']
+        self.noise_snrs_db = [30, 20, 10, 0, -10, -20, -50]
+        self.noise_seed = 0
+        # compile the generator and discriminator with torch.compile, each into a single graph, for training and
+        # inference, with the given torch.compile mode (e.g. 'reduce-overhead' to also capture CUDA graphs)
+        self.compile_model = False
+        self.compile_mode = 'default'
+        # train with mixed precision: the models run in float16 on CUDA, with scaled gradients, and in bfloat16 on the
+        # CPU, while every loss is computed in float32. A float16 step whose forward pass overflows is skipped, and after
+        # max_consecutive_overflows such steps in a row the rest of the epoch runs in float32
+        self.mixed_precision = False
+        self.max_consecutive_overflows = 5
+        # run the generator in test mode with PyTorch ('torch') or, once exported in export_onnx mode, with ONNX Runtime
+        # on the CPU ('onnx'). The export fails if the ONNX outputs differ from those of PyTorch by more than the
+        # tolerance, relative to the largest output
+        self.inference_backend = 'torch'
+        self.onnx_opset = 20
+        self.onnx_parity_tolerance = 1e-4
 
         # Data dirs
         if using_hpc:
@@ -62,6 +103,8 @@ class Config:
         self.model_path = f'{self.data_dirs_path}{self.runs_folder}/{self.tag}'
 
         self.projection_dir = f'{self.data_dirs_path}/projection_coordinates'
+        self.decode_cache_dir = f'{self.data_dirs_path}/decode_cache'
+        self.stage_cache_dir = f'{self.data_dirs_path}/stage_cache'
         self.baseline_dir = '/baseline_results/' + self.dataset
 
         self.train_hrtf_dir = self.data_dirs_path + self.data_dir + '/hr/train'
@@ -71,6 +114,7 @@ class Config:
 
         self.train_hrtf_merge_dir = self.data_dirs_path + self.data_dir + '/hr_merge/train'
 
+        self.noisy_hrtf_merge_dir = self.data_dirs_path + self.data_dir + '/hr_merge_noisy'
         #*********************Added Code to Specify the Train Folder in the Job .pbs File************************************************************************     
         self.train_noisy_hrtf_merge_dir = self.data_dirs_path + self.data_dir + '/hr_merge_noisy/' + self.train_folder
         #*********************End of Added Code to Specify the Train Folder in the Job .pbs File************************************************************************    
@@ -83,12 +127,15 @@ class Config:
         self.valid_original_hrtf_merge_dir = self.data_dirs_path + self.data_dir + '/merge_original/valid'
 
         self.mean_std_filename = self.data_dirs_path + self.data_dir + '/mean_std_' + self.dataset
+        self.preprocess_manifest_filename = self.data_dirs_path + self.data_dir + '/preprocess_manifest.json'
         self.barycentric_hrtf_dir = self.data_dirs_path + self.baseline_dir + '/barycentric/valid'
         self.hrtf_selection_dir = self.data_dirs_path + self.baseline_dir + '/hrtf_selection/valid'
 
         # Training hyperparams
         self.batch_size = 1
         self.num_workers = 1
+        # batches read ahead on a background thread when training without CUDA (0 to read them synchronously)
+        self.prefetch_queue_size = 2
         self.num_epochs = 300  # was originally 250
         self.lr_gen = 0.0002
         self.lr_dis = 0.0000015
@@ -112,9 +159,10 @@ class Config:
     def save(self):
         j = {}
         for k, v in self.__dict__.items():
-            j[k] = v
+            # paths are not json serializable
+            j[k] = str(v) if isinstance(v, Path) else v
         with open(f'{self.path}/config.json', 'w') as f:
-            json.dump(list(j), f)
+            json.dump(j, f, indent=2)
 
     def load(self):
         with open(f'{self.path}/config.json', 'r') as f:
@@ -1,6 +1,10 @@
+from model.layout import to_channels_first, to_channels_last
 from model.util import spectral_distortion_metric
-from model.dataset import downsample_hrtf
+from preprocessing.lr_pyramid import get_lr_mask
 from preprocessing.utils import convert_to_sofa
+from preprocessing.projection import load_projection
+from preprocessing.hrtf_store import read_hrtf
+from preprocessing.storage import STORAGE_POLICIES, load_hrtf_file, encode_hrtf, decode_hrtf, get_storage_policy
 
 import shutil
 from pathlib import Path
@@ -16,25 +20,20 @@ import matlab.engine
 
 def replace_nodes(config, sr_dir, file_name):
     # Overwrite the generated points that exist in the original data
-    with open(config.valid_hrtf_merge_dir + file_name, "rb") as f:
-        hr_hrtf = pickle.load(f)
+    if config.use_hrtf_store:
+        hr_hrtf = read_hrtf(config.valid_hrtf_merge_dir, file_name).clone()
+    else:
+        hr_hrtf = load_hrtf_file(config.valid_hrtf_merge_dir + file_name)
 
     with open(sr_dir + file_name, "rb") as f:
         sr_hrtf = pickle.load(f)
 
-    lr_hrtf = torch.permute(
-        downsample_hrtf(torch.permute(hr_hrtf, (3, 0, 1, 2)), config.hrtf_size, config.upscale_factor),
-        (1, 2, 3, 0))
-
-    lr = lr_hrtf.detach().cpu()
-    for p in range(5):
-        for w in range(config.hrtf_size):
-            for h in range(config.hrtf_size):
-                if hr_hrtf[p, w, h] in lr:
-                    sr_hrtf[p, w, h] = hr_hrtf[p, w, h]
+    # the positions kept in the low resolution HRTF are the measured ones
+    lr_mask = torch.tensor(get_lr_mask(config.hrtf_size, config.upscale_factor))
+    sr_hrtf[lr_mask] = hr_hrtf[lr_mask].to(sr_hrtf.dtype)
 
-    generated = torch.permute(sr_hrtf[:, None], (1, 4, 0, 2, 3))
-    target = torch.permute(hr_hrtf[:, None], (1, 4, 0, 2, 3))
+    generated = to_channels_first(sr_hrtf)[None]
+    target = to_channels_first(hr_hrtf)[None]
 
     return target, generated
 
@@ -49,14 +48,13 @@ def run_lsd_evaluation(config, sr_dir, file_ext=None, hrtf_selection=None):
 
         for file_name in valid_data_file_names:
             # Overwrite the generated points that exist in the original data
-            with open(config.valid_hrtf_merge_dir + file_name, "rb") as f:
-                hr_hrtf = pickle.load(f)
+            hr_hrtf = load_hrtf_file(config.valid_hrtf_merge_dir + file_name)
 
             with open(f'{sr_dir}/{hrtf_selection}.pickle', "rb") as f:
                 sr_hrtf = pickle.load(f)
 
-            generated = torch.permute(sr_hrtf[:, None], (1, 4, 0, 2, 3))
-            target = torch.permute(hr_hrtf[:, None], (1, 4, 0, 2, 3))
+            generated = to_channels_first(sr_hrtf)[None]
+            target = to_channels_first(hr_hrtf)[None]
 
             error = spectral_distortion_metric(generated, target)
             subject_id = ''.join(re.findall(r'\d+', file_name))
@@ -105,10 +103,9 @@ def lsd_personalization_evaluation(config, sr_dir, file_ext=None):
         for hr_file_name in all_hrtf_file_names:
             hr_subject_id = ''.join(re.findall(r'\d+', hr_file_name))
             if hr_subject_id != subject_id:
-                with open(config.valid_hrtf_merge_dir + hr_file_name, "rb") as f:
-                    hr_hrtf = pickle.load(f)
+                hr_hrtf = load_hrtf_file(config.valid_hrtf_merge_dir + hr_file_name)
                 #permutation that would have been applied in the replace_nodes function
-                hr_target = torch.permute(hr_hrtf[:, None], (1, 4, 0, 2, 3))
+                hr_target = to_channels_first(hr_hrtf)[None]
                 error = spectral_distortion_metric(generated, hr_target)
                 subject_lsd_errors.append(float(error.detach()))
                 print('LSD Error of subject %s comparing to %s: %0.4f' % (subject_id, hr_subject_id, float(error.detach())))
@@ -153,13 +150,12 @@ def run_localisation_evaluation(config, sr_dir, file_ext=None, hrtf_selection=No
             target, generated = replace_nodes(config, sr_dir, file_name)
 
             with open(nodes_replaced_path + file_name, "wb") as file:
-                pickle.dump(torch.permute(generated[0], (1, 2, 3, 0)), file)
+                pickle.dump(to_channels_last(generated[0]), file)
 
-        projection_filename = f'{config.projection_dir}/{config.dataset}_projection_{config.hrtf_size}'
-        with open(projection_filename, "rb") as file:
-            cube, sphere, sphere_triangles, sphere_coeffs = pickle.load(file)
+        projection = load_projection(config)
 
-        convert_to_sofa(nodes_replaced_path, config, cube, sphere)
+        convert_to_sofa(nodes_replaced_path, config, projection.cube, projection.sphere,
+                        cube_indices=projection.get_cube_indices())
         print('Created valid sofa files')
 
         hrtf_file_names = [hrtf_file_name for hrtf_file_name in os.listdir(nodes_replaced_path + '/sofa_min_phase')]
@@ -228,3 +224,46 @@ def run_target_localisation_evaluation(config):
     print('Mean QUERR Error: %0.3f' % np.mean([error[3] for error in loc_target_errors]))
     with open(f'{config.data_dir}/{config.dataset}_loc_target_valid_errors.pickle', "wb") as file:
         pickle.dump(loc_target_errors, file)
+
+
+def run_storage_precision_evaluation(config, file_ext=None):
+    """LSD between the validation HRTFs and the same HRTFs after storing them with each storage policy (see
+    preprocessing.storage), to judge the impact of reduced precision storage. The HRTFs are compared as they are
+    currently stored, so preprocessing should be run with a float32 or float64 policy beforehand"""
+    file_ext = 'storage_precision_errors.pickle' if file_ext is None else file_ext
+    print(f'HRTFs are currently stored with policy {get_storage_policy(config.valid_hrtf_merge_dir)}')
+
+    valid_data_paths = sorted(glob.glob('%s/%s_*' % (config.valid_hrtf_merge_dir, config.dataset)))
+    if len(valid_data_paths) == 0:
+        print(f'No {config.dataset} HRTFs in {config.valid_hrtf_merge_dir}, run main.py in preprocess mode first')
+        return {}
+
+    precision_errors = {}
+    for policy in STORAGE_POLICIES:
+        lsd_errors = []
+        max_relative_errors = []
+        stored_bytes = []
+        for valid_data_path in valid_data_paths:
+            hr_hrtf = load_hrtf_file(valid_data_path)
+            stored_hrtf = encode_hrtf(hr_hrtf, policy)
+            stored_bytes.append(stored_hrtf.element_size() * stored_hrtf.nelement())
+            decoded_hrtf = decode_hrtf(stored_hrtf, policy).to(hr_hrtf.dtype)
+
+            generated = to_channels_first(decoded_hrtf)[None]
+            target = to_channels_first(hr_hrtf)[None]
+            lsd_errors.append(float(spectral_distortion_metric(generated, target)))
+            max_relative_errors.append(float(torch.max(torch.abs(decoded_hrtf - hr_hrtf) / torch.abs(hr_hrtf).clamp_min(1e-12))))
+
+        bytes_per_hrtf = int(np.mean(stored_bytes))
+        precision_errors[policy] = {'mean_lsd_error': float(np.mean(lsd_errors)),
+                                    'max_lsd_error': float(np.max(lsd_errors)),
+                                    'max_relative_error': float(np.max(max_relative_errors)),
+                                    'bytes_per_hrtf': bytes_per_hrtf}
+        print('Policy %s: mean LSD %0.6f, max LSD %0.6f, max relative error %0.2e, %d bytes per HRTF'
+              % (policy, precision_errors[policy]['mean_lsd_error'], precision_errors[policy]['max_lsd_error'],
+                 precision_errors[policy]['max_relative_error'], bytes_per_hrtf))
+
+    with open(f'{config.path}/{file_ext}', "wb") as file:
+        pickle.dump(precision_errors, file)
+
+    return precision_errors
@@ -4,18 +4,33 @@ import pickle
 import torch
 import numpy as np
 import importlib
+from pathlib import Path
 
 from config import Config
 from model.train import train
 from model.test import test
 from model.util import load_dataset
 from preprocessing.cubed_sphere import CubedSphere
-from preprocessing.utils import interpolate_fft, generate_euclidean_cube, convert_to_sofa, \
-     merge_files, gen_sofa_preprocess, get_hrtf_from_ds, clear_create_directories
+from preprocessing.utils import generate_euclidean_cube, convert_to_sofa, \
+     merge_files, gen_sofa_preprocess, clear_create_directories
+from preprocessing.projection import load_projection, get_projection_paths, get_projection_dir, \
+     PROJECTION_TRIANGULATION_VERSION
+from preprocessing.ingest import SubjectProjector, load_subject_features, project_subjects
+from preprocessing.running_stats import RunningStats
+from preprocessing.validity import ValidityManifest
+from preprocessing.lr_pyramid import write_lr_pyramid
+from preprocessing.noise import build_noisy_datasets, get_noisy_folder
+from preprocessing.storage import save_hrtf_file, load_hrtf_file, decode_hrtf, set_storage_policy
+from preprocessing.manifest import PreprocessManifest, assign_splits, calc_params_fingerprint, index_source_files, \
+     calc_source_fingerprint, get_subject_outputs
 from model import util
+from model.benchmark import run_compile_benchmark
+from model.onnx_backend import OnnxGenerator, export_generator_onnx, check_onnx_parity, get_onnx_filename
+from stage_cache import CachedStage, calc_stat_fingerprint
 from baselines.barycentric_interpolation import run_barycentric_interpolation
 from baselines.hrtf_selection import run_hrtf_selection
-from evaluation.evaluation import run_lsd_evaluation, lsd_personalization_evaluation, run_localisation_evaluation
+from evaluation.evaluation import run_lsd_evaluation, lsd_personalization_evaluation, run_localisation_evaluation, \
+     run_storage_precision_evaluation
 
 PI_4 = np.pi / 4
 
@@ -36,82 +51,177 @@ def main(config, mode, noise, clean_hrtf_ratio):
     if mode == 'generate_projection':
         # Must be run in this mode once per dataset, finds barycentric coordinates for each point in the cubed sphere
         # No need to load the entire dataset in this case
+        stage = CachedStage(config, mode, inputs=[], outputs=[get_projection_dir(config)],
+                            source=calc_stat_fingerprint([data_dir]), projection_version=PROJECTION_TRIANGULATION_VERSION)
+        if stage.is_cached():
+            return
         ds = load_function(data_dir, feature_spec={'hrirs': {'samplerate': config.hrir_samplerate, 'side': 'left', 'domain': 'time'}}, subject_ids='first')
         # need to use protected member to get this data, no getters
         cs = CubedSphere(mask=ds[0]['features'].mask, row_angles=ds.row_angles, column_angles=ds.column_angles)
         generate_euclidean_cube(config, cs.get_sphere_coords(), edge_len=config.hrtf_size)
+        stage.save()
 
     elif mode == 'preprocess':
         # Interpolates data to find HRIRs on cubed sphere, then FFT to obtain HRTF, finally splits data into train and
         # val sets and saves processed data
-        ds = load_function(data_dir, feature_spec={'hrirs': {'samplerate': config.hrir_samplerate, 'side': 'both', 'domain': 'time'}})
-        cs = CubedSphere(mask=ds[0]['features'].mask, row_angles=ds.row_angles, column_angles=ds.column_angles)
+        stage = CachedStage(config, mode, inputs=get_projection_paths(config),
+                            outputs=[config.train_hrtf_dir, config.valid_hrtf_dir, config.train_original_hrtf_dir,
+                                     config.valid_original_hrtf_dir, config.train_hrtf_merge_dir,
+                                     config.valid_hrtf_merge_dir, config.train_original_hrtf_merge_dir,
+                                     config.valid_original_hrtf_merge_dir, config.mean_std_filename,
+                                     config.preprocess_manifest_filename],
+                            source=calc_stat_fingerprint([data_dir]))
+        # turning incremental preprocessing off forces a rebuild
+        if config.incremental_preprocess and stage.is_cached():
+            return
 
-        # need to use protected member to get this data, no getters
-        projection_filename = f'{config.projection_dir}/{config.dataset}_projection_{config.hrtf_size}'
-        with open(projection_filename, "rb") as file:
-            cube, sphere, sphere_triangles, sphere_coeffs = pickle.load(file)
-
-        # Clear/Create directories
-        clear_create_directories(config)
-
-        # Split data into train and test sets
-        train_size = int(len(set(ds.subject_ids)) * config.train_samples_ratio)
-        train_sample = np.random.choice(list(set(ds.subject_ids)), train_size, replace=False)
-
-        # collect all train_hrtfs to get mean and sd
-        train_hrtfs = torch.empty(size=(2 * train_size, 5, config.hrtf_size, config.hrtf_size, config.nbins_hrtf))
-        j = 0
-        for i in range(len(ds)):
-            if i % 10 == 0:
-                print(f"HRTF {i} out of {len(ds)} ({round(100 * i / len(ds))}%)")
-
-            # Verification that HRTF is valid
-            if np.isnan(ds[i]['features']).any():
-                print(f'HRTF (Subject ID: {i}) contains nan values')
-                continue
-
-            features = ds[i]['features'].data.reshape(*ds[i]['features'].shape[:-2], -1)
-            clean_hrtf = interpolate_fft(config, cs, features, sphere, sphere_triangles, sphere_coeffs,
-                                             cube, fs_original=ds.hrir_samplerate, edge_len=config.hrtf_size)
-            hrtf_original, phase_original, sphere_original = get_hrtf_from_ds(config, ds, i)
+        ds = load_function(data_dir, feature_spec={'hrirs': {'samplerate': config.hrir_samplerate, 'side': 'both', 'domain': 'time'}})
+        projection = load_projection(config)
+
+        # subjects that are unchanged since the last run are skipped, unless incremental preprocessing is turned off
+        params, params_hash = calc_params_fingerprint(config, projection)
+        manifest = PreprocessManifest.load(config.preprocess_manifest_filename, params, params_hash)
+        if not config.incremental_preprocess:
+            manifest.clear()
+        full_rebuild = manifest.is_empty()
+        if full_rebuild:
+            # Clear/Create directories
+            clear_create_directories(config)
+
+        # Split data into train and test sets, subjects that were already preprocessed keep their split
+        splits = assign_splits(manifest, ds.subject_ids, config.train_samples_ratio)
+
+        # fingerprint the source files of each subject, falling back to all files of the dataset if none can be
+        # assigned to it, such that a subject is never decoded only to find out whether it changed
+        source_files, all_source_files = index_source_files(data_dir, ds.subject_ids)
+        fingerprints = {}
+        dataset_fingerprint = None
+        for subject_id in set(ds.subject_ids):
+            if len(source_files.get(int(subject_id), [])) > 0:
+                fingerprints[subject_id] = calc_source_fingerprint(data_dir, source_files[int(subject_id)])
+            else:
+                if dataset_fingerprint is None:
+                    dataset_fingerprint = calc_source_fingerprint(data_dir, all_source_files)
+                fingerprints[subject_id] = dataset_fingerprint
+        for subject_id in manifest.get_subject_ids():
+            if subject_id not in fingerprints:
+                print(f'Removing outputs of subject {subject_id}, which is no longer in the dataset')
+                manifest.remove(subject_id)
+
+        # the features of the first subject are also projected below, rather than decoded again
+        first_features = load_subject_features(config, ds, 0, fingerprints[ds.subject_ids[0]])
+        cs = CubedSphere(mask=first_features.mask, row_angles=ds.row_angles, column_angles=ds.column_angles)
+        projector = SubjectProjector(config, cs, projection, ds.row_angles, ds.column_angles, ds.hrir_samplerate)
+
+        # accumulate statistics of all train_hrtfs to get mean and sd
+        train_stats = RunningStats(config.nbins_hrtf)
+        changed_subject_ids = set()
+
+        def valid_subjects():
+            # each subject is decoded once here (or read from the cache) and then handed to the projector
+            for i in range(len(ds)):
+                if i % 10 == 0:
+                    print(f"HRTF {i} out of {len(ds)} ({round(100 * i / len(ds))}%)")
+
+                subject_id, side = ds.subject_ids[i], ds.sides[i]
+                if manifest.is_up_to_date(subject_id, side, fingerprints[subject_id]):
+                    # unchanged train subjects still count towards the statistics
+                    if manifest.is_valid(subject_id, side) and splits[subject_id] == 'train':
+                        train_stats.add(load_hrtf_file(manifest.get_outputs(subject_id, side)[0]))
+                    continue
+
+                changed_subject_ids.add(subject_id)
+                if i == 0:
+                    features = first_features
+                else:
+                    features = load_subject_features(config, ds, i, fingerprints[subject_id])
+
+                # Verification that HRTF is valid
+                if np.isnan(features).any():
+                    print(f'HRTF (Subject ID: {i}) contains nan values')
+                    manifest.update(subject_id, side, fingerprints[subject_id], splits[subject_id], False, [])
+                    continue
+
+                yield i, features
+
+        # validity of the files read by the datasets, see preprocessing.validity
+        validity_manifests = {}
+        sphere_original = None
+        for i, (clean_hrtf, hrtf_original, phase_original, sphere_original) in \
+                project_subjects(projector, valid_subjects(), config.num_preprocess_workers):
 
             # save cleaned hrtfdata
-            if ds.subject_ids[i] in train_sample:
+            if splits[ds.subject_ids[i]] == 'train':
                 projected_dir = config.train_hrtf_dir
                 projected_dir_original = config.train_original_hrtf_dir
-                train_hrtfs[j] = clean_hrtf
-                j += 1
             else:
                 projected_dir = config.valid_hrtf_dir
                 projected_dir_original = config.valid_original_hrtf_dir
 
             subject_id = str(ds.subject_ids[i])
             side = ds.sides[i]
-            with open('%s/%s_mag_%s%s.pickle' % (projected_dir, config.dataset, subject_id, side), "wb") as file:
-                pickle.dump(clean_hrtf, file)
-
-            with open('%s/%s_mag_%s%s.pickle' % (projected_dir_original, config.dataset, subject_id, side), "wb") as file:
-                pickle.dump(hrtf_original, file)
-
-            with open('%s/%s_phase_%s%s.pickle' % (projected_dir_original, config.dataset, subject_id, side), "wb") as file:
-                pickle.dump(phase_original, file)
-
-        if config.merge_flag:
-            merge_files(config)
-
-        if config.gen_sofa_flag:
-            gen_sofa_preprocess(config, cube, sphere, sphere_original)
+            outputs = ['%s/%s_mag_%s%s.pickle' % (projected_dir, config.dataset, subject_id, side),
+                       '%s/%s_mag_%s%s.pickle' % (projected_dir_original, config.dataset, subject_id, side),
+                       '%s/%s_phase_%s%s.pickle' % (projected_dir_original, config.dataset, subject_id, side)]
+            # the HRTFs on the cubed sphere are stored with the storage policy, the original HRTFs at full precision
+            stored_hrtf = save_hrtf_file(outputs[0], clean_hrtf, config.hrtf_storage_policy)
+            for output, data in zip(outputs[1:], (hrtf_original, phase_original)):
+                with open(output, "wb") as file:
+                    pickle.dump(data, file)
+            if splits[ds.subject_ids[i]] == 'train':
+                # statistics of the HRTFs as they are read back
+                train_stats.add(decode_hrtf(stored_hrtf, config.hrtf_storage_policy))
+            if config.gen_lr_pyramid_flag:
+                outputs += write_lr_pyramid(outputs[0], clean_hrtf, config.hrtf_size, config.hrtf_storage_policy)
+            if projected_dir not in validity_manifests:
+                set_storage_policy(projected_dir, config.hrtf_storage_policy)
+                validity_manifests[projected_dir] = ValidityManifest(projected_dir)
+            validity_manifests[projected_dir].record(outputs[0], stored_hrtf)
+
+            manifest.update(ds.subject_ids[i], side, fingerprints[ds.subject_ids[i]], splits[ds.subject_ids[i]], True,
+                            outputs)
+
+        # merging and SOFA export are limited to the subjects that were reprocessed
+        if full_rebuild:
+            changed_subject_ids = None
+        elif len(changed_subject_ids) == 0:
+            print('All subjects are up to date')
+
+        for validity_manifest in validity_manifests.values():
+            validity_manifest.save()
+
+        if config.merge_flag and changed_subject_ids != set():
+            merge_files(config, changed_subject_ids)
+
+        if config.gen_sofa_flag and sphere_original is not None:
+            gen_sofa_preprocess(config, projection.cube, projection.sphere, sphere_original,
+                                projection.get_cube_indices(), changed_subject_ids)
 
         # save dataset mean and standard deviation for each channel, across all HRTFs in the training data
-        mean = torch.mean(train_hrtfs, [0, 1, 2, 3])
-        std = torch.std(train_hrtfs, [0, 1, 2, 3])
-        min_hrtf = torch.min(train_hrtfs)
-        max_hrtf = torch.max(train_hrtfs)
+        mean, std, min_hrtf, max_hrtf = train_stats.get_stats()
         mean_std_filename = config.mean_std_filename
         with open(mean_std_filename, "wb") as file:
             pickle.dump((mean, std, min_hrtf, max_hrtf), file)
 
+        # only record the subjects once all of their outputs have been written
+        for subject_id in (set(ds.subject_ids) if changed_subject_ids is None else changed_subject_ids):
+            manifest.set_subject_outputs(subject_id, get_subject_outputs(config, subject_id, splits[subject_id]))
+        manifest.save()
+        stage.save()
+
+    elif mode == 'build_noisy_datasets':
+        # Adds noise of every colour and SNR in Config to the clean HRTFs, writing one noisy train and valid dataset per
+        # combination to hr_merge_noisy, where they can be trained and tested with as train_folder/validation_folder
+        noisy_dirs = [f'{config.noisy_hrtf_merge_dir}/{get_noisy_folder(colour, snr_db, split)}'
+                      for colour in config.noise_colours for snr_db in config.noise_snrs_db
+                      for split in ('train', 'valid')]
+        stage = CachedStage(config, mode, inputs=[config.train_hrtf_dir, config.valid_hrtf_dir], outputs=noisy_dirs)
+        if stage.is_cached():
+            return
+
+        build_noisy_datasets(config)
+        stage.save()
+
     elif mode == 'train':
         # Trains the GANs, according to the parameters specified in Config
 
@@ -122,6 +232,13 @@ def main(config, mode, noise, clean_hrtf_ratio):
 
 #*********************End of Added Code to Train With Noisy Files************************************************************************      
 
+        elif noise == "augment_noise":
+            # noise is added to the clean HRTFs as they are batched, rather than read from hr_merge_noisy
+            train_prefetcher, _ = load_dataset(config, clean_hrtf_ratio=clean_hrtf_ratio, mean=None, std=None,
+                                               augment_noise=True)
+            print(f"Loaded all datasets successfully, adding {', '.join(config.noise_colours)} noise at "
+                  f"{', '.join(map(str, config.noise_snrs_db))}dB SNR.")
+
         else:
             train_prefetcher, _ = load_dataset(config, mean=None, std=None)
             print("Loaded all datasets successfully.")
@@ -130,6 +247,17 @@ def main(config, mode, noise, clean_hrtf_ratio):
         train(config, train_prefetcher)
 
     elif mode == 'test':
+        valid_hrtf_dir = config.valid_noisy_hrtf_merge_dir if noise == "with_noise" else config.valid_hrtf_merge_dir
+        model_paths = [f'{config.model_path}/Gen.pt']
+        if config.inference_backend == 'onnx':
+            model_paths.append(get_onnx_filename(config))
+        stage = CachedStage(config, mode,
+                            inputs=[*model_paths, valid_hrtf_dir, config.valid_hrtf_merge_dir,
+                                    *get_projection_paths(config)],
+                            outputs=[config.valid_path, f'{config.path}/lsd_errors.pickle',
+                                     f'{config.path}/loc_errors.pickle'], noise=noise)
+        if stage.is_cached():
+            return
 
 #*********************Added Code to Test With Noisy Files************************************************************************ 
         if noise == "with_noise":
@@ -150,10 +278,20 @@ def main(config, mode, noise, clean_hrtf_ratio):
 #*********************End of Added Code to Compare the LSD of Subjects with the LSD of All Other Subjects And Average the Results************************************************************************ 
 
         run_localisation_evaluation(config, config.valid_path)
+        stage.save()
 
     elif mode == 'barycentric_baseline':
         barycentric_data_folder = f'/barycentric_interpolated_data_{config.upscale_factor}'
         barycentric_output_path = config.barycentric_hrtf_dir + barycentric_data_folder
+        stage = CachedStage(config, mode, inputs=[config.valid_hrtf_merge_dir, *get_projection_paths(config)],
+                            outputs=[barycentric_output_path,
+                                     f'{config.barycentric_hrtf_dir}/lsd_errors_barycentric_interpolated_data_'
+                                     f'{config.upscale_factor}.pickle',
+                                     f'{config.barycentric_hrtf_dir}/loc_errors_barycentric_interpolated_data_'
+                                     f'{config.upscale_factor}.pickle'])
+        if stage.is_cached():
+            return
+
         cube, sphere = run_barycentric_interpolation(config, barycentric_output_path)
 
         if config.gen_sofa_flag:
@@ -167,17 +305,21 @@ def main(config, mode, noise, clean_hrtf_ratio):
 
         file_ext = f'loc_errors_barycentric_interpolated_data_{config.upscale_factor}.pickle'
         run_localisation_evaluation(config, barycentric_output_path, file_ext)
+        stage.save()
 
     elif mode == 'hrtf_selection_baseline':
+        stage = CachedStage(config, mode, inputs=[config.valid_hrtf_merge_dir, *get_projection_paths(config)],
+                            outputs=[config.hrtf_selection_dir])
+        if stage.is_cached():
+            return
 
         run_hrtf_selection(config, config.hrtf_selection_dir)
 
-        projection_filename = f'{config.projection_dir}/{config.dataset}_projection_{config.hrtf_size}'
-        with open(projection_filename, "rb") as f:
-            (cube, sphere, _, _) = pickle.load(f)
+        projection = load_projection(config)
 
         if config.gen_sofa_flag:
-            convert_to_sofa(config.hrtf_selection_dir, config, cube, sphere)
+            convert_to_sofa(config.hrtf_selection_dir, config, projection.cube, projection.sphere,
+                            cube_indices=projection.get_cube_indices())
             print('Created barycentric baseline sofa files')
 
         config.path = config.hrtf_selection_dir
@@ -191,14 +333,14 @@ def main(config, mode, noise, clean_hrtf_ratio):
         run_lsd_evaluation(config, config.hrtf_selection_dir, file_ext, hrtf_selection='maximum')
         file_ext = f'loc_errors_hrtf_selection_maximum_data.pickle'
         run_localisation_evaluation(config, config.hrtf_selection_dir, file_ext, hrtf_selection='maximum')
+        stage.save()
 
 #*********************Added Code to Directly Create Sofa Files When HRTFs are Already in a Pickle Format************************************************************************ 
     elif mode == 'generate_sofa_files':
-        projection_filename = f'{config.projection_dir}/{config.dataset}_projection_{config.hrtf_size}'
-        with open(projection_filename, "rb") as file:
-            cube, sphere, sphere_triangles, sphere_coeffs = pickle.load(file)
-            
-        convert_to_sofa(config.valid_noisy_hrtf_merge_dir, config, cube, sphere)
+        projection = load_projection(config)
+
+        convert_to_sofa(config.valid_noisy_hrtf_merge_dir, config, projection.cube, projection.sphere,
+                        cube_indices=projection.get_cube_indices())
 #*********************End of Added Code to Directly Create Sofa Files When HRTFs are already in a pickle format************************************************************************ 
 
 #*********************Added Code to Check LSD of Noisy Files************************************************************************    
@@ -206,6 +348,28 @@ def main(config, mode, noise, clean_hrtf_ratio):
         run_lsd_evaluation(config, config.valid_noisy_hrtf_merge_dir)
 #*********************End of Added Code to Check LSD of Noisy Files************************************************************************    
 
+    elif mode == 'storage_precision_report':
+        # LSD impact of storing the HRTFs with each storage policy
+        Path(config.path).mkdir(parents=True, exist_ok=True)
+        run_storage_precision_evaluation(config)
+
+    elif mode == 'export_onnx':
+        # Exports the trained generator to ONNX, such that test mode can run it with ONNX Runtime on CPU-only nodes
+        # (see Config.inference_backend), and checks its outputs against those of PyTorch
+        stage = CachedStage(config, mode, inputs=[f'{config.model_path}/Gen.pt'],
+                            outputs=[get_onnx_filename(config)])
+        if stage.is_cached():
+            return
+
+        model = export_generator_onnx(config)
+        check_onnx_parity(config, model, OnnxGenerator(get_onnx_filename(config)))
+        stage.save()
+
+    elif mode == 'compile_benchmark':
+        # Speedup of training and inference with the models compiled (see Config.compile_model) over eager mode
+        Path(config.path).mkdir(parents=True, exist_ok=True)
+        run_compile_benchmark(config)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
@@ -0,0 +1,85 @@
+import pickle
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from model.model import Generator, Discriminator
+
+
+def _time_step(step, device, repeats, warmup):
+    """Median time of step() in seconds, after warmup calls (which include compiling the models)"""
+    for _ in range(warmup):
+        step()
+    times = []
+    for _ in range(repeats):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def run_compile_benchmark(config, batch_size=None, repeats=20, warmup=3, file_ext=None):
+    """Time inference of the generator and a training step of the generator and discriminator on random HRTFs, with
+    the models run eagerly and compiled with torch.compile (config.compile_mode), and report the speedup of compiling.
+    The weights of both are the same, so the difference between their outputs is reported as well"""
+    file_ext = 'compile_benchmark.pickle' if file_ext is None else file_ext
+    batch_size = config.batch_size if batch_size is None else batch_size
+    nbins = config.nbins_hrtf * 2 if config.merge_flag else config.nbins_hrtf
+    device = torch.device(config.device_name if (torch.cuda.is_available() and config.ngpu > 0) else "cpu")
+    lr_size = config.hrtf_size // config.upscale_factor
+
+    lr = torch.rand((batch_size, nbins, 5, lr_size, lr_size), device=device)
+    hr = torch.rand((batch_size, nbins, 5, config.hrtf_size, config.hrtf_size), device=device)
+    adversarial_criterion = nn.BCEWithLogitsLoss()
+    label = torch.ones((batch_size, ), device=device)
+
+    torch.manual_seed(0)
+    eager_netG = Generator(upscale_factor=config.upscale_factor, nbins=nbins).to(device)
+    eager_netD = Discriminator(nbins=nbins).to(device)
+    results = {}
+    outputs = {}
+    for name in ('eager', 'compiled'):
+        netG = Generator(upscale_factor=config.upscale_factor, nbins=nbins).to(device)
+        netD = Discriminator(nbins=nbins).to(device)
+        netG.load_state_dict(eager_netG.state_dict())
+        netD.load_state_dict(eager_netD.state_dict())
+        if name == 'compiled':
+            netG.compile(fullgraph=True, mode=config.compile_mode)
+            netD.compile(fullgraph=True, mode=config.compile_mode)
+
+        def inference():
+            with torch.no_grad():
+                return netG(lr)
+
+        def train_step():
+            netG.zero_grad()
+            netD.zero_grad()
+            sr = netG(lr)
+            loss = adversarial_criterion(netD(hr).view(-1), label) + adversarial_criterion(netD(sr).view(-1), label)
+            loss.backward()
+
+        netG.eval()
+        results[name] = {'inference': _time_step(inference, device, repeats, warmup)}
+        outputs[name] = inference()
+        netG.train()
+        netD.train()
+        results[name]['train_step'] = _time_step(train_step, device, repeats, warmup)
+
+    for step in ('inference', 'train_step'):
+        results[f'{step}_speedup'] = results['eager'][step] / results['compiled'][step]
+        print('%s (batch size %d): eager %0.4fs, compiled %0.4fs, speedup %0.2fx'
+              % (step, batch_size, results['eager'][step], results['compiled'][step], results[f'{step}_speedup']))
+    results['max_abs_difference'] = float(torch.max(torch.abs(outputs['eager'] - outputs['compiled'])))
+    print('Max absolute difference between eager and compiled generator outputs: %0.2e'
+          % results['max_abs_difference'])
+
+    with open(f'{config.path}/{file_ext}', "wb") as file:
+        pickle.dump(results, file)
+
+    return results
@@ -1,4 +1,5 @@
 import collections
+import functools
 import math
 from itertools import repeat
 
@@ -32,6 +33,92 @@ _scalar_or_tuple_2_t = Union[T, Tuple[T, T]]
 _size_2_t = _scalar_or_tuple_2_t[int]
 
 
+def _pad_cube_sphere(inputs: Tensor, p: int) -> Tensor:
+    """Pads a cubed sphere tensor (batch, channels, 5, height, width) by slicing and concatenating the adjacent panels,
+    which CubeSpherePadding2D only does once per input size, on a tensor of indices, to build its index table, unless
+    it is scripted or compiled"""
+    # Pad the equatorial upper/lower boundaries and the polar upper/lower boundaries
+    out = [
+        # Panel 0
+        torch.unsqueeze(
+            torch.cat([torch.unsqueeze(inputs[:, :, 0, :, 0], 3).expand(-1, -1, -1, p),
+                       inputs[:, :, 0],
+                       inputs[:, :, 4, :, :p]], dim=3), 2
+        ),
+        # Panel 1
+        torch.unsqueeze(
+            torch.cat([torch.unsqueeze(inputs[:, :, 1, :, 0], 3).expand(-1, -1, -1, p),
+                       inputs[:, :, 1],
+                       torch.transpose(torch.flip(inputs[:, :, 4, -p:, :], dims=[2]), dim0=2, dim1=3)], dim=3), 2
+        ),
+        # Panel 2
+        torch.unsqueeze(
+            torch.cat([torch.unsqueeze(inputs[:, :, 2, :, 0], 3).expand(-1, -1, -1, p),
+                       inputs[:, :, 2],
+                       torch.flip(inputs[:, :, 4, :, -p:], dims=[2, 3])], dim=3), 2
+        ),
+        # Panel 3
+        torch.unsqueeze(
+            torch.cat([torch.unsqueeze(inputs[:, :, 3, :, 0], 3).expand(-1, -1, -1, p),
+                       inputs[:, :, 3],
+                       torch.transpose(torch.flip(inputs[:, :, 4, :p, :], dims=[3]), dim0=2, dim1=3)], dim=3), 2
+        ),
+        # Panel 4 (top)
+        torch.unsqueeze(
+            torch.cat([inputs[:, :, 0, :, -p:],
+                       inputs[:, :, 4],
+                       torch.flip(inputs[:, :, 2, :, -p:], dims=[2, 3])], dim=3), 2
+        )
+    ]
+
+    out1 = torch.cat(out, dim=2)
+    del out
+
+    # Pad the equatorial periodic lateral boundaries and the polar left/right boundaries
+    out = []
+
+    # Panel 0
+    out.append(torch.unsqueeze(torch.cat([out1[:, :, 3, -p:, :],
+                                          out1[:, :, 0],
+                                          out1[:, :, 1, :p, :]], dim=2), 2))
+    # Panel 1
+    out.append(torch.unsqueeze(torch.cat([out1[:, :, 0, -p:, :],
+                                          out1[:, :, 1],
+                                          out1[:, :, 2, :p, :]], dim=2), 2))
+    # Panel 2
+    out.append(torch.unsqueeze(torch.cat([out1[:, :, 1, -p:, :],
+                                          out1[:, :, 2],
+                                          out1[:, :, 3, :p, :]], dim=2), 2))
+    # Panel 3
+    out.append(torch.unsqueeze(torch.cat([out1[:, :, 2, -p:, :],
+                                          out1[:, :, 3],
+                                          out1[:, :, 0, :p, :]], dim=2), 2))
+    # Panel 4 (top)
+    out.append(torch.unsqueeze(
+        torch.cat([torch.transpose(torch.flip(out[3][:, :, 0, :, -2 * p:-p], dims=[2]), dim0=2, dim1=3),
+                   out1[:, :, 4],
+                   torch.transpose(torch.flip(out[1][:, :, 0, :, -2 * p:-p], dims=[3]), dim0=2, dim1=3)], dim=2),
+        2)
+    )
+
+    del out1
+    outputs = torch.cat(out, dim=2)
+    del out
+
+    return outputs
+
+
+@functools.lru_cache(maxsize=None)
+def get_cube_padding_indices(height: int, width: int, padding: int) -> Tuple[Tensor, Tensor]:
+    """Index tables of the padding cells of a cubed sphere tensor (5, height, width): the position of each cell of the
+    padded tensor (5, height + 2 * padding, width + 2 * padding) outside the unpadded panels, and the position in the
+    unpadded tensor it is copied from, both in the flattened tensors"""
+    padded = _pad_cube_sphere(torch.arange(5 * height * width).view(1, 1, 5, height, width), padding)[0, 0]
+    border = torch.ones(padded.shape, dtype=torch.bool)
+    border[:, padding:padding + height, padding:padding + width] = False
+    return torch.nonzero(border.flatten()).flatten(), padded[border]
+
+
 class CubeSpherePadding2D(Module):
     """
     Pads the input cubed sphere tensor according to adjacent panels. The requirements for this layer are as follows:
@@ -40,6 +127,11 @@ class CubeSpherePadding2D(Module):
 
     Adapted from CubeSpherePadding2D by @jweyn
 
+    Every padding cell is copied from a cell of the input, so the panels are copied into a preallocated output and the
+    padding cells are filled with a single gather, using index tables built once per input size and padding width
+    (see get_cube_padding_indices). Scripted or compiled, the layer pads by slicing the panels instead, which gives the
+    same output without any state outside the graph.
+
     Args:
         padding (int): Width of padding on each cube sphere panel
     """
@@ -49,79 +141,59 @@ class CubeSpherePadding2D(Module):
     def __init__(self, padding: int) -> None:
         super(CubeSpherePadding2D, self).__init__()
         self.padding = padding
+        # index tables of each input size and device the layer has been used with
+        self._indices = {}
 
     def forward(self, inputs: Tensor) -> Tensor:
+        if torch.jit.is_scripting() or torch.compiler.is_compiling():
+            # the index tables are cached outside the graph, which is captured from the slicing ops instead and fused
+            # by the compiler
+            return _pad_cube_sphere(inputs, self.padding)
+        return self._pad_indexed(inputs)
+
+    @torch.jit.unused
+    def _pad_indexed(self, inputs: Tensor) -> Tensor:
+        n, c, panels, h, w = inputs.shape
         p = self.padding
+        indices = self._indices.get((h, w, inputs.device))
+        if indices is None:
+            indices = tuple(index.to(inputs.device) for index in get_cube_padding_indices(h, w, p))
+            self._indices[(h, w, inputs.device)] = indices
+        positions, sources = indices
+
+        outputs = inputs.new_empty((n, c, panels, h + 2 * p, w + 2 * p))
+        outputs[:, :, :, p:p + h, p:p + w] = inputs
+        outputs.view(n, c, -1)[:, :, positions] = inputs.reshape(n, c, -1)[:, :, sources]
+        return outputs
 
-        # Pad the equatorial upper/lower boundaries and the polar upper/lower boundaries
-        out = [
-            # Panel 0
-            torch.unsqueeze(
-                torch.cat(list(repeat(torch.unsqueeze(inputs[:, :, 0, :, 0], 3), p)) +
-                          [inputs[:, :, 0],
-                           inputs[:, :, 4, :, :p]], dim=3), 2
-            ),
-            # Panel 1
-            torch.unsqueeze(
-                torch.cat(list(repeat(torch.unsqueeze(inputs[:, :, 1, :, 0], 3), p)) +
-                          [inputs[:, :, 1],
-                           torch.transpose(torch.flip(inputs[:, :, 4, -p:, :], dims=[2]), dim0=2, dim1=3)], dim=3), 2
-            ),
-            # Panel 2
-            torch.unsqueeze(
-                torch.cat(list(repeat(torch.unsqueeze(inputs[:, :, 2, :, 0], 3), p)) +
-                          [inputs[:, :, 2],
-                           torch.flip(inputs[:, :, 4, :, -p:], dims=[2, 3])], dim=3), 2
-            ),
-            # Panel 3
-            torch.unsqueeze(
-                torch.cat(list(repeat(torch.unsqueeze(inputs[:, :, 3, :, 0], 3), p)) +
-                          [inputs[:, :, 3],
-                           torch.transpose(torch.flip(inputs[:, :, 4, :p, :], dims=[3]), dim0=2, dim1=3)], dim=3), 2
-            ),
-            # Panel 4 (top)
-            torch.unsqueeze(
-                torch.cat([inputs[:, :, 0, :, -p:],
-                           inputs[:, :, 4],
-                           torch.flip(inputs[:, :, 2, :, -p:], dims=[2, 3])], dim=3), 2
-            )
-        ]
 
-        out1 = torch.cat(out, dim=2)
-        del out
+class CubePixelShuffle(Module):
+    """
+    Rearranges the channels of a cubed sphere tensor into a higher resolution on each panel, as nn.PixelShuffle does
+    for each panel of the tensor, but taking the 5-dimensional tensor directly:
+    (batch, channels * r^2, 5, height, width) to (batch, channels, 5, height * r, width * r). The channels of each
+    output position are the same as those of nn.PixelShuffle applied with the panels as batch dimension, in a single
+    copy instead of permuting the tensor before and after.
 
-        # Pad the equatorial periodic lateral boundaries and the polar left/right boundaries
-        out = []
+    Args:
+        upscale_factor (int): Factor r to increase the resolution of each panel by
+    """
+    __constants__ = ['upscale_factor']
+    upscale_factor: int
 
-        # Panel 0
-        out.append(torch.unsqueeze(torch.cat([out1[:, :, 3, -p:, :],
-                                              out1[:, :, 0],
-                                              out1[:, :, 1, :p, :]], dim=2), 2))
-        # Panel 1
-        out.append(torch.unsqueeze(torch.cat([out1[:, :, 0, -p:, :],
-                                              out1[:, :, 1],
-                                              out1[:, :, 2, :p, :]], dim=2), 2))
-        # Panel 2
-        out.append(torch.unsqueeze(torch.cat([out1[:, :, 1, -p:, :],
-                                              out1[:, :, 2],
-                                              out1[:, :, 3, :p, :]], dim=2), 2))
-        # Panel 3
-        out.append(torch.unsqueeze(torch.cat([out1[:, :, 2, -p:, :],
-                                              out1[:, :, 3],
-                                              out1[:, :, 0, :p, :]], dim=2), 2))
-        # Panel 4 (top)
-        out.append(torch.unsqueeze(
-            torch.cat([torch.transpose(torch.flip(out[3][:, :, 0, :, -2 * p:-p], dims=[2]), dim0=2, dim1=3),
-                       out1[:, :, 4],
-                       torch.transpose(torch.flip(out[1][:, :, 0, :, -2 * p:-p], dims=[3]), dim0=2, dim1=3)], dim=2),
-            2)
-        )
+    def __init__(self, upscale_factor: int) -> None:
+        super(CubePixelShuffle, self).__init__()
+        self.upscale_factor = upscale_factor
 
-        del out1
-        outputs = torch.cat(out, dim=2)
-        del out
+    def forward(self, inputs: Tensor) -> Tensor:
+        r = self.upscale_factor
+        n, c, panels, h, w = inputs.shape
+        # (batch, channels, r, r, 5, height, width) to (batch, channels, 5, height, r, width, r)
+        outputs = inputs.reshape(n, c // (r * r), r, r, panels, h, w).permute(0, 1, 4, 5, 2, 6, 3)
+        return outputs.reshape(n, c // (r * r), panels, h * r, w * r)
 
-        return outputs
+    def extra_repr(self) -> str:
+        return f'upscale_factor={self.upscale_factor}'
 
 
 class _ConvNd(Module):
@@ -312,6 +384,8 @@ class CubeSphereConv2D(_ConvNd):
         dilation (int or tuple, optional): Spacing between kernel elements. Default: 1
         bias (bool, optional): If ``True``, adds a learnable bias to the
             output. Default: ``True``
+        fold_panels (bool, optional): If ``True``, the four equatorial panels are folded into the batch dimension and
+            convolved with a single call, rather than one call per panel. Default: ``True``
 
     Shape:
         - Input: :math:`(N, C_{in}, 5, H_{in}, W_{in})` or :math:`(C_{in}, 5, H_{in}, W_{in})`
@@ -356,7 +430,8 @@ class CubeSphereConv2D(_ConvNd):
             bias: bool = True,
             padding_mode: str = 'zeros',  # TODO: refine this type
             device=None,
-            dtype=None
+            dtype=None,
+            fold_panels: bool = True
     ) -> None:
         factory_kwargs = {'device': device, 'dtype': dtype}
         kernel_size_ = _pair(kernel_size)
@@ -366,9 +441,40 @@ class CubeSphereConv2D(_ConvNd):
         super(CubeSphereConv2D, self).__init__(
             in_channels, out_channels, kernel_size_, stride_, padding_, dilation_,
             False, _pair(0), bias, padding_mode, **factory_kwargs)
+        self.fold_panels = fold_panels
+
+    def __setstate__(self, state):
+        super(CubeSphereConv2D, self).__setstate__(state)
+        if not hasattr(self, 'fold_panels'):
+            self.fold_panels = True
+
+    def _conv_panels(self, input: Tensor, weight: Tensor, bias: Optional[Tensor]) -> Tensor:
+        """Convolve every panel of input (N, C_in, panels, H, W) with the same weights, as a batch of N * panels"""
+        n, c, panels, h, w = input.shape
+        folded = input.transpose(1, 2).reshape(n * panels, c, h, w)
+        if self.padding_mode != 'zeros':
+            return F.conv2d(F.pad(folded, self._reversed_padding_repeated_twice, mode=self.padding_mode),
+                            weight, bias, self.stride, [0, 0], self.dilation, self.groups)
+        return F.conv2d(folded, weight, bias, self.stride, self.padding, self.dilation, self.groups)
 
     def _conv_forward(self, input: Tensor, equatorial_weight: Tensor, polar_weight: Tensor,
                       equatorial_bias: Optional[Tensor], polar_bias: Optional[Tensor]):
+        if not self.fold_panels:
+            return self._conv_forward_per_panel(input, equatorial_weight, polar_weight, equatorial_bias, polar_bias)
+
+        n = input.shape[0]
+        # Equatorial panels, which share their weights, in one convolution
+        equatorial = self._conv_panels(input[:, :, :4], equatorial_weight, equatorial_bias)
+        # Top panel
+        polar = self._conv_panels(input[:, :, 4:], polar_weight, polar_bias)
+
+        outputs = equatorial.new_empty([n, equatorial.shape[1], 5, equatorial.shape[2], equatorial.shape[3]])
+        outputs[:, :, :4] = equatorial.unflatten(0, (n, 4)).transpose(1, 2)
+        outputs[:, :, 4] = polar
+        return outputs
+
+    def _conv_forward_per_panel(self, input: Tensor, equatorial_weight: Tensor, polar_weight: Tensor,
+                                equatorial_bias: Optional[Tensor], polar_bias: Optional[Tensor]):
         outputs = []
         if self.padding_mode != 'zeros':
             # Equatorial panels
@@ -378,7 +484,7 @@ class CubeSphereConv2D(_ConvNd):
                         F.conv2d(
                             F.pad(input[:, :, p, :, :], self._reversed_padding_repeated_twice, mode=self.padding_mode),
                             equatorial_weight, equatorial_bias, self.stride,
-                            _pair(0), self.dilation, self.groups), 2)
+                            [0, 0], self.dilation, self.groups), 2)
                 )
 
             # Top panel
@@ -386,7 +492,7 @@ class CubeSphereConv2D(_ConvNd):
                 torch.unsqueeze(
                     F.conv2d(F.pad(input[:, :, 4, :, :], self._reversed_padding_repeated_twice, mode=self.padding_mode),
                              polar_weight, polar_bias, self.stride,
-                             _pair(0), self.dilation, self.groups), 2)
+                             [0, 0], self.dilation, self.groups), 2)
             )
 
         else:
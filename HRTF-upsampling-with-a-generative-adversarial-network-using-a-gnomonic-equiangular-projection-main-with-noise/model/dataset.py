@@ -1,9 +1,18 @@
 import os
 import pickle
+import queue
+import threading
+import time
 import torch
 import numpy as np
 from torch.utils.data import Dataset
 
+from model.layout import to_channels_first, to_channels_last
+from preprocessing.lr_pyramid import read_lr_hrtf
+from preprocessing.noise import NOISE_COLOURS, check_noise_colours, generate_coloured_noise, add_noise
+from preprocessing.storage import decode_hrtf, get_storage_policy, load_hrtf_file
+from preprocessing.validity import filter_valid_hrtf_files
+
 
 # based on https://github.com/Lornatang/SRGAN-PyTorch/blob/7292452634137d8f5d4478e44727ec1166a89125/dataset.py
 def downsample_hrtf(hr_hrtf, hrtf_size, upscale_factor):
@@ -16,6 +25,17 @@ def downsample_hrtf(hr_hrtf, hrtf_size, upscale_factor):
 
     return lr_hrtf
 
+def transform_hrtf(hrtf, transform=None):
+    """Apply the transform to an HRTF of shape (panels, X, Y, channels), returning it contiguous in the canonical
+    layout (channels, panels, X, Y), see model.layout"""
+    hrtf = to_channels_first(hrtf)
+    if transform is not None:
+        # If using a transform, treat panels as batch dim such that dims are (panels, channels, X, Y)
+        hrtf = torch.transpose(transform(torch.transpose(hrtf, 0, 1)), 0, 1)
+    # the only copy of the HRTF, where the transform does not already make one in the canonical layout
+    return hrtf.contiguous()
+
+
 class TrainValidHRTFDataset(Dataset):
     """Define training/valid dataset loading methods.
     Args:
@@ -23,22 +43,19 @@ class TrainValidHRTFDataset(Dataset):
         hrtf_size (int): High resolution hrtf size.
         upscale_factor (int): hrtf up scale factor.
         transform (callable): A function/transform that takes in an HRTF and returns a transformed version.
+        use_lr_pyramid (bool): Read the low resolution HRTFs written by preprocessing instead of downsampling, if they exist.
     """
 
-    def __init__(self, hrtf_dir: str, hrtf_size: int, upscale_factor: int, transform=None, run_validation =True) -> None:
+    def __init__(self, hrtf_dir: str, hrtf_size: int, upscale_factor: int, transform=None, run_validation =True,
+                 use_lr_pyramid=True) -> None:
         super(TrainValidHRTFDataset, self).__init__()
         # Get all hrtf file names in folder
         self.hrtf_file_names = [os.path.join(hrtf_dir, hrtf_file_name) for hrtf_file_name in os.listdir(hrtf_dir)
                                 if os.path.isfile(os.path.join(hrtf_dir, hrtf_file_name))]
 
         if run_validation:
-            valid_hrtf_file_names = []
-            for hrtf_file_name in self.hrtf_file_names:
-                file = open(hrtf_file_name, 'rb')
-                hrtf = pickle.load(file)
-                if not np.isnan(np.sum(hrtf.cpu().data.numpy())):
-                    valid_hrtf_file_names.append(hrtf_file_name)
-            self.hrtf_file_names = valid_hrtf_file_names
+            # only files that are new or have changed since the last run are read (see preprocessing.validity)
+            self.hrtf_file_names = filter_valid_hrtf_files(self.hrtf_file_names)
 
         # Specify the high-resolution hrtf size, with equal length and width
         self.hrtf_size = hrtf_size
@@ -46,24 +63,29 @@ class TrainValidHRTFDataset(Dataset):
         self.upscale_factor = upscale_factor
         # transform to be applied to the data
         self.transform = transform
+        # whether to read low resolution HRTFs written by preprocessing, when they exist
+        self.use_lr_pyramid = use_lr_pyramid
+
+    def load_hrtf(self, batch_index: int) -> torch.Tensor:
+        return load_hrtf_file(self.hrtf_file_names[batch_index])
+
+    def load_lr_hrtf(self, batch_index: int):
+        """Low resolution HRTF written by preprocessing (see preprocessing.lr_pyramid), None if there is none"""
+        if not self.use_lr_pyramid:
+            return None
+        return read_lr_hrtf(self.hrtf_file_names[batch_index], self.upscale_factor)
 
     def __getitem__(self, batch_index: int) -> [torch.Tensor, torch.Tensor]:
         # Read a batch of hrtf data
-        with open(self.hrtf_file_names[batch_index], "rb") as file:
-            hrtf = pickle.load(file)
-
-        # hrtf processing operations
-        if self.transform is not None:
-            # If using a transform, treat panels as batch dim such that dims are (panels, channels, X, Y)
-            hr_hrtf = torch.permute(hrtf, (0, 3, 1, 2))
-            # Then, transform hr_hrtf to normalize and swap panel/channel dims to get channels first
-            hr_hrtf = torch.permute(self.transform(hr_hrtf), (1, 0, 2, 3))
-        else:
-            # If no transform, go directly to (channels, panels, X, Y)
-            hr_hrtf = torch.permute(hrtf, (3, 0, 1, 2))
+        hrtf = self.load_hrtf(batch_index)
+        hr_hrtf = transform_hrtf(hrtf, self.transform)
 
-        # downsample hrtf
-        lr_hrtf = downsample_hrtf(hr_hrtf, self.hrtf_size, self.upscale_factor)
+        # downsample hrtf, unless it was already downsampled in preprocessing
+        lr_hrtf = self.load_lr_hrtf(batch_index)
+        if lr_hrtf is not None:
+            lr_hrtf = transform_hrtf(lr_hrtf, self.transform)
+        else:
+            lr_hrtf = downsample_hrtf(hr_hrtf, self.hrtf_size, self.upscale_factor)
 
         return {"lr": lr_hrtf, "hr": hr_hrtf, "filename": self.hrtf_file_names[batch_index]}
 
@@ -71,6 +93,136 @@ class TrainValidHRTFDataset(Dataset):
         return len(self.hrtf_file_names)
 
 
+class HRTFStoreDataset(TrainValidHRTFDataset):
+    """Define training/valid dataset loading methods for HRTFs held in an HRTFStore, which are read from the
+    memory-mapped store without copying instead of unpickling one file per sample.
+    Args:
+        store (HRTFStore): Store of a Train/Valid dataset (see preprocessing.hrtf_store).
+        hrtf_size (int): High resolution hrtf size.
+        upscale_factor (int): hrtf up scale factor.
+        transform (callable): A function/transform that takes in an HRTF and returns a transformed version.
+        names (list): Names of the HRTFs to use, defaults to every HRTF in the store without nan or inf values.
+        bins (slice): Frequency bins to read, defaults to all of them.
+        use_lr_pyramid (bool): Read the low resolution HRTFs written by preprocessing instead of downsampling, if they exist.
+    """
+
+    def __init__(self, store, hrtf_size: int, upscale_factor: int, transform=None, names=None, bins=None,
+                 use_lr_pyramid=True) -> None:
+        Dataset.__init__(self)
+        self.store = store
+        self.names = store.get_names(valid_only=True) if names is None else names
+        # filenames are reported as the pickles the HRTFs were stored from
+        self.hrtf_file_names = [os.path.join(os.path.dirname(store.store_dir), name) for name in self.names]
+        self.bins = bins
+
+        self.hrtf_size = hrtf_size
+        self.upscale_factor = upscale_factor
+        self.transform = transform
+        self.use_lr_pyramid = use_lr_pyramid
+        # the store holds the HRTFs as they are pickled, see preprocessing.storage
+        self.storage_policy = get_storage_policy(os.path.dirname(store.store_dir))
+
+    def load_hrtf(self, batch_index: int) -> torch.Tensor:
+        return decode_hrtf(self.store.read_tensor(self.names[batch_index], self.bins), self.storage_policy)
+
+    def load_lr_hrtf(self, batch_index: int):
+        lr_hrtf = super(HRTFStoreDataset, self).load_lr_hrtf(batch_index)
+        return lr_hrtf if lr_hrtf is None or self.bins is None else lr_hrtf[..., self.bins]
+
+
+def downsample_hrtf_batch(hr_hrtf, hrtf_size, upscale_factor):
+    """downsample_hrtf for a batch of HRTFs of shape (N, channels, panels, X, Y)"""
+    lr_hrtf = downsample_hrtf(hr_hrtf.flatten(0, 1), hrtf_size, upscale_factor)
+    return lr_hrtf.unflatten(0, hr_hrtf.shape[:2])
+
+
+def get_dataset_hrtfs(dataset):
+    """(hrtf, filename) of every item of a dataset, without its transform and downsampling. Datasets combined with
+    ConcatDataset are read in turn"""
+    for sub_dataset in getattr(dataset, 'datasets', [dataset]):
+        for batch_index in range(len(sub_dataset)):
+            yield sub_dataset.load_hrtf(batch_index), sub_dataset.hrtf_file_names[batch_index]
+
+
+def _get_dataset_attr(dataset, name):
+    # datasets combined with ConcatDataset share the same hrtf_size and upscale_factor
+    return getattr(getattr(dataset, 'datasets', [dataset])[0], name)
+
+
+class ResidentPrefetcher:
+    """Hold a whole (small) dataset on the device, as one tensor of high resolution HRTFs and one of low resolution
+    HRTFs, and serve batches of it by indexing, without a DataLoader or worker processes. Has the same interface as
+    CPUPrefetcher and CUDAPrefetcher. The dataset is read on the first reset, so that it is only held if it is used.
+    Args:
+        dataset (Dataset): Train/Valid dataset.
+        device (torch.device): Device the dataset is held on.
+        batch_size (int): Number of HRTFs per batch.
+        shuffle (bool): Whether to serve the HRTFs in a new random order after every reset.
+        drop_last (bool): Whether to leave out the last batch if it is smaller than batch_size.
+        mean (list): Mean of each channel, used with std to normalize the HRTFs on the device (optional).
+        std (list): Standard deviation of each channel.
+    """
+
+    def __init__(self, dataset, device: torch.device, batch_size: int, shuffle: bool, drop_last: bool,
+                 mean=None, std=None) -> None:
+        self.dataset = dataset
+        self.device = device
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.mean = mean
+        self.std = std
+
+        self.hr = None
+        self.lr = None
+        self.filenames = None
+        self.order = None
+        self.position = 0
+
+    @staticmethod
+    def get_size(dataset) -> int:
+        """Size in bytes of a dataset once it is resident, estimated from its first HRTF"""
+        if len(dataset) == 0:
+            return 0
+        hrtf, _ = next(get_dataset_hrtfs(dataset))
+        return len(dataset) * hrtf.numel() * torch.tensor([], dtype=torch.float).element_size()
+
+    def load(self):
+        hrtfs, filenames = zip(*get_dataset_hrtfs(self.dataset))
+        # (N, channels, panels, X, Y), as returned by the datasets
+        hr = to_channels_first(torch.stack(hrtfs).to(device=self.device, dtype=torch.float))
+        if self.mean is not None and self.std is not None:
+            mean = torch.as_tensor(self.mean, dtype=torch.float, device=self.device).view(1, -1, 1, 1, 1)
+            std = torch.as_tensor(self.std, dtype=torch.float, device=self.device).view(1, -1, 1, 1, 1)
+            hr = (hr - mean) / std
+        assert torch.isfinite(hr).all(), "Transformed tensor contains NaN or Inf"
+
+        self.hr = hr.contiguous()
+        self.lr = downsample_hrtf_batch(self.hr, _get_dataset_attr(self.dataset, 'hrtf_size'),
+                                        _get_dataset_attr(self.dataset, 'upscale_factor')).contiguous()
+        self.filenames = filenames
+
+    def next(self):
+        if self.position + (self.batch_size if self.drop_last else 1) > len(self.order):
+            return None
+        indices = self.order[self.position:self.position + self.batch_size]
+        self.position += self.batch_size
+        return {"lr": self.lr[indices], "hr": self.hr[indices],
+                "filename": [self.filenames[i] for i in indices.tolist()]}
+
+    def reset(self):
+        if self.hr is None:
+            self.load()
+        self.position = 0
+        # the order is kept on the CPU, such that reading the filenames of a batch does not wait for the device
+        self.order = torch.randperm(len(self.hr)) if self.shuffle else torch.arange(len(self.hr))
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+
 class CPUPrefetcher:
     """Use the CPU side to accelerate data reading.
     Args:
@@ -94,6 +246,170 @@ class CPUPrefetcher:
         return len(self.original_dataloader)
 
 
+class NoiseAugmentPrefetcher:
+    """Add coloured noise to the clean HRTFs served by another prefetcher as they are batched, on the device, in place
+    of a pre-built noisy dataset (see preprocessing.noise). round(N * clean_hrtf_ratio / (1 + clean_hrtf_ratio))
+    HRTFs of each batch of N, picked at random, are kept clean, the share of clean HRTFs TrainNoisyHRTFDataset mixes
+    with as many noisy ones. Noise of one of colours is added to each ear of the others at one of snrs_db, drawn per
+    HRTF. The low resolution HRTFs are downsampled from the noisy high resolution ones, as the pyramids of noisy
+    datasets are.
+    The HRTFs must not be normalized, since the noise is scaled to their magnitudes.
+    Args:
+        prefetcher: Prefetcher of clean HRTFs (CPUPrefetcher, CUDAPrefetcher, ThreadPrefetcher or ResidentPrefetcher).
+        device (torch.device): Device the noise is added on.
+        hrtf_size (int): High resolution hrtf size.
+        upscale_factor (int): hrtf up scale factor.
+        nbins (int): Number of frequency bins of each ear.
+        colours (list): Noise colours to draw from, see preprocessing.noise.NOISE_COLOURS.
+        snrs_db (list): Signal-to-noise ratios in dB to draw from.
+        clean_hrtf_ratio (float): Ratio of clean to noisy HRTFs, as for TrainNoisyHRTFDataset.
+        seed (int): Seed of the noise, such that runs are reproducible.
+    """
+
+    def __init__(self, prefetcher, device: torch.device, hrtf_size: int, upscale_factor: int, nbins: int, colours,
+                 snrs_db, clean_hrtf_ratio: float = 1, seed: int = 0) -> None:
+        check_noise_colours(colours)
+        self.prefetcher = prefetcher
+        self.device = device
+        self.hrtf_size = hrtf_size
+        self.upscale_factor = upscale_factor
+        self.nbins = nbins
+        self.exponents = [NOISE_COLOURS[colour] for colour in colours]
+        self.snrs_db = torch.tensor(snrs_db, dtype=torch.float, device=device)
+        self.clean_share = clean_hrtf_ratio / (1 + clean_hrtf_ratio)
+        self.generator = torch.Generator(device=device).manual_seed(seed)
+
+    def augment(self, hr: torch.Tensor) -> torch.Tensor:
+        """Noisy version of a batch of HRTFs (N, channels, panels, X, Y), whose channels are the bins of each ear"""
+        n = len(hr)
+        # (N, ears, panels, X, Y, samples) impulse responses of each ear
+        hrtf = to_channels_last(hr).unflatten(-1, (-1, self.nbins))
+        hrir = torch.fft.irfft(torch.movedim(hrtf, -2, 1), dim=-1)
+
+        colour_indices = torch.randint(len(self.exponents), (n,), generator=self.generator, device=self.device)
+        noise = torch.empty_like(hrir)
+        for i, exponent in enumerate(self.exponents):
+            selected = colour_indices == i
+            noise[selected] = generate_coloured_noise((int(selected.sum()), *hrir.shape[1:]), exponent,
+                                                      self.generator, self.device, hrir.dtype)
+        snrs_db = self.snrs_db[torch.randint(len(self.snrs_db), (n,), generator=self.generator, device=self.device)]
+        noisy = add_noise(hrir, noise, snrs_db.view(-1, 1, 1, 1, 1, 1))
+
+        noisy = to_channels_first(torch.movedim(noisy, 1, -2).flatten(-2)).to(hr.dtype)
+        # the share of clean HRTFs is that of every batch, rather than only on average
+        clean = torch.zeros(n, dtype=torch.bool, device=self.device)
+        clean[torch.randperm(n, generator=self.generator, device=self.device)[:round(n * self.clean_share)]] = True
+        return torch.where(clean.view(-1, 1, 1, 1, 1), hr, noisy)
+
+    def next(self):
+        batch_data = self.prefetcher.next()
+        if batch_data is None:
+            return None
+        # a new batch, the HRTFs of the prefetcher (e.g. those held by a ResidentPrefetcher) are left as they are
+        batch_data = dict(batch_data)
+        batch_data["hr"] = self.augment(batch_data["hr"].to(device=self.device, dtype=torch.float))
+        batch_data["lr"] = downsample_hrtf_batch(batch_data["hr"], self.hrtf_size, self.upscale_factor)
+        return batch_data
+
+    def reset(self):
+        self.prefetcher.reset()
+
+    def __len__(self) -> int:
+        return len(self.prefetcher)
+
+
+class ThreadPrefetcher:
+    """Read batches on a background thread, keeping up to queue_size batches ready, so that loading overlaps with
+    training on any device. Batches are moved to the device on the background thread as well (from pinned memory
+    when the device is a GPU).
+    Counts how often the training thread had to wait for a batch (starved_batches) and for how long in total
+    (starved_seconds), since the last reset. The thread is started on the first reset or next, so that a prefetcher
+    which is never read does not read the dataset.
+    Args:
+        dataloader (DataLoader): Data loader. Combines a dataset and a sampler, and provides an iterable over the given dataset.
+        device (torch.device): Specify running device.
+        queue_size (int): Number of batches to read ahead.
+    """
+
+    _end = object()
+
+    def __init__(self, dataloader, device: torch.device, queue_size: int = 2) -> None:
+        self.original_dataloader = dataloader
+        self.device = device
+        self.queue_size = queue_size
+        self.queue = None
+        self.stop_event = None
+        self.thread = None
+        self.starved_batches = 0
+        self.starved_seconds = 0.
+
+    def _load(self, data, batch_queue, stop_event):
+        try:
+            for batch_data in data:
+                for k, v in batch_data.items():
+                    if torch.is_tensor(v):
+                        if self.device.type == 'cuda':
+                            v = v.pin_memory()
+                        batch_data[k] = v.to(self.device, non_blocking=True)
+                while not stop_event.is_set():
+                    try:
+                        batch_queue.put(batch_data, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop_event.is_set():
+                    return
+        except Exception as e:
+            batch_queue.put(e)
+            return
+        batch_queue.put(self._end)
+
+    def _stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            # make room for a batch the thread may be trying to put
+            while self.thread.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.thread.join()
+
+    def next(self):
+        if self.thread is None:
+            self.reset()
+        try:
+            batch_data = self.queue.get_nowait()
+        except queue.Empty:
+            start = time.perf_counter()
+            batch_data = self.queue.get()
+            self.starved_batches += 1
+            self.starved_seconds += time.perf_counter() - start
+
+        if batch_data is self._end:
+            # keep returning None until the next reset
+            self.queue.put(self._end)
+            return None
+        if isinstance(batch_data, Exception):
+            # the thread has stopped, keep raising until the next reset rather than waiting for a batch
+            self.queue.put(batch_data)
+            raise batch_data
+        return batch_data
+
+    def reset(self):
+        self._stop()
+        self.starved_batches = 0
+        self.starved_seconds = 0.
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._load, args=(iter(self.original_dataloader), self.queue,
+                                                                self.stop_event), daemon=True)
+        self.thread.start()
+
+    def __len__(self) -> int:
+        return len(self.original_dataloader)
+
+
 class CUDAPrefetcher:
     """Use the CUDA side to accelerate data reading.
     Args:
@@ -144,9 +460,11 @@ class TrainNoisyHRTFDataset(Dataset):
         upscale_factor (int): HRTF up scale factor.
         clean_hrtf_ratio (int): ratio determining how many clean HRTFs are included in the training of the GAN
         transform (callable): A function/transform that takes in an HRTF and returns a transformed version.
+        use_lr_pyramid (bool): Read the low resolution HRTFs written by preprocessing instead of downsampling, if they exist.
     """
 
-    def __init__(self, clean_hrtf_dir: str, noisy_hrtf_dir: str, hrtf_size: int, upscale_factor: int, clean_hrtf_ratio: float, transform=None, run_validation=True) -> None:
+    def __init__(self, clean_hrtf_dir: str, noisy_hrtf_dir: str, hrtf_size: int, upscale_factor: int, clean_hrtf_ratio: float, transform=None, run_validation=True,
+                 use_lr_pyramid=True) -> None:
         super(TrainNoisyHRTFDataset, self).__init__()
 
         # Get all noisy HRTF file names
@@ -168,13 +486,8 @@ class TrainNoisyHRTFDataset(Dataset):
         self.hrtf_file_names = noisy_files + clean_files
         
         if run_validation:
-            valid_hrtf_file_names = []
-            for hrtf_file_name in self.hrtf_file_names:
-                file = open(hrtf_file_name, 'rb')
-                hrtf = pickle.load(file)
-                if not np.isnan(np.sum(hrtf.cpu().data.numpy())):
-                    valid_hrtf_file_names.append(hrtf_file_name)
-            self.hrtf_file_names = valid_hrtf_file_names
+            # only files that are new or have changed since the last run are read (see preprocessing.validity)
+            self.hrtf_file_names = filter_valid_hrtf_files(self.hrtf_file_names)
 
 
         # Specify the high-resolution HRTF size, with equal length and width
@@ -183,29 +496,28 @@ class TrainNoisyHRTFDataset(Dataset):
         self.upscale_factor = upscale_factor
         # Transform to be applied to the data
         self.transform = transform
+        # Whether to read low resolution HRTFs written by preprocessing, when they exist
+        self.use_lr_pyramid = use_lr_pyramid
 
 #********************* End of Added Code to Process The Noisy Files************************************************************************
-    
+
+    def load_hrtf(self, batch_index: int) -> torch.Tensor:
+        return load_hrtf_file(self.hrtf_file_names[batch_index])
+
     def __getitem__(self, batch_index: int) -> [torch.Tensor, torch.Tensor]:
         # Read a batch of hrtf data
-        with open(self.hrtf_file_names[batch_index], "rb") as file:
-            hrtf = pickle.load(file)
-
-        # hrtf processing operations
-        if self.transform is not None:
-            # If using a transform, treat panels as batch dim such that dims are (panels, channels, X, Y)
-            hr_hrtf = torch.permute(hrtf, (0, 3, 1, 2))
-            # Then, transform hr_hrtf to normalize and swap panel/channel dims to get channels first
-            hr_hrtf = torch.permute(self.transform(hr_hrtf), (1, 0, 2, 3))
-        else:
-            # If no transform, go directly to (channels, panels, X, Y)
-            hr_hrtf = torch.permute(hrtf, (3, 0, 1, 2))
+        hrtf = self.load_hrtf(batch_index)
+        hr_hrtf = transform_hrtf(hrtf, self.transform)
 
             # Ensure the transformed data is valid
         assert torch.isfinite(hr_hrtf).all(), "Transformed tensor contains NaN or Inf"
 
-        # downsample hrtf
-        lr_hrtf = downsample_hrtf(hr_hrtf, self.hrtf_size, self.upscale_factor)
+        # downsample hrtf, unless it was already downsampled in preprocessing
+        lr_hrtf = read_lr_hrtf(self.hrtf_file_names[batch_index], self.upscale_factor) if self.use_lr_pyramid else None
+        if lr_hrtf is not None:
+            lr_hrtf = transform_hrtf(lr_hrtf, self.transform)
+        else:
+            lr_hrtf = downsample_hrtf(hr_hrtf, self.hrtf_size, self.upscale_factor)
 
         assert torch.isfinite(lr_hrtf).all(), "Downsampled tensor contains NaN or Inf"
 
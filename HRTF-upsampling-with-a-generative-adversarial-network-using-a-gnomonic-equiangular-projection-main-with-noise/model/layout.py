@@ -0,0 +1,56 @@
+import torch
+
+# HRTFs on the cubed sphere are held in one canonical layout, channels first: (channels, panels, X, Y), or
+# (N, channels, panels, X, Y) for a batch, contiguous, as the models take them. HRTFs are stored channels last:
+# (panels, X, Y, channels). Either order is a view of the other, so converting between them never copies; only making
+# a channels last view contiguous does.
+
+
+def to_channels_first(hrtf: torch.Tensor) -> torch.Tensor:
+    """View of an HRTF (panels, X, Y, channels), or a batch of them, as (channels, panels, X, Y)"""
+    return torch.movedim(hrtf, -1, -4)
+
+
+def to_channels_last(hrtf: torch.Tensor) -> torch.Tensor:
+    """View of an HRTF (channels, panels, X, Y), or a batch of them, as (panels, X, Y, channels)"""
+    return torch.movedim(hrtf, -4, -1)
+
+
+class CubeHRTF(object):
+    """An HRTF, or a batch of HRTFs, on the cubed sphere in the canonical channels first layout, with views of it in
+    the channels last layout it is stored in. Nothing is copied, except by from_stored when asked to make the HRTF
+    contiguous.
+    Args:
+        data (Tensor): HRTF of shape (channels, panels, X, Y) or (N, channels, panels, X, Y).
+    """
+
+    def __init__(self, data: torch.Tensor) -> None:
+        self.data = data
+
+    @classmethod
+    def from_stored(cls, hrtf: torch.Tensor, contiguous: bool = False):
+        """From an HRTF as it is stored, (panels, X, Y, channels) or (N, panels, X, Y, channels). If contiguous, it is
+        copied once into the canonical layout"""
+        data = to_channels_first(torch.as_tensor(hrtf))
+        return cls(data.contiguous() if contiguous else data)
+
+    @property
+    def channels_first(self) -> torch.Tensor:
+        return self.data
+
+    @property
+    def channels_last(self) -> torch.Tensor:
+        return to_channels_last(self.data)
+
+    @property
+    def is_batch(self) -> bool:
+        return self.data.dim() == 5
+
+    def as_batch(self):
+        """View of a single HRTF as a batch of one"""
+        return self if self.is_batch else CubeHRTF(self.data.unsqueeze(0))
+
+    def ear(self, side: str, nbins: int):
+        """View of the channels of one ear of a merged HRTF, whose left ear is its first nbins channels"""
+        channels = slice(0, nbins) if side == 'left' else slice(nbins, None)
+        return CubeHRTF(self.data[..., channels, :, :, :])
@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 import numpy as np
-from model.custom_conv import CubeSpherePadding2D, CubeSphereConv2D
+from model.custom_conv import CubeSpherePadding2D, CubeSphereConv2D, CubePixelShuffle
 
 # based on https://github.com/Lornatang/SRGAN-PyTorch/blob/main/model.py
 
@@ -40,15 +40,15 @@ class UpsampleBlock(nn.Module):
             CubeSphereConv2D(channels, channels * 4, (3, 3), (1, 1))
         )
         self.upsample_block_2 = nn.Sequential(
-            nn.PixelShuffle(2),
+            CubePixelShuffle(2),
             nn.PReLU(),
         )
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         out1 = self.upsample_block_1(x)
-        out = self.upsample_block_2(torch.permute(out1, dims=(0, 2, 1, 3, 4)))
+        out = self.upsample_block_2(out1)
 
-        return torch.permute(out, dims=(0, 2, 1, 3, 4))
+        return out
 
 
 class Discriminator(nn.Module):
@@ -0,0 +1,88 @@
+import numpy as np
+import torch
+
+from model.model import Generator
+
+
+def get_onnx_filename(config):
+    return f'{config.model_path}/Gen.onnx'
+
+
+def load_generator(config, device=torch.device('cpu')):
+    """Generator with the trained weights of config.model_path/Gen.pt, in eval mode"""
+    nbins = config.nbins_hrtf * 2 if config.merge_flag else config.nbins_hrtf
+    model = Generator(upscale_factor=config.upscale_factor, nbins=nbins).to(device=device)
+    model.load_state_dict(torch.load(f"{config.model_path}/Gen.pt", map_location=torch.device('cpu')))
+    return model.eval()
+
+
+def export_generator_onnx(config, filename=None):
+    """Export the trained generator to ONNX, taking a batch of low resolution HRTFs 'lr' of any batch size and returning
+    the upsampled HRTFs 'sr'. The model is captured by torch.export, so the cube sphere padding is expressed as the
+    slicing and concatenation of panels and the cube sphere convolution as Conv ops (see CubeSpherePadding2D).
+    Returns the PyTorch model that was exported"""
+    filename = get_onnx_filename(config) if filename is None else filename
+    model = load_generator(config)
+    nbins = config.nbins_hrtf * 2 if config.merge_flag else config.nbins_hrtf
+    lr_size = config.hrtf_size // config.upscale_factor
+    # a batch of more than one, such that the batch size is not specialised to 1
+    example = torch.rand((2, nbins, 5, lr_size, lr_size))
+    torch.onnx.export(model, (example, ), filename, input_names=['lr'], output_names=['sr'],
+                      opset_version=config.onnx_opset, dynamic_shapes={'x': {0: torch.export.Dim('batch')}},
+                      dynamo=True)
+    print(f'Exported generator to {filename}')
+    return model
+
+
+class OnnxGenerator(object):
+    """Generator exported by export_generator_onnx, run by ONNX Runtime on the CPU. Called like the Generator, with a
+    batch of low resolution HRTFs (N, nbins, 5, X, Y) as a tensor or array, and returns the upsampled batch as a tensor
+    on the CPU. Only needs onnxruntime, which is imported when the first OnnxGenerator is created.
+    Args:
+        filename (str): ONNX file written by export_generator_onnx
+        num_threads (int, optional): Threads ONNX Runtime runs each operator on, by default all cores
+    """
+
+    def __init__(self, filename, num_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.filename = filename
+        self.session = onnxruntime.InferenceSession(filename, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, lr):
+        if torch.is_tensor(lr):
+            lr = lr.detach().cpu().numpy()
+        sr = self.session.run(None, {self.input_name: np.ascontiguousarray(lr, dtype=np.float32)})[0]
+        return torch.from_numpy(sr)
+
+
+def check_onnx_parity(config, model, onnx_generator, batch_sizes=(1, 3)):
+    """Compare the outputs of the exported generator with those of the PyTorch model on random low resolution HRTFs of
+    several batch sizes. Raises a ValueError if the largest difference, relative to the largest output, is above
+    config.onnx_parity_tolerance. Returns the largest relative difference"""
+    nbins = config.nbins_hrtf * 2 if config.merge_flag else config.nbins_hrtf
+    lr_size = config.hrtf_size // config.upscale_factor
+    device = next(model.parameters()).device
+
+    max_relative_error = 0.
+    for batch_size in batch_sizes:
+        lr = torch.rand((batch_size, nbins, 5, lr_size, lr_size))
+        with torch.no_grad():
+            sr = model(lr.to(device)).cpu()
+        onnx_sr = onnx_generator(lr)
+        if onnx_sr.shape != sr.shape:
+            raise ValueError(f'ONNX generator output has shape {tuple(onnx_sr.shape)} for a batch of {batch_size}, '
+                             f'expected {tuple(sr.shape)}')
+        relative_error = float(torch.max(torch.abs(onnx_sr - sr)) / torch.max(torch.abs(sr)).clamp_min(1e-12))
+        max_relative_error = max(max_relative_error, relative_error)
+
+    print('ONNX parity: max difference relative to the largest output %0.2e' % max_relative_error)
+    if max_relative_error > config.onnx_parity_tolerance:
+        raise ValueError(f'Outputs of {onnx_generator.filename} differ from the PyTorch generator by '
+                         f'{max_relative_error:.2e}, more than the tolerance of {config.onnx_parity_tolerance:.0e}')
+    return max_relative_error
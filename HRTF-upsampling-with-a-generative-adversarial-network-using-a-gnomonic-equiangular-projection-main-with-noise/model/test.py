@@ -4,7 +4,9 @@ import pickle
 import scipy
 import torch
 
-from model.model import Generator
+from model.layout import to_channels_last
+from model.onnx_backend import OnnxGenerator, get_onnx_filename, load_generator
+from model.util import compile_model
 import shutil
 from pathlib import Path
 
@@ -15,40 +17,20 @@ def test(config, val_prefetcher):
     ngpu = config.ngpu
     valid_dir = config.valid_path
 
-    nbins = config.nbins_hrtf
-    if config.merge_flag:
-        nbins = config.nbins_hrtf * 2
-
     device = torch.device(config.device_name if (
             torch.cuda.is_available() and ngpu > 0) else "cpu")
-    model = Generator(upscale_factor=config.upscale_factor, nbins=nbins).to(device=device)
-    print("Build SRGAN model successfully.")
-
-    # Load super-resolution model weights (always uses the CPU due to HPC having long wait times)
-    model.load_state_dict(torch.load(f"{config.model_path}/Gen.pt", map_location=torch.device('cpu')))
-    print(f"Load SRGAN model weights `{os.path.abspath(config.model_path)}` successfully.")
-
-    param_size = 0
-    for param in model.parameters():
-        param_size += param.nelement() * param.element_size()
-    buffer_size = 0
-    for buffer in model.buffers():
-        buffer_size += buffer.nelement() * buffer.element_size()
-
-    size_param_mb = param_size / 1024 ** 2
-    size_buffer_mb = buffer_size / 1024 ** 2
-    size_all_mb = (param_size + buffer_size) / 1024 ** 2
-    print('param size: {:.3f}MB'.format(size_param_mb))
-    print('buffer size: {:.3f}MB'.format(size_buffer_mb))
-    print('model size: {:.3f}MB'.format(size_all_mb))
+    if config.inference_backend == 'onnx':
+        # the generator exported in export_onnx mode, run by ONNX Runtime on the CPU
+        device = torch.device('cpu')
+        model = OnnxGenerator(get_onnx_filename(config))
+        print(f"Load ONNX SRGAN model `{os.path.abspath(model.filename)}` successfully.")
+    else:
+        model = load_torch_generator(config, device)
 
     # get list of positive frequencies of HRTF for plotting magnitude spectrum
     all_freqs = scipy.fft.fftfreq(256, 1 / config.hrir_samplerate)
     pos_freqs = all_freqs[all_freqs >= 0]
 
-    # Start the verification mode of the model.
-    model.eval()
-
     # Initialize the data loader and load the first batch of data
     val_prefetcher.reset()
     batch_data = val_prefetcher.next()
@@ -66,9 +48,35 @@ def test(config, val_prefetcher):
         with torch.no_grad():
             sr = model(lr)
 
-        file_name = '/' + os.path.basename(batch_data["filename"][0])
-        with open(valid_dir + file_name, "wb") as file:
-            pickle.dump(torch.permute(sr[0], (1, 2, 3, 0)).detach().cpu(), file)
+        for i in range(len(sr)):
+            file_name = '/' + os.path.basename(batch_data["filename"][i])
+            with open(valid_dir + file_name, "wb") as file:
+                pickle.dump(to_channels_last(sr[i]).detach().cpu(), file)
 
         # Preload the next batch of data
         batch_data = val_prefetcher.next()
+
+
+def load_torch_generator(config, device):
+    """The trained generator, run by PyTorch in test mode"""
+    # Load super-resolution model weights (always uses the CPU due to HPC having long wait times)
+    model = load_generator(config).to(device=device)
+    print(f"Load SRGAN model weights `{os.path.abspath(config.model_path)}` successfully.")
+
+    param_size = 0
+    for param in model.parameters():
+        param_size += param.nelement() * param.element_size()
+    buffer_size = 0
+    for buffer in model.buffers():
+        buffer_size += buffer.nelement() * buffer.element_size()
+
+    size_param_mb = param_size / 1024 ** 2
+    size_buffer_mb = buffer_size / 1024 ** 2
+    size_all_mb = (param_size + buffer_size) / 1024 ** 2
+    print('param size: {:.3f}MB'.format(size_param_mb))
+    print('buffer size: {:.3f}MB'.format(size_buffer_mb))
+    print('model size: {:.3f}MB'.format(size_all_mb))
+
+    # Start the verification mode of the model.
+    model.eval()
+    return compile_model(config, model)
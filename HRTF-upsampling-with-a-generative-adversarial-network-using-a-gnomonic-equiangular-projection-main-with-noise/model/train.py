@@ -3,6 +3,7 @@ import pickle
 import scipy
 
 from model.util import *
+from model.layout import to_channels_last
 from model.model import *
 
 import torch.backends.cudnn as cudnn
@@ -48,6 +49,8 @@ def train(config, train_prefetcher):
     # Define Generator network and transfer to CUDA
     netG = Generator(upscale_factor=config.upscale_factor, nbins=nbins).to(device)
     netD = Discriminator(nbins=nbins).to(device)
+    compile_model(config, netG)
+    compile_model(config, netD)
     if ('cuda' in str(device)) and (ngpu > 1):
         netD = (nn.DataParallel(netD, list(range(ngpu)))).to(device)
         netG = nn.DataParallel(netG, list(range(ngpu))).to(device)
@@ -55,6 +58,10 @@ def train(config, train_prefetcher):
     # Define optimizers
     optD = optim.Adam(netD.parameters(), lr=lr_dis, betas=(beta1, beta2))
     optG = optim.Adam(netG.parameters(), lr=lr_gen, betas=(beta1, beta2))
+    scalerD = get_grad_scaler(config, device)
+    scalerG = get_grad_scaler(config, device)
+    if config.mixed_precision:
+        print(f'Training with mixed precision ({"float16" if device.type == "cuda" else "bfloat16"})')
 
     # Define loss functions
     adversarial_criterion = nn.BCEWithLogitsLoss()
@@ -90,6 +97,11 @@ def train(config, train_prefetcher):
         train_loss_D = 0.
         train_loss_D_hr = 0.
         train_loss_D_sr = 0.
+        # steps skipped as their float16 forward pass overflowed, see forward_is_finite
+        skipped_steps_D = 0
+        skipped_steps_G = 0
+        consecutive_overflows = 0
+        float32_batches = 0
 
         # Initialize the number of data batches to print logs on the terminal
         batch_index = 0
@@ -119,63 +131,99 @@ def train(config, train_prefetcher):
             if epoch % 25 == 0 or epoch == (num_epochs - 1):
                 filename = batch_data["filename"]
 
+            # with float16, a forward pass that overflows skips the step, as scaling the gradients cannot prevent it.
+            # After max_consecutive_overflows skipped batches in a row the remaining batches run in float32
+            use_float32 = consecutive_overflows >= config.max_consecutive_overflows
+            skip_overflow = scalerD.is_enabled() and not use_float32
+            float32_batches += int(use_float32)
+
             # Discriminator Training
             # Initialize the discriminator model gradients
             netD.zero_grad()
 
             # Use the generator model to generate fake samples
-            sr = netG(lr)
-            assert torch.isfinite(sr).all(), "Generated tensor 'sr' contains NaN or Inf"
-
-            # Calculate the classification score of the discriminator model for real samples
-            label = torch.full((batch_size, ), 1., dtype=hr.dtype, device=device)
-            output = netD(hr).view(-1)
-            loss_D_hr = adversarial_criterion(output, label)
-            assert torch.isfinite(loss_D_hr).all(), "loss_D_hr contains NaN or Inf"
-            loss_D_hr.backward()
-
-            # train on SR hrtfs
-            label.fill_(0.)
-            output = netD(sr.detach().clone()).view(-1)
-            loss_D_sr = adversarial_criterion(output, label)
-            assert torch.isfinite(loss_D_sr).all(), "loss_D_sr contains NaN or Inf"
-            loss_D_sr.backward()
-
-            # Compute the discriminator loss
-            loss_D = loss_D_hr + loss_D_sr
-            assert torch.isfinite(loss_D).all(), "loss_D contains NaN or Inf"
-            train_loss_D += loss_D.item()
-            train_loss_D_hr += loss_D_hr.item()
-            train_loss_D_sr += loss_D_sr.item()
-
-            # Update D
-            optD.step()
+            with get_autocast(config, device, enabled=not use_float32):
+                sr = netG(lr)
+            step_D = forward_is_finite(sr, "Generated tensor 'sr'", skip_overflow)
+
+            if step_D:
+                # Calculate the classification score of the discriminator model for real samples
+                label = torch.full((batch_size, ), 1., dtype=hr.dtype, device=device)
+                with get_autocast(config, device, enabled=not use_float32):
+                    output = netD(hr).view(-1)
+                step_D = forward_is_finite(output, "Discriminator output of 'hr'", skip_overflow)
+
+            if step_D:
+                # losses are computed in float32, also when the models run with mixed precision
+                loss_D_hr = adversarial_criterion(output.float(), label)
+                assert torch.isfinite(loss_D_hr).all(), "loss_D_hr contains NaN or Inf"
+                scalerD.scale(loss_D_hr).backward()
+
+                # train on SR hrtfs
+                label.fill_(0.)
+                with get_autocast(config, device, enabled=not use_float32):
+                    output = netD(sr.detach().clone()).view(-1)
+                step_D = forward_is_finite(output, "Discriminator output of 'sr'", skip_overflow)
+
+            if step_D:
+                loss_D_sr = adversarial_criterion(output.float(), label)
+                assert torch.isfinite(loss_D_sr).all(), "loss_D_sr contains NaN or Inf"
+                scalerD.scale(loss_D_sr).backward()
+
+                # Compute the discriminator loss
+                loss_D = loss_D_hr + loss_D_sr
+                assert torch.isfinite(loss_D).all(), "loss_D contains NaN or Inf"
+                train_loss_D += loss_D.item()
+                train_loss_D_hr += loss_D_hr.item()
+                train_loss_D_sr += loss_D_sr.item()
+
+                # Update D
+                scalerD.step(optD)
+                scalerD.update()
+
+            skipped_steps_D += int(not step_D)
+            overflowed = not step_D
 
             # Generator training
-            if batch_index % int(critic_iters) == 0:
+            if step_D and batch_index % int(critic_iters) == 0:
                 # Initialize generator model gradients
                 netG.zero_grad()
-                sr = netG(lr)
                 label.fill_(1.)
-                # Calculate adversarial loss
-                output = netD(sr).view(-1)
-                
-                unweighted_content_loss_G = content_criterion(config, sr, hr, sd_mean, sd_std, ild_mean, ild_std)
-                assert torch.isfinite(unweighted_content_loss_G).all(), "unweighted_content_loss_G contains NaN or Inf"
-                content_loss_G = config.content_weight * unweighted_content_loss_G
-                adversarial_loss_G = config.adversarial_weight * adversarial_criterion(output, label)
-
-                # Calculate the generator total loss value and backprop
-                loss_G = content_loss_G + adversarial_loss_G
-                assert torch.isfinite(loss_G).all(), "loss_G contains NaN or Inf"
-                loss_G.backward()
-
-                train_loss_G += loss_G.item()
-                train_loss_G_adversarial += adversarial_loss_G.item()
-                train_loss_G_content += content_loss_G.item()
-                train_SD_metric.append(unweighted_content_loss_G.item())
-
-                optG.step()
+                with get_autocast(config, device, enabled=not use_float32):
+                    sr = netG(lr)
+                    # Calculate adversarial loss
+                    output = netD(sr).view(-1)
+
+                overflowed = not (forward_is_finite(sr, "Generated tensor 'sr'", skip_overflow)
+                                  and forward_is_finite(output, "Discriminator output of 'sr'", skip_overflow))
+                skipped_steps_G += int(overflowed)
+                if not overflowed:
+                    # the log10 ratios of the content loss need float32
+                    sr = sr.float()
+
+                    unweighted_content_loss_G = content_criterion(config, sr, hr, sd_mean, sd_std, ild_mean, ild_std)
+                    assert torch.isfinite(unweighted_content_loss_G).all(), \
+                        "unweighted_content_loss_G contains NaN or Inf"
+                    content_loss_G = config.content_weight * unweighted_content_loss_G
+                    adversarial_loss_G = config.adversarial_weight * adversarial_criterion(output.float(), label)
+
+                    # Calculate the generator total loss value and backprop
+                    loss_G = content_loss_G + adversarial_loss_G
+                    assert torch.isfinite(loss_G).all(), "loss_G contains NaN or Inf"
+                    scalerG.scale(loss_G).backward()
+
+                    train_loss_G += loss_G.item()
+                    train_loss_G_adversarial += adversarial_loss_G.item()
+                    train_loss_G_content += content_loss_G.item()
+                    train_SD_metric.append(unweighted_content_loss_G.item())
+
+                    scalerG.step(optG)
+                    scalerG.update()
+
+            if overflowed:
+                consecutive_overflows += 1
+            elif not use_float32:
+                consecutive_overflows = 0
 
             if ('cuda' in str(device)) and (ngpu > 1):
                 end_overall.record()
@@ -201,21 +249,32 @@ def train(config, train_prefetcher):
             # terminal print data normally
             batch_index += 1
 
-        train_losses_D.append(train_loss_D / len(train_prefetcher))
-        train_losses_D_hr.append(train_loss_D_hr / len(train_prefetcher))
-        train_losses_D_sr.append(train_loss_D_sr / len(train_prefetcher))
-        train_losses_G.append(train_loss_G / len(train_prefetcher))
-        train_losses_G_adversarial.append(train_loss_G_adversarial / len(train_prefetcher))
-        train_losses_G_content.append(train_loss_G_content / len(train_prefetcher))
+        # the averages are over the steps that were taken
+        steps_D = max(len(train_prefetcher) - skipped_steps_D, 1)
+        steps_G = max(len(train_prefetcher) - skipped_steps_D - skipped_steps_G, 1)
+        train_losses_D.append(train_loss_D / steps_D)
+        train_losses_D_hr.append(train_loss_D_hr / steps_D)
+        train_losses_D_sr.append(train_loss_D_sr / steps_D)
+        train_losses_G.append(train_loss_G / steps_G)
+        train_losses_G_adversarial.append(train_loss_G_adversarial / steps_G)
+        train_losses_G_content.append(train_loss_G_content / steps_G)
         print(f"Average epoch loss, discriminator: {train_losses_D[-1]}, generator: {train_losses_G[-1]}")
         print(f"Average epoch loss, D_real: {train_losses_D_hr[-1]}, D_fake: {train_losses_D_sr[-1]}")
         print(f"Average epoch loss, G_adv: {train_losses_G_adversarial[-1]}, train_losses_G_content: {train_losses_G_content[-1]}")
+        if scalerD.is_enabled():
+            print(f"Skipped {skipped_steps_D} discriminator and {skipped_steps_G} generator steps whose float16 forward "
+                  f"pass overflowed, ran {float32_batches} of {batches} batches in float32")
+        # noise augmentation wraps the prefetcher reading the batches
+        data_prefetcher = getattr(train_prefetcher, 'prefetcher', train_prefetcher)
+        if isinstance(data_prefetcher, ThreadPrefetcher):
+            print(f"Waited for data on {data_prefetcher.starved_batches} of {batches} batches "
+                  f"({data_prefetcher.starved_seconds:.2f}s)")
 
         # create magnitude spectrum plot every 25 epochs and last epoch
         if epoch % 25 == 0 or epoch == (num_epochs - 1):
             i_plot = 0
-            magnitudes_real = torch.permute(hr.detach().cpu()[i_plot], (1, 2, 3, 0))
-            magnitudes_interpolated = torch.permute(sr.detach().cpu()[i_plot], (1, 2, 3, 0))
+            magnitudes_real = to_channels_last(hr.detach().cpu()[i_plot])
+            magnitudes_interpolated = to_channels_last(sr.detach().float().cpu()[i_plot])
 
             plot_label = filename[i_plot].split('/')[-1] + '_epoch' + str(epoch)
             plot_magnitude_spectrums(pos_freqs, magnitudes_real[:, :, :, :config.nbins_hrtf], magnitudes_interpolated[:, :, :, :config.nbins_hrtf],
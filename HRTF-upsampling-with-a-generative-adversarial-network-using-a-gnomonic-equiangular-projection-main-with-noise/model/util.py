@@ -3,10 +3,13 @@ import os
 import shutil
 from pathlib import Path
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, ConcatDataset
 from torchvision.transforms import transforms
 
-from model.dataset import CUDAPrefetcher, TrainValidHRTFDataset, TrainNoisyHRTFDataset, CPUPrefetcher
+from model.layout import to_channels_first
+from model.dataset import CUDAPrefetcher, TrainValidHRTFDataset, TrainNoisyHRTFDataset, CPUPrefetcher, \
+    HRTFStoreDataset, ResidentPrefetcher, ThreadPrefetcher, NoiseAugmentPrefetcher
+from preprocessing.hrtf_store import sync_store
 
 
 def initialise_folders(config, overwrite):
@@ -20,8 +23,37 @@ def initialise_folders(config, overwrite):
         Path(config.path).mkdir(parents=True, exist_ok=True)
 
 
-def load_dataset(config, noise_included=False, clean_hrtf_ratio=1, mean=None, std=None) -> [CUDAPrefetcher, CUDAPrefetcher, CUDAPrefetcher]:
-    """Based on https://github.com/Lornatang/SRGAN-PyTorch/blob/main/train_srgan.py"""
+def load_store_datasets(config, noise_included, clean_hrtf_ratio, transform):
+    """Same datasets as load_dataset, read from the HRTF store of each directory (see preprocessing.hrtf_store), which
+    is first brought up to date with the pickles in the directory"""
+    train_hrtf_dir = config.train_hrtf_merge_dir if config.merge_flag else config.train_hrtf_dir
+    valid_hrtf_dir = config.valid_hrtf_merge_dir if config.merge_flag else config.valid_hrtf_dir
+    if noise_included:
+        valid_hrtf_dir = config.valid_noisy_hrtf_merge_dir
+
+    train_store = sync_store(train_hrtf_dir)
+    train_datasets = HRTFStoreDataset(train_store, config.hrtf_size, config.upscale_factor, transform)
+    if noise_included:
+        # noisy HRTFs, along with a share of the clean HRTFs given by clean_hrtf_ratio (see TrainNoisyHRTFDataset)
+        noisy_store = sync_store(config.train_noisy_hrtf_merge_dir)
+        clean_names = train_store.get_names(valid_only=True)
+        if clean_hrtf_ratio < 1.0:
+            clean_names = clean_names[:int(len(clean_names) * clean_hrtf_ratio)]
+        train_datasets = ConcatDataset([
+            HRTFStoreDataset(noisy_store, config.hrtf_size, config.upscale_factor, transform),
+            HRTFStoreDataset(train_store, config.hrtf_size, config.upscale_factor, transform, names=clean_names)])
+
+    valid_datasets = HRTFStoreDataset(sync_store(valid_hrtf_dir), config.hrtf_size, config.upscale_factor, transform)
+    return train_datasets, valid_datasets
+
+
+def load_dataset(config, noise_included=False, clean_hrtf_ratio=1, mean=None, std=None, augment_noise=False) -> [CUDAPrefetcher, CUDAPrefetcher, CUDAPrefetcher]:
+    """Based on https://github.com/Lornatang/SRGAN-PyTorch/blob/main/train_srgan.py
+
+    If augment_noise, the clean train HRTFs are read and noise drawn from config.noise_colours and config.noise_snrs_db
+    is added to them as they are batched (see NoiseAugmentPrefetcher), with clean_hrtf_ratio as for noisy datasets"""
+    if augment_noise and (noise_included or mean is not None or std is not None):
+        raise ValueError('Noise augmentation adds noise to the clean HRTFs before they are normalized')
 
     # define transforms
     if mean is None or std is None:
@@ -32,7 +64,9 @@ def load_dataset(config, noise_included=False, clean_hrtf_ratio=1, mean=None, st
 #*********************Added Code to Differentiate Between The Processing of Noisy Files and Clean Files Only************************************************************************
 
     # Load train, test and valid datasets
-    if noise_included == False:
+    if config.use_hrtf_store:
+        train_datasets, valid_datasets = load_store_datasets(config, noise_included, clean_hrtf_ratio, transform)
+    elif noise_included == False:
         if config.merge_flag:
             train_datasets = TrainValidHRTFDataset(config.train_hrtf_merge_dir, config.hrtf_size, config.upscale_factor, transform)
             valid_datasets = TrainValidHRTFDataset(config.valid_hrtf_merge_dir, config.hrtf_size, config.upscale_factor, transform)
@@ -49,6 +83,24 @@ def load_dataset(config, noise_included=False, clean_hrtf_ratio=1, mean=None, st
 
 #*********************End of Added Code to Differentiate Between The Processing of Noisy Files and Clean Files Only************************************************************************
 
+    if torch.cuda.is_available() and config.ngpu > 0:
+        device = torch.device(config.device_name)
+    else:
+        device = torch.device('cpu')
+
+    if config.use_resident_dataset:
+        size_mb = (ResidentPrefetcher.get_size(train_datasets) + ResidentPrefetcher.get_size(valid_datasets)) / 1024 ** 2
+        if size_mb <= config.resident_dataset_max_mb:
+            print(f'Holding datasets ({size_mb:.1f}MB) on {device}')
+            train_prefetcher = ResidentPrefetcher(train_datasets, device, config.batch_size, shuffle=True,
+                                                  drop_last=True, mean=mean, std=std)
+            valid_prefetcher = ResidentPrefetcher(valid_datasets, device, 1, shuffle=False, drop_last=False,
+                                                  mean=mean, std=std)
+            if augment_noise:
+                train_prefetcher = get_noise_augment_prefetcher(config, train_prefetcher, device, clean_hrtf_ratio)
+            return train_prefetcher, valid_prefetcher
+        print(f'Datasets ({size_mb:.1f}MB) are larger than resident_dataset_max_mb, using data loaders')
+
     # Generator all dataloader
     train_dataloader = DataLoader(train_datasets,
                                   batch_size=config.batch_size,
@@ -66,17 +118,58 @@ def load_dataset(config, noise_included=False, clean_hrtf_ratio=1, mean=None, st
                                   persistent_workers=True)
 
     # Place all data on the preprocessing data loader
-    if torch.cuda.is_available() and config.ngpu > 0:
-        device = torch.device(config.device_name)
+    if device.type == 'cuda':
         train_prefetcher = CUDAPrefetcher(train_dataloader, device)
         valid_prefetcher = CUDAPrefetcher(valid_dataloader, device)
+    elif config.prefetch_queue_size > 0:
+        train_prefetcher = ThreadPrefetcher(train_dataloader, device, config.prefetch_queue_size)
+        valid_prefetcher = ThreadPrefetcher(valid_dataloader, device, config.prefetch_queue_size)
     else:
         train_prefetcher = CPUPrefetcher(train_dataloader)
         valid_prefetcher = CPUPrefetcher(valid_dataloader)
 
+    if augment_noise:
+        train_prefetcher = get_noise_augment_prefetcher(config, train_prefetcher, device, clean_hrtf_ratio)
     return train_prefetcher, valid_prefetcher
 
 
+def get_noise_augment_prefetcher(config, prefetcher, device, clean_hrtf_ratio):
+    return NoiseAugmentPrefetcher(prefetcher, device, config.hrtf_size, config.upscale_factor, config.nbins_hrtf,
+                                  config.noise_colours, config.noise_snrs_db, clean_hrtf_ratio, config.noise_seed)
+
+
+def compile_model(config, model):
+    """Compile model in place with torch.compile when config.compile_model is set, such that its state_dict is the same
+    as that of the eager model. Any graph break raises an error rather than silently splitting the graph"""
+    if config.compile_model:
+        model.compile(fullgraph=True, mode=config.compile_mode)
+    return model
+
+
+def get_autocast(config, device, enabled=True):
+    """Autocast context the models are trained in when config.mixed_precision is set (and enabled): float16 on CUDA
+    and bfloat16 (which has the range of float32, so needs no gradient scaling) on the CPU"""
+    dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return torch.autocast(device.type, dtype=dtype, enabled=config.mixed_precision and enabled)
+
+
+def get_grad_scaler(config, device):
+    """GradScaler for the losses of one optimizer, which only scales them when training with float16 on CUDA and
+    otherwise steps the optimizer as it is. Steps whose gradients overflowed are skipped and the scale is lowered"""
+    return torch.amp.GradScaler(device.type, enabled=config.mixed_precision and device.type == 'cuda')
+
+
+def forward_is_finite(tensor, name, skip_overflow):
+    """Whether the output of a forward pass contains no NaN or Inf. When skip_overflow is set (training with float16),
+    an overflow is logged and False is returned, such that the step is skipped as GradScaler does when the gradients
+    overflow. Otherwise a NaN or Inf stops training"""
+    if torch.isfinite(tensor).all():
+        return True
+    assert skip_overflow, f"{name} contains NaN or Inf"
+    print(f"{name} overflowed in float16, skipping the step")
+    return False
+
+
 def progress(i, batches, n, num_epochs, timed):
     """Prints progress to console
 
@@ -143,11 +236,8 @@ def spectral_distortion_metric_for_plot(generated, target):
     Where P is the number of panels (usually 5), H is height, W is width, and C is the number of frequency bins.
 
     Wrapper for spectral_distortion_metric, used for plot_magnitude_spectrums"""
-    generated = torch.permute(generated, (3, 0, 1, 2))
-    target = torch.permute(target, (3, 0, 1, 2))
-
-    generated = torch.unsqueeze(generated, 0)
-    target = torch.unsqueeze(target, 0)
+    generated = to_channels_first(generated)[None]
+    target = to_channels_first(target)[None]
 
     return spectral_distortion_metric(generated, target).item()
 
@@ -195,11 +285,8 @@ def ILD_metric_for_plot(config, generated, target):
     Where P is the number of panels (usually 5), H is height, W is width, and C is the number of frequency bins.
 
     Wrapper for ILD_metric"""
-    generated = torch.permute(generated, (3, 0, 1, 2))
-    target = torch.permute(target, (3, 0, 1, 2))
-
-    generated = torch.unsqueeze(generated, 0)
-    target = torch.unsqueeze(target, 0)
+    generated = to_channels_first(generated)[None]
+    target = to_channels_first(target)[None]
 
     return ILD_metric(config, generated, target).item()
 
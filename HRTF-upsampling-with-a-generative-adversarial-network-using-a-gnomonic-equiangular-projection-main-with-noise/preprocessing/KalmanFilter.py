@@ -59,3 +59,19 @@ class KalmanFilter:
 
     def get_post_fit_residual(self):
         return self.k.dot(self.y).item(0)
+
+
+def calc_kalman_gains(num_steps, Q, R, P=0.):
+    """Optimal kalman gains of a scalar filter where the state transition and observation models are both 1
+
+    With constant Q and R the gain (and covariance) recursion does not depend on the observations, so it only needs to
+    be computed once for any number of signals. Steps are the same as KalmanFilter.prediction and KalmanFilter.update
+    """
+    gains = np.empty(num_steps)
+    for i in range(num_steps):
+        P = P + Q
+        S = P + R
+        k = P * (1. / S)
+        P = P - k * P
+        gains[i] = k
+    return gains
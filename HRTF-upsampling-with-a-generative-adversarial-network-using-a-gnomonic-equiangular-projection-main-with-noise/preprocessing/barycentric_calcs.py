@@ -1,4 +1,6 @@
 import numpy as np
+from scipy.spatial import ConvexHull, cKDTree
+from scipy.spatial import QhullError
 
 from preprocessing.convert_coordinates import convert_sphere_to_cartesian
 
@@ -31,10 +33,14 @@ def calc_spherical_excess(elevation1, azimuth1, elevation2, azimuth2, elevation3
              np.tan(0.5 * (semiperimeter - dist12)) *
              np.tan(0.5 * (semiperimeter - dist13)) *
              np.tan(0.5 * (semiperimeter - dist23)))
-    if inner >= 0:
-        excess = 4 * np.arctan(np.sqrt(inner))
+    if np.ndim(inner) == 0:
+        if inner >= 0:
+            excess = 4 * np.arctan(np.sqrt(inner))
+        else:
+            excess = 1
     else:
-        excess = 1
+        # same as above, applied element-wise when whole arrays of triangles are passed in
+        excess = np.where(inner >= 0, 4 * np.arctan(np.sqrt(np.abs(inner))), 1.)
     return excess
 
 
@@ -153,3 +159,125 @@ def calc_barycentric_coordinates(elevation, azimuth, closest_points):
         return {"alpha": None, "beta": None, "gamma": None}
 
 
+class SphericalTriangulation(object):
+    """Spherical Delaunay triangulation of a set of measured points, used to find the enclosing triangle and barycentric
+    coefficients for many points of interest at once.
+
+    The convex hull of the measured directions (as unit vectors) is their spherical Delaunay triangulation. Facets of
+    the hull whose plane does not separate them from the centre of the sphere only bridge gaps in the measurement grid
+    that are larger than a hemisphere, so they are discarded. Points not enclosed by any remaining triangle fall back to
+    their closest measured point, as in get_triangle_vertices.
+
+    :param sphere_coords: A list of measured points in the form (elevation, azimuth), entries of None are skipped
+    :param num_candidates: How many triangles (closest first) to test per point before falling back to testing all of
+                           them
+    """
+
+    def __init__(self, sphere_coords, num_candidates=8):
+        # only keep measured positions, vertex indices returned by this class refer to this list
+        self.sphere_coords = [(elev, azi) for elev, azi in sphere_coords if elev is not None and azi is not None]
+        elevations, azimuths = np.array(self.sphere_coords, dtype=float).reshape(-1, 2).T
+        self.points = np.stack([np.cos(elevations) * np.cos(azimuths),
+                                np.cos(elevations) * np.sin(azimuths),
+                                np.sin(elevations)], axis=-1)
+        self.point_tree = cKDTree(self.points)
+
+        try:
+            hull = ConvexHull(self.points)
+            # hull.equations holds (normal, offset) with normal . x + offset <= 0 inside the hull
+            keep = hull.equations[:, 3] < -1e-12
+            self.triangles = hull.simplices[keep]
+        except (QhullError, ValueError):
+            # fewer than four points, or all points on a plane: no triangle can enclose anything
+            self.triangles = np.empty((0, 3), dtype=int)
+
+        self.num_candidates = min(num_candidates, len(self.triangles))
+        if len(self.triangles) > 0:
+            # inverse of the matrix with the triangle vertices as its columns, such that inverse @ point gives the
+            # (unnormalised) barycentric weights of the point in that triangle, see triangle_encloses_point
+            self.inverses = np.linalg.inv(np.transpose(self.points[self.triangles], (0, 2, 1)))
+            centroids = np.mean(self.points[self.triangles], axis=1)
+            self.triangle_tree = cKDTree(centroids / np.linalg.norm(centroids, axis=-1, keepdims=True))
+
+    def _encloses(self, triangle_indices, points, tolerance=1e-10):
+        """Barycentric weights of each point in each of its candidate triangles (shape (n_points, n_candidates)),
+        returns a boolean array that is True where the triangle encloses the point"""
+        weights = np.einsum('nkij,nj->nki', self.inverses[triangle_indices], points)
+        return np.all(weights > -tolerance, axis=-1)
+
+    def find_triangles(self, elevations, azimuths, chunk_size=1024):
+        """For arrays of points (elevation, azimuth), find the enclosing triangle of each point and the corresponding
+        barycentric coefficients
+
+        Returns two arrays of shape (n_points, 3): the vertex indices into self.sphere_coords, sorted from closest to
+        farthest, and the coefficients (alpha, beta, gamma) for those vertices. Points that no triangle encloses are
+        given their closest measured point as the only vertex, with remaining indices set to -1 and coefficients (1, 0, 0)
+        """
+        elevations = np.asarray(elevations, dtype=float).reshape(-1)
+        azimuths = np.asarray(azimuths, dtype=float).reshape(-1)
+        points = np.stack([np.cos(elevations) * np.cos(azimuths),
+                           np.cos(elevations) * np.sin(azimuths),
+                           np.sin(elevations)], axis=-1)
+        num_points = len(points)
+        selected = np.full(num_points, -1, dtype=int)
+
+        if len(self.triangles) > 0:
+            # first test the triangles whose centroids are closest to each point
+            _, candidates = self.triangle_tree.query(points, k=self.num_candidates)
+            candidates = candidates.reshape(num_points, -1)
+            encloses = self._encloses(candidates, points)
+            found = np.any(encloses, axis=1)
+            selected[found] = candidates[found, np.argmax(encloses[found], axis=1)]
+
+            # failing that, test every triangle
+            remaining = np.flatnonzero(~found)
+            all_triangles = np.arange(len(self.triangles))
+            for start in range(0, len(remaining), chunk_size):
+                chunk = remaining[start:start + chunk_size]
+                for triangle_start in range(0, len(all_triangles), chunk_size):
+                    triangle_chunk = all_triangles[triangle_start:triangle_start + chunk_size]
+                    unresolved = chunk[selected[chunk] < 0]
+                    if len(unresolved) == 0:
+                        break
+                    encloses = self._encloses(np.broadcast_to(triangle_chunk, (len(unresolved), len(triangle_chunk))),
+                                              points[unresolved])
+                    hit = np.any(encloses, axis=1)
+                    selected[unresolved[hit]] = triangle_chunk[np.argmax(encloses[hit], axis=1)]
+
+        vertices = np.full((num_points, 3), -1, dtype=int)
+        coeffs = np.zeros((num_points, 3))
+
+        enclosed = selected >= 0
+        if np.any(enclosed):
+            triangle_vertices = self.triangles[selected[enclosed]]
+            # sort vertices from closest to farthest, to match the ordering used by get_triangle_vertices
+            distances = np.linalg.norm(self.points[triangle_vertices] - points[enclosed, None, :], axis=-1)
+            triangle_vertices = np.take_along_axis(triangle_vertices, np.argsort(distances, axis=1), axis=1)
+            vertices[enclosed] = triangle_vertices
+            coeffs[enclosed] = self.calc_barycentric_coordinates(elevations[enclosed], azimuths[enclosed],
+                                                                 triangle_vertices)
+
+        # sometimes no triangle can be formed, so it directly uses the closest point
+        if np.any(~enclosed):
+            _, closest = self.point_tree.query(points[~enclosed])
+            vertices[~enclosed, 0] = closest
+            coeffs[~enclosed, 0] = 1.
+
+        return vertices, coeffs
+
+    def calc_barycentric_coordinates(self, elevations, azimuths, triangle_vertices):
+        """Vectorised calc_barycentric_coordinates, returns an array of (alpha, beta, gamma) for each point"""
+        coords = np.array(self.sphere_coords, dtype=float)[triangle_vertices]
+        elev1, elev2, elev3 = coords[:, 0, 0], coords[:, 1, 0], coords[:, 2, 0]
+        azi1, azi2, azi3 = coords[:, 0, 1], coords[:, 1, 1], coords[:, 2, 1]
+
+        denominator = calc_spherical_excess(elev1, azi1, elev2, azi2, elev3, azi3)
+        alpha = calc_spherical_excess(elevations, azimuths, elev2, azi2, elev3, azi3) / denominator
+        beta = calc_spherical_excess(elev1, azi1, elevations, azimuths, elev3, azi3) / denominator
+        gamma = 1 - alpha - beta
+        return np.stack([alpha, beta, gamma], axis=-1)
+
+    def get_triangle_vertices(self, vertices):
+        """Convert a row of vertex indices from find_triangles to a list of (elevation, azimuth) vertices, in the form
+        returned by get_triangle_vertices"""
+        return [self.sphere_coords[v] for v in vertices if v >= 0]
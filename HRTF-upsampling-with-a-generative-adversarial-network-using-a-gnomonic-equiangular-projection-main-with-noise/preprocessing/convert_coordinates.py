@@ -1,3 +1,5 @@
+import contextlib
+
 import numpy as np
 
 PI_4 = np.pi / 4
@@ -110,52 +112,150 @@ def convert_cube_indices_to_spherical(panel, i, j, edge_len):
 def convert_sphere_to_cartesian(coordinates):
     """For a list of spherical coordinates of the form (elevation, azimuth), convert to (x, y, z) cartesian
     coordinates for plotting purposes """
-    x, y, z = [], [], []
-    mask = []
-
-    for elevation, azimuth in coordinates:
-        if elevation is not None and azimuth is not None:
-            mask.append(True)
-            # convert to cartesian coordinates
-            x_i = np.cos(elevation) * np.cos(azimuth)
-            y_i = np.cos(elevation) * np.sin(azimuth)
-            z_i = np.sin(elevation)
-
-            x.append(x_i)
-            y.append(y_i)
-            z.append(z_i)
-        else:
-            mask.append(False)
-
-    return np.asarray(x), np.asarray(y), np.asarray(z), mask
+    elevation, azimuth, mask = coordinates_to_arrays(coordinates)
+    x, y, z, _ = convert_sphere_to_cartesian_array(elevation[mask], azimuth[mask])
+    return x, y, z, mask.tolist()
 
 
 def convert_cube_to_cartesian(coordinates):
     """For a list of cube sphere coordinates of the form (panel, x, y), convert to (x, y, z) cartesian
     coordinates for plotting purposes """
-    x, y, z = [], [], []
-    mask = []
-
-    for panel, p, q in coordinates:
-        if not np.isnan(p) and not np.isnan(q):
-            mask.append(True)
-            if panel == 1:
-                x_i, y_i, z_i = PI_4, p, q
-            elif panel == 2:
-                x_i, y_i, z_i = -p, PI_4, q
-            elif panel == 3:
-                x_i, y_i, z_i = -PI_4, -p, q
-            elif panel == 4:
-                x_i, y_i, z_i = p, -PI_4, q
-            elif panel == 5:
-                x_i, y_i, z_i = -q, p, PI_4
-            else:
-                x_i, y_i, z_i = q, p, -PI_4
-
-            x.append(x_i)
-            y.append(y_i)
-            z.append(z_i)
-        else:
-            mask.append(False)
+    panel, p, q, mask = coordinates_to_arrays(coordinates)
+    x, y, z, _ = convert_cube_to_cartesian_array(panel[mask], p[mask], q[mask])
+    return x, y, z, mask.tolist()
+
+
+def _get_array_module(*arrays):
+    """Use torch for the array versions of the conversions below if any input is a torch tensor, otherwise numpy"""
+    for array in arrays:
+        if type(array).__module__.startswith('torch'):
+            import torch
+            return torch
+    return np
+
+
+def _as_float(xp, values, like):
+    """Cast values (e.g. panel numbers) to the floating point type of another array, so torch does not fall back to
+    its default float32 when dividing integers"""
+    if xp is np:
+        return np.asarray(values, dtype=np.result_type(like, float))
+    return values.to(like.dtype if like.is_floating_point() else xp.get_default_dtype())
+
+
+def _ignore_float_errors(xp):
+    # invalid positions are carried through as nan, so numpy warnings about them are not useful
+    return np.errstate(divide='ignore', invalid='ignore') if xp is np else contextlib.nullcontext()
+
+
+def coordinates_to_arrays(coordinates):
+    """For a list of coordinates such as (elevation, azimuth) or (panel, x, y), where entries may be None or nan for
+    positions that were not measured, return one float array per coordinate (with nan for those positions) and a
+    boolean mask that is True for valid positions"""
+    coordinates = list(coordinates)
+    num_columns = len(coordinates[0]) if len(coordinates) > 0 else 2
+    arrays = np.array([[np.nan if c is None else c for c in coordinate] for coordinate in coordinates],
+                      dtype=float).reshape(-1, num_columns)
+    mask = ~np.any(np.isnan(arrays), axis=1)
+    return (*arrays.T, mask)
+
+
+def calc_panel_array(elevation, azimuth):
+    """Array version of calc_panel, panels are numbered 1 through 6"""
+    xp = _get_array_module(elevation, azimuth)
+    quadrant = _as_float(xp, 1 + (azimuth >= np.pi / 4) * 1 + (azimuth >= 3 * np.pi / 4) * 1 +
+                         (azimuth >= 5 * np.pi / 4) * 1, azimuth)
+    offset = ((quadrant - 1) / 2) * np.pi
+    with _ignore_float_errors(xp):
+        threshold_val = xp.tan(elevation) / xp.cos(azimuth - offset)
+    # when close to the horizontal plane, must be panels 1 through 4 (inclusive), above a certain elevation it is in
+    # panel 5, and below a certain elevation in panel 6
+    return xp.where((-1 <= threshold_val) & (threshold_val < 1), quadrant,
+                    xp.where(threshold_val >= 1, 5., 6.))
+
+
+def convert_sphere_to_cube_array(elevation, azimuth):
+    """Array version of convert_sphere_to_cube, returns arrays of panel, x, y, and a mask of valid positions (positions
+    where elevation or azimuth is nan are kept as nan in the cube)"""
+    xp = _get_array_module(elevation, azimuth)
+    valid = ~(xp.isnan(elevation) | xp.isnan(azimuth))
+
+    # shift the range of azimuth angles such that it works with conversion equations
+    azimuth = xp.where(azimuth < -np.pi / 4, azimuth + 2 * np.pi, azimuth)
+    panel = calc_panel_array(elevation, azimuth)
+    offset = ((panel - 1) / 2) * np.pi
+
+    with _ignore_float_errors(xp):
+        tan_elevation = xp.tan(elevation)
+        x = xp.where(panel <= 4, azimuth - offset,
+                     xp.where(panel == 5, xp.arctan(xp.sin(azimuth) / tan_elevation),
+                              xp.arctan(-xp.sin(azimuth) / tan_elevation)))
+        y = xp.where(panel <= 4, xp.arctan(tan_elevation / xp.cos(azimuth - offset)),
+                     xp.arctan(-xp.cos(azimuth) / tan_elevation))
+
+    panel = xp.where(valid, panel, np.nan)
+    x = xp.where(valid, x, np.nan)
+    y = xp.where(valid, y, np.nan)
+    return panel, x, y, valid
+
+
+def convert_cube_to_sphere_array(panel, x, y):
+    """Array version of convert_cube_to_sphere, returns arrays of elevation, azimuth, and a mask of valid positions
+    (panel 6 is not supported, so those positions are nan like any position where panel, x or y is nan)"""
+    xp = _get_array_module(panel, x, y)
+    panel = _as_float(xp, panel, x)
+    valid = ~(xp.isnan(panel) | xp.isnan(x) | xp.isnan(y)) & (panel <= 5)
+
+    with _ignore_float_errors(xp):
+        # equatorial panels
+        offset = ((panel - 1) / 2) * np.pi
+        azimuth = x + offset
+        elevation = xp.arctan(xp.tan(y) * xp.cos(x))
+
+        # top panel, where tan(x) == 0 is handled as a special case
+        tan_x = xp.tan(x)
+        top_azimuth = xp.arctan(-tan_x / xp.tan(y))
+        top_elevation = xp.arctan(xp.sin(top_azimuth) / tan_x)
+        top_azimuth = xp.where(top_elevation < 0, top_azimuth + np.pi, top_azimuth)
+        top_elevation = xp.where(top_elevation < 0, -top_elevation, top_elevation)
+        top_azimuth = xp.where(tan_x == 0, 0., top_azimuth)
+        top_elevation = xp.where(tan_x == 0, np.pi / 2, top_elevation)
+
+    azimuth = xp.where(panel == 5, top_azimuth, azimuth)
+    elevation = xp.where(panel == 5, top_elevation, elevation)
+
+    # ensure azimuth is in range -pi to +pi
+    azimuth = xp.where(valid, azimuth, 0.)
+    while xp.any(azimuth > np.pi):
+        azimuth = xp.where(azimuth > np.pi, azimuth - 2 * np.pi, azimuth)
+    while xp.any(azimuth <= -np.pi):
+        azimuth = xp.where(azimuth <= -np.pi, azimuth + 2 * np.pi, azimuth)
+
+    elevation = xp.where(valid, elevation, np.nan)
+    azimuth = xp.where(valid, azimuth, np.nan)
+    return elevation, azimuth, valid
+
+
+def convert_sphere_to_cartesian_array(elevation, azimuth):
+    """Array version of convert_sphere_to_cartesian, returns arrays x, y, z (nan where elevation or azimuth is nan)
+    along with a mask of valid positions"""
+    xp = _get_array_module(elevation, azimuth)
+    valid = ~(xp.isnan(elevation) | xp.isnan(azimuth))
+    x = xp.cos(elevation) * xp.cos(azimuth)
+    y = xp.cos(elevation) * xp.sin(azimuth)
+    z = xp.sin(elevation)
+    return x, y, z, valid
+
 
-    return np.asarray(x), np.asarray(y), np.asarray(z), mask
+def convert_cube_to_cartesian_array(panel, p, q):
+    """Array version of convert_cube_to_cartesian, returns arrays x, y, z (nan where p or q is nan) along with a mask of
+    valid positions"""
+    xp = _get_array_module(panel, p, q)
+    valid = ~(xp.isnan(p) | xp.isnan(q))
+    # position of each panel's centre along the axis it faces, and the directions of p and q on that panel
+    x = xp.where(panel == 1, PI_4, xp.where(panel == 2, -p, xp.where(panel == 3, -PI_4, xp.where(
+        panel == 4, p, xp.where(panel == 5, -q, q)))))
+    y = xp.where(panel == 1, p, xp.where(panel == 2, PI_4, xp.where(panel == 3, -p, xp.where(
+        panel == 4, -PI_4, p))))
+    z = xp.where(panel <= 4, q, xp.where(panel == 5, PI_4, -PI_4))
+    x, y, z = (xp.where(valid, c, np.nan) for c in (x, y, z))
+    return x, y, z, valid
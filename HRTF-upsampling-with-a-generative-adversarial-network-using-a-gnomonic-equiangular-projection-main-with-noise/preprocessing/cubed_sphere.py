@@ -1,9 +1,7 @@
-import itertools
-
 import numpy as np
 import pandas as pd
 
-from preprocessing.convert_coordinates import convert_sphere_to_cube
+from preprocessing.convert_coordinates import convert_sphere_to_cube_array, coordinates_to_arrays
 
 
 class CubedSphere(object):
@@ -18,56 +16,78 @@ class CubedSphere(object):
     # In all cases, low values of x and y are situated in lower left of the unfolded sphere
 
     def __init__(self, mask=None, row_angles=None, column_angles=None, sphere_coords=None, indices=None):
-        # initiate two lists of tuples, one will store (elevation, azimuth) for every measurement point
-        # the other will store (elevation_index, azimuth_index) for every measurement point
-        self.sphere_coords = []
-        self.indices = []
+        # coordinates are stored as compact arrays, in the same order for all of them:
+        # self.sphere_array holds (elevation, azimuth) for every measurement point, with nan for points not measured
+        # self.indices holds (elevation_index, azimuth_index) for every measurement point, or (panel_index,
+        # elevation_index, azimuth_index) when built from given sphere_coords and indices
+        # self.cube_array holds the corresponding (panel, x, y) on the cubed sphere
+        # list versions and the pandas dataframe are only built if they are requested
+        self._sphere_coords = None
+        self._cube_coords = None
+        self._all_coords = None
 
         if indices is None:
             # at this stage, we can simplify by acting as if there are the same number of elevation measurement points at
             # every azimuth angle
-            def elevation_validate(a, b): return None if b else a
+            num_azimuth_measurements = len(row_angles)
             num_elevation_measurements = len(column_angles)
-            elevation_indices = list(range(num_elevation_measurements))
-            elevation = column_angles * np.pi / 180
-
-            # loop through all azimuth positions
-            for azimuth_index, azimuth in enumerate(row_angles):
-                # convert degrees to radians by multiplying by a factor of pi/180
-                azimuth = azimuth * np.pi / 180
-                if type(mask) is np.bool_:
-                    if not mask:
-                        elevation_valid = elevation
-                else:
-                    elevation_valid = list(map(elevation_validate, list(elevation), [x.flatten().any() for x in mask[azimuth_index]]))
-
-                # sphere_coords is stored as (elevation, azimuth). Ultimately, we're creating a list of (elevation,
-                # azimuth) pairs for every measurement position in the sphere
-                self.sphere_coords += list(zip(elevation_valid, [azimuth] * num_elevation_measurements))
-                self.indices += list(zip(elevation_indices, [azimuth_index] * num_elevation_measurements))
-
-            # self.cube_coords is created from measurement_positions, such that order is the same
-            self.cube_coords = list(itertools.starmap(convert_sphere_to_cube, self.sphere_coords))
-
-            # create pandas dataframe containing all coordinate data (spherical and cubed sphere)
-            # this can be useful for debugging
-            self.all_coords = pd.concat([pd.DataFrame(self.indices, columns=["elevation_index", "azimuth_index"]),
-                                         pd.DataFrame(self.sphere_coords, columns=["elevation", "azimuth"]),
-                                         pd.DataFrame(self.cube_coords, columns=["panel", "x", "y"])], axis="columns")
-
+            # convert degrees to radians by multiplying by a factor of pi/180
+            elevation = np.asarray(column_angles) * np.pi / 180
+            azimuth = np.asarray(row_angles) * np.pi / 180
+
+            # a position is not valid if any of its features are masked
+            if type(mask) is np.bool_ or mask is None:
+                invalid = np.full((num_azimuth_measurements, num_elevation_measurements), bool(mask))
+            else:
+                invalid = np.asarray(mask).reshape(num_azimuth_measurements, num_elevation_measurements, -1).any(axis=-1)
+
+            # ordered by azimuth, then elevation
+            elevation_grid = np.tile(elevation, num_azimuth_measurements)
+            azimuth_grid = np.repeat(azimuth, num_elevation_measurements)
+            self.valid = ~invalid.flatten()
+            self.sphere_array = np.stack([np.where(self.valid, elevation_grid, np.nan), azimuth_grid], axis=1)
+            self.indices = np.stack([np.tile(np.arange(num_elevation_measurements), num_azimuth_measurements),
+                                     np.repeat(np.arange(num_azimuth_measurements), num_elevation_measurements)], axis=1)
+            self._index_columns = ["elevation_index", "azimuth_index"]
+
+            # azimuth is always known, so give sphere_coords the same form as before, where only elevation is None
+            if self.valid.all():
+                self._sphere_coords = list(zip(elevation_grid, azimuth_grid))
+            else:
+                self._sphere_coords = [(e if v else None, a) for e, a, v in zip(elevation_grid, azimuth_grid,
+                                                                                  self.valid)]
         else:
-            self.sphere_coords = sphere_coords
-            self.indices = indices
-
-            # self.cube_coords is created from measurement_positions, such that order is the same
-            self.cube_coords = list(itertools.starmap(convert_sphere_to_cube, self.sphere_coords))
-
+            self._sphere_coords = sphere_coords
+            elevation_grid, azimuth_grid, self.valid = coordinates_to_arrays(sphere_coords)
+            self.sphere_array = np.stack([elevation_grid, azimuth_grid], axis=1)
+            self.indices = np.asarray(indices, dtype=int)
+            self._index_columns = ["panel_index", "elevation_index", "azimuth_index"]
+
+        # self.cube_array is created from sphere_array, such that order is the same
+        panel, x, y, _ = convert_sphere_to_cube_array(self.sphere_array[:, 0], self.sphere_array[:, 1])
+        self.cube_array = np.stack([panel, x, y], axis=1)
+
+    @property
+    def sphere_coords(self):
+        return self._sphere_coords
+
+    @property
+    def cube_coords(self):
+        if self._cube_coords is None:
+            # panels are ints (or nan for points that were not measured) as in convert_sphere_to_cube
+            self._cube_coords = [(p if np.isnan(p) else int(p), x, y) for p, x, y in self.cube_array.tolist()]
+        return self._cube_coords
+
+    @property
+    def all_coords(self):
+        if self._all_coords is None:
             # create pandas dataframe containing all coordinate data (spherical and cubed sphere)
             # this can be useful for debugging
-            self.all_coords = pd.concat(
-                [pd.DataFrame(self.indices, columns=["panel_index", "elevation_index", "azimuth_index"]),
-                 pd.DataFrame(self.sphere_coords, columns=["elevation", "azimuth"]),
-                 pd.DataFrame(self.cube_coords, columns=["panel", "x", "y"])], axis="columns")
+            self._all_coords = pd.concat([pd.DataFrame(self.indices, columns=self._index_columns),
+                                          pd.DataFrame(self.sphere_coords, columns=["elevation", "azimuth"]),
+                                          pd.DataFrame(self.cube_coords, columns=["panel", "x", "y"])],
+                                         axis="columns")
+        return self._all_coords
 
     def get_sphere_coords(self):
         return self.sphere_coords
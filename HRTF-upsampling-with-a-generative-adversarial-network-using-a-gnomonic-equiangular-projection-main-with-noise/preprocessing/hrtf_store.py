@@ -0,0 +1,283 @@
+import json
+import os
+import pickle
+import re
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from preprocessing.storage import STORAGE_POLICIES, decode_hrtf, get_storage_policy, load_hrtf_file
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where stores are not shared between jobs
+    fcntl = None
+
+HRTF_STORE_VERSION = 1
+
+
+def get_store_dir(hrtf_dir):
+    """The store for a directory of pickled HRTFs lives inside it, where it is ignored by everything that only lists
+    the files of the directory"""
+    return f'{hrtf_dir}/store'
+
+
+def parse_hrtf_file_name(file_name):
+    """Get (subject_id, side) from names such as Sonicom_mag_12.pickle (merged, side is None) or
+    Sonicom_mag_12left.pickle"""
+    subject_id, side = re.findall('_([0-9]*)([a-z]*).pickle$', os.path.basename(file_name))[0]
+    return int(subject_id), side if side != '' else None
+
+
+class HRTFStore(object):
+    """Consolidated store of HRTFs that all have the same shape, e.g. (5, hrtf_size, hrtf_size, nbins), held in one
+    contiguous file that is memory-mapped for reading, along with an index.json mapping the name of each HRTF (the
+    name of the pickle it replaces) to its row, subject id and side.
+
+    Writing an HRTF under an existing name stores it in a new row, so the store can be updated by incremental
+    preprocessing. Rows of replaced and removed HRTFs are reused by later writes, but only once the saved index no
+    longer points at them, such that other processes reading the store never see a row half written. Writes are
+    serialised between processes (e.g. jobs sharing a data directory) by a lock file.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = str(store_dir)
+        self.data_filename = f'{self.store_dir}/data.bin'
+        self.index_filename = f'{self.store_dir}/index.json'
+        self.index = None
+        self._data = None
+        self.reload()
+
+    @staticmethod
+    def exists(store_dir):
+        return os.path.isfile(f'{store_dir}/index.json')
+
+    def reload(self):
+        """Read the index again, e.g. after another process has written to the store"""
+        self._data = None
+        if self.exists(self.store_dir):
+            with open(self.index_filename) as file:
+                self.index = json.load(file)
+            if self.index['version'] > HRTF_STORE_VERSION:
+                raise ValueError(f'HRTF store version {self.index["version"]} of {self.store_dir} is newer than the '
+                                 f'supported version {HRTF_STORE_VERSION}')
+        else:
+            self.index = {'version': HRTF_STORE_VERSION, 'dtype': None, 'shape': None, 'num_rows': 0, 'entries': {},
+                          'free_rows': []}
+
+    def _save_index(self):
+        Path(self.store_dir).mkdir(parents=True, exist_ok=True)
+        # a temporary file per process, as several jobs may update the store at once
+        tmp_filename = f'{self.index_filename}.{os.getpid()}.tmp'
+        with open(tmp_filename, 'w') as file:
+            json.dump(self.index, file)
+        os.replace(tmp_filename, self.index_filename)
+
+    @contextmanager
+    def _lock(self):
+        """Hold the store's lock file, with the index as it was last saved by any process"""
+        Path(self.store_dir).mkdir(parents=True, exist_ok=True)
+        with open(f'{self.store_dir}/lock', 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.reload()
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @property
+    def shape(self):
+        return tuple(self.index['shape'])
+
+    @property
+    def dtype(self):
+        """dtype of the stored data, bfloat16 HRTFs are stored as int16 with the same bits"""
+        return np.dtype(np.int16 if self.index['dtype'] == 'bfloat16' else self.index['dtype'])
+
+    @property
+    def dtype_name(self):
+        if self.index['dtype'] is None:
+            return None
+        return 'bfloat16' if self.index['dtype'] == 'bfloat16' else np.dtype(self.index['dtype']).name
+
+    @property
+    def data(self):
+        """All rows as a (num_rows, *shape) array, memory-mapped copy-on-write such that tensors can share its memory
+        without ever modifying the store"""
+        if self._data is None and self.index['num_rows'] > 0:
+            self._data = np.memmap(self.data_filename, dtype=self.dtype, mode='c',
+                                   shape=(self.index['num_rows'], *self.shape))
+        return self._data
+
+    def __len__(self):
+        return len(self.index['entries'])
+
+    def __contains__(self, name):
+        return name in self.index['entries']
+
+    def get_names(self, valid_only=False):
+        """Names of the HRTFs in the store, sorted by name. If valid_only, those containing nan or inf are left out"""
+        return sorted(name for name, entry in self.index['entries'].items() if entry['finite'] or not valid_only)
+
+    def get_entry(self, name):
+        return self.index['entries'][name]
+
+    def find(self, subject_id, side=None):
+        """Name of the HRTF of a given subject and side (None for merged HRTFs)"""
+        for name, entry in self.index['entries'].items():
+            if entry['subject_id'] == subject_id and entry['side'] == side:
+                return name
+        raise KeyError(f'No HRTF of subject {subject_id} ({side}) in {self.store_dir}')
+
+    def read(self, name, bins=None):
+        """HRTF stored under name as a view of the memory-mapped data (no copy), optionally only a slice of the last
+        axis, e.g. bins=slice(0, nbins_hrtf) for the left ear of a merged HRTF"""
+        hrtf = self.data[self.index['entries'][name]['row']]
+        return hrtf if bins is None else hrtf[..., bins]
+
+    def read_tensor(self, name, bins=None):
+        hrtf = torch.from_numpy(self.read(name, bins))
+        return hrtf.view(torch.bfloat16) if self.index['dtype'] == 'bfloat16' else hrtf
+
+    def write_many(self, items):
+        """Write (name, hrtf, source) items, where source is an optional fingerprint of the file the HRTF came from, to
+        the store, replacing HRTFs already stored under the same names. The index is only saved once all data has been
+        written, and not at all if there were no items. Items may be a generator, which is consumed while the store is
+        locked, after the index has been read again. Returns the number of HRTFs written"""
+        with self._lock():
+            num_written, replaced_rows = self._write_rows(items)
+            if num_written > 0:
+                self._save_index()
+                if len(replaced_rows) > 0:
+                    # the saved index no longer points at the rows of the replaced HRTFs
+                    self.index['free_rows'] += replaced_rows
+                    self._save_index()
+            self._data = None
+        return num_written
+
+    def _write_rows(self, items):
+        num_written = 0
+        replaced_rows = []
+        file = None
+        try:
+            for name, hrtf, source in items:
+                if file is None:
+                    file = open(self.data_filename, 'r+b' if os.path.isfile(self.data_filename) else 'w+b')
+                dtype_name = str(hrtf.dtype).replace('torch.', '') if torch.is_tensor(hrtf) else np.dtype(hrtf.dtype).name
+                if torch.is_tensor(hrtf):
+                    hrtf = hrtf.detach().cpu()
+                    hrtf = (hrtf.view(torch.int16) if hrtf.dtype == torch.bfloat16 else hrtf).numpy()
+                hrtf = np.asarray(hrtf)
+                if self.index['shape'] is None:
+                    self.index['shape'], self.index['dtype'] = list(hrtf.shape), dtype_name
+                if tuple(hrtf.shape) != self.shape or dtype_name != self.dtype_name:
+                    raise ValueError(f'Cannot write HRTF of shape {hrtf.shape} ({dtype_name}) to {self.store_dir}, '
+                                     f'which holds HRTFs of shape {self.shape} ({self.dtype_name})')
+
+                if name in self.index['entries']:
+                    replaced_rows.append(self.index['entries'][name]['row'])
+                if len(self.index['free_rows']) > 0:
+                    row = self.index['free_rows'].pop()
+                else:
+                    row = self.index['num_rows']
+                    self.index['num_rows'] += 1
+
+                file.seek(row * self.dtype.itemsize * int(np.prod(self.shape)))
+                file.write(np.ascontiguousarray(hrtf, dtype=self.dtype).tobytes())
+
+                subject_id, side = parse_hrtf_file_name(name)
+                finite = bool(torch.isfinite(self._as_tensor(hrtf)).all())
+                self.index['entries'][name] = {'row': row, 'subject_id': subject_id, 'side': side,
+                                               'finite': finite, 'source': source}
+                num_written += 1
+        finally:
+            if file is not None:
+                file.close()
+        return num_written, replaced_rows
+
+    def _as_tensor(self, data):
+        data = torch.from_numpy(np.ascontiguousarray(data))
+        return data.view(torch.bfloat16) if self.index['dtype'] == 'bfloat16' else data
+
+    def clear(self):
+        """Remove every HRTF, e.g. to store HRTFs of another dtype"""
+        with self._lock():
+            for filename in (self.data_filename, self.index_filename):
+                if os.path.isfile(filename):
+                    os.remove(filename)
+            self.reload()
+
+    def append(self, name, hrtf, source=None):
+        self.write_many([(name, hrtf, source)])
+
+    def remove(self, names):
+        with self._lock():
+            names = [name for name in names if name in self.index['entries']]
+            if len(names) > 0:
+                for name in names:
+                    self.index['free_rows'].append(self.index['entries'].pop(name)['row'])
+                self._save_index()
+            self._data = None
+
+    def __getstate__(self):
+        # the memory map is opened again by each process (e.g. DataLoader workers) rather than copied
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+
+def get_file_fingerprint(file_name):
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def sync_store(hrtf_dir, store=None):
+    """Bring the store of a directory of pickled HRTFs up to date with its files: pickles that are new or have changed
+    since they were stored (by size and modification time) are written to the store, and HRTFs whose pickle was
+    removed are removed from it. Converts the whole directory the first time it is called"""
+    store = HRTFStore(get_store_dir(hrtf_dir)) if store is None else store
+    policy = get_storage_policy(hrtf_dir)
+    if policy is not None and store.dtype_name not in (None, str(STORAGE_POLICIES[policy][0]).replace('torch.', '')):
+        # the HRTFs were written with another storage policy since they were stored
+        store.clear()
+    hrtf_file_names = sorted(hrtf_file_name for hrtf_file_name in os.listdir(hrtf_dir)
+                             if os.path.isfile(os.path.join(hrtf_dir, hrtf_file_name))
+                             and hrtf_file_name.endswith('.pickle') and '_phase' not in hrtf_file_name)
+
+    def changed_items():
+        for hrtf_file_name in hrtf_file_names:
+            source = get_file_fingerprint(os.path.join(hrtf_dir, hrtf_file_name))
+            if hrtf_file_name in store and store.get_entry(hrtf_file_name)['source'] == source:
+                continue
+            with open(os.path.join(hrtf_dir, hrtf_file_name), 'rb') as file:
+                yield hrtf_file_name, pickle.load(file), source
+
+    store.write_many(changed_items())
+    removed = set(store.get_names()) - set(hrtf_file_names)
+    if len(removed) > 0:
+        store.remove(removed)
+    return store
+
+
+# stores opened by read_hrtf, one per directory
+_open_stores = {}
+
+
+def read_hrtf(hrtf_dir, file_name):
+    """Read the pickled HRTF hrtf_dir/file_name from the directory's store if it holds an up to date copy of it,
+    otherwise from the pickle itself. Either way, it is decoded with the storage policy of the directory"""
+    file_name = os.path.basename(file_name)
+    store_dir = get_store_dir(hrtf_dir)
+    if store_dir not in _open_stores and HRTFStore.exists(store_dir):
+        _open_stores[store_dir] = HRTFStore(store_dir)
+
+    store = _open_stores.get(store_dir)
+    if store is not None and file_name in store \
+            and store.get_entry(file_name)['source'] == get_file_fingerprint(os.path.join(hrtf_dir, file_name)):
+        return decode_hrtf(store.read_tensor(file_name), get_storage_policy(hrtf_dir))
+    return load_hrtf_file(os.path.join(hrtf_dir, file_name))
@@ -0,0 +1,101 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from preprocessing.utils import interpolate_fft, get_hrtf_from_features
+
+
+def get_decode_cache_filename(config, subject_id, side):
+    """Location of the cached features for one subject/side, keyed by dataset and sample rate"""
+    return f'{config.decode_cache_dir}/{config.dataset}_{config.hrir_samplerate:g}/{subject_id}_{side}.npz'
+
+
+def load_subject_features(config, ds, index, source=None):
+    """Get the features of ds[index] as a masked array, decoding them through hrtfdata only if they are not already in
+    the local cache (see config.use_decode_cache). The fingerprint of the subject's source files is stored with the
+    cached features, which are decoded again if they were cached from other source files"""
+    filename = get_decode_cache_filename(config, ds.subject_ids[index], ds.sides[index])
+    if config.use_decode_cache and os.path.isfile(filename):
+        with np.load(filename) as cached:
+            if source is None or ('source' in cached.files and str(cached['source']) == source):
+                return np.ma.array(cached['data'], mask=cached['mask'])
+
+    features = ds[index]['features']
+    if config.use_decode_cache:
+        # write to a temporary file first, so that an interrupted run never leaves a truncated cache entry
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        with open(filename + '.tmp', 'wb') as file:
+            np.savez(file, data=np.ma.getdata(features), mask=np.ma.getmaskarray(features),
+                     source=np.array('' if source is None else source))
+        os.replace(filename + '.tmp', filename)
+    return features
+
+
+class SubjectProjector(object):
+    """Projects the features of one subject onto the cubed sphere (interpolate_fft) and computes the HRTFs at the
+    originally measured positions (get_hrtf_from_features).
+
+    Holds everything that is shared between subjects, so that it only needs to be sent to each worker process once
+    """
+
+    def __init__(self, config, cs, projection, row_angles, column_angles, fs_original):
+        self.config = config
+        self.cs = cs
+        self.row_angles = row_angles
+        self.column_angles = column_angles
+        self.fs_original = fs_original
+        # triangles and coefficients are the same for every subject, so only compile them once
+        self.interpolation_matrix = projection.get_interpolation_matrix(cs)
+        self.cube_indices = projection.get_cube_indices()
+
+    def __call__(self, subject_features):
+        features = subject_features.data.reshape(*subject_features.shape[:-2], -1)
+        # the projection's points are fully described by interpolation_matrix and cube_indices
+        clean_hrtf = interpolate_fft(self.config, self.cs, features, sphere=None, sphere_triangles=None,
+                                     sphere_coeffs=None, cube=None, fs_original=self.fs_original,
+                                     edge_len=self.config.hrtf_size, interpolation_matrix=self.interpolation_matrix,
+                                     cube_indices=self.cube_indices)
+        hrtf_original, phase_original, sphere_original = get_hrtf_from_features(self.config, subject_features,
+                                                                                self.row_angles, self.column_angles)
+        return clean_hrtf, hrtf_original, phase_original, sphere_original
+
+
+# projector used by each worker process, set once by _init_worker
+_worker_projector = None
+
+
+def _init_worker(projector):
+    global _worker_projector
+    _worker_projector = projector
+
+
+def _project_in_worker(subject_features):
+    return _worker_projector(subject_features)
+
+
+def project_subjects(projector, subjects, num_workers=1):
+    """Apply projector to the features of every subject, fanning the work out over num_workers processes
+
+    :param subjects: An iterable of (index, features) pairs
+    :return: A generator of (index, projector output) pairs, in the same order as subjects regardless of the number of
+             workers, such that the outputs are identical to a serial run
+    """
+    if num_workers <= 1:
+        for index, subject_features in subjects:
+            yield index, projector(subject_features)
+        return
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(projector,)) as executor:
+        # limit the number of subjects in flight, so that only a few decoded subjects are held in memory at once
+        pending = deque()
+        for index, subject_features in subjects:
+            pending.append((index, executor.submit(_project_in_worker, subject_features)))
+            if len(pending) >= 2 * num_workers:
+                index, future = pending.popleft()
+                yield index, future.result()
+        while pending:
+            index, future = pending.popleft()
+            yield index, future.result()
@@ -0,0 +1,85 @@
+import functools
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from preprocessing.storage import encode_hrtf, decode_hrtf, get_storage_policy
+
+# upscale factors whose low resolution HRTFs are written by preprocessing, for an hrtf_size of 16
+LR_PYRAMID_FACTORS = (2, 4, 8, 16)
+
+
+def get_lr_pyramid_dir(hrtf_dir, upscale_factor):
+    """Low resolution HRTFs of a directory live in a subdirectory per upscale factor, under the same file names as
+    the high resolution HRTFs they were taken from"""
+    return f'{hrtf_dir}/lr_pyramid/{upscale_factor}'
+
+
+def get_lr_pyramid_filename(hrtf_file_name, upscale_factor):
+    hrtf_dir, file_name = os.path.split(hrtf_file_name)
+    return os.path.join(get_lr_pyramid_dir(hrtf_dir, upscale_factor), file_name)
+
+
+def get_lr_pyramid_factors(hrtf_size):
+    return [upscale_factor for upscale_factor in LR_PYRAMID_FACTORS if upscale_factor <= hrtf_size]
+
+
+@functools.lru_cache(maxsize=None)
+def get_lr_indices(hrtf_size, upscale_factor):
+    """Indices along each edge of a panel of the high resolution positions kept at an upscale factor, the same ones
+    downsample_hrtf keeps: every upscale_factor-th position, or the middle one when a panel is downsampled to a single
+    position"""
+    if upscale_factor == hrtf_size:
+        indices = np.array([hrtf_size // 2])
+    else:
+        indices = np.arange(0, hrtf_size, upscale_factor)
+    indices.setflags(write=False)
+    return indices
+
+
+@functools.lru_cache(maxsize=None)
+def get_lr_mask(hrtf_size, upscale_factor):
+    """(5, hrtf_size, hrtf_size) boolean array, True for the high resolution positions kept at an upscale factor"""
+    indices = get_lr_indices(hrtf_size, upscale_factor)
+    mask = np.zeros((5, hrtf_size, hrtf_size), dtype=bool)
+    mask[:, indices[:, np.newaxis], indices] = True
+    mask.setflags(write=False)
+    return mask
+
+
+def get_lr_hrtf(hr_hrtf, hrtf_size, upscale_factor):
+    """Low resolution HRTF of shape (5, hrtf_size / upscale_factor, hrtf_size / upscale_factor, nbins) taken from a
+    high resolution HRTF of shape (5, hrtf_size, hrtf_size, nbins) by indexing, equivalent to downsample_hrtf"""
+    indices = torch.tensor(get_lr_indices(hrtf_size, upscale_factor))
+    return hr_hrtf[:, indices][:, :, indices]
+
+
+def write_lr_pyramid(hrtf_file_name, hr_hrtf, hrtf_size, storage_policy=None):
+    """Write the low resolution HRTFs of every supported upscale factor for a high resolution HRTF that was written to
+    hrtf_file_name, returning the files written. They are written with the storage policy of the high resolution HRTF
+    (see preprocessing.storage)"""
+    lr_file_names = []
+    for upscale_factor in get_lr_pyramid_factors(hrtf_size):
+        lr_file_name = get_lr_pyramid_filename(hrtf_file_name, upscale_factor)
+        Path(lr_file_name).parent.mkdir(parents=True, exist_ok=True)
+        lr_hrtf = get_lr_hrtf(hr_hrtf, hrtf_size, upscale_factor).clone()
+        with open(lr_file_name, "wb") as file:
+            pickle.dump(lr_hrtf if storage_policy is None else encode_hrtf(lr_hrtf, storage_policy), file)
+        lr_file_names.append(lr_file_name)
+    return lr_file_names
+
+
+def read_lr_hrtf(hrtf_file_name, upscale_factor):
+    """Low resolution HRTF written by write_lr_pyramid for hrtf_file_name, or None if there is none or it is older than
+    the high resolution HRTF. Decoded with the storage policy of the high resolution HRTF"""
+    lr_file_name = get_lr_pyramid_filename(hrtf_file_name, upscale_factor)
+    try:
+        if os.path.getmtime(lr_file_name) < os.path.getmtime(hrtf_file_name):
+            return None
+        with open(lr_file_name, "rb") as file:
+            return decode_hrtf(pickle.load(file), get_storage_policy(os.path.dirname(hrtf_file_name)))
+    except FileNotFoundError:
+        return None
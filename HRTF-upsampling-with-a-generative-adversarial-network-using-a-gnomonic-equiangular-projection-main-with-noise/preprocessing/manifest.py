@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import re
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from preprocessing.lr_pyramid import get_lr_pyramid_filename, get_lr_pyramid_factors
+
+PREPROCESS_MANIFEST_VERSION = 1
+
+
+def calc_params_fingerprint(config, projection):
+    """Parameters that change the output of every subject, if any of them differ from the manifest then everything is
+    reprocessed"""
+    params = {'version': PREPROCESS_MANIFEST_VERSION, 'dataset': config.dataset, 'hrtf_size': config.hrtf_size,
+              'nbins_hrtf': config.nbins_hrtf, 'hrir_samplerate': config.hrir_samplerate,
+              'merge_flag': config.merge_flag, 'gen_sofa_flag': config.gen_sofa_flag,
+              'gen_lr_pyramid_flag': config.gen_lr_pyramid_flag, 'hrtf_storage_policy': config.hrtf_storage_policy,
+              'projection': projection.get_hash()}
+    return params, hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def index_source_files(data_dir, subject_ids):
+    """Group the files under the raw dataset directory by the subject id in their name (e.g. 12 for
+    HRIR_48kHz_P0012.sofa). A file is only assigned to a subject if exactly one of the numbers in its name is a subject
+    id of the dataset, not counting numbers followed by a unit of frequency such as 48kHz. Also returns every file, to
+    fingerprint the subjects that no file could be assigned to"""
+    subject_ids = {int(subject_id) for subject_id in subject_ids}
+    files_by_subject = defaultdict(list)
+    all_files = []
+    for root, _, file_names in os.walk(data_dir):
+        for file_name in file_names:
+            all_files.append(os.path.join(root, file_name))
+            numbers = {int(number) for number in re.findall(r'(?<!\d)(\d+)(?!\d|k?hz)', file_name, re.IGNORECASE)}
+            matches = numbers & subject_ids
+            if len(matches) == 1:
+                files_by_subject[matches.pop()].append(all_files[-1])
+    return files_by_subject, all_files
+
+
+def calc_source_fingerprint(data_dir, file_names):
+    """Fingerprint of a subject's source files, based on their path, size and modification time, so that no file
+    needs to be read"""
+    entries = []
+    for file_name in sorted(file_names):
+        stat = os.stat(file_name)
+        entries.append([os.path.relpath(file_name, data_dir), stat.st_size, stat.st_mtime_ns])
+    return 'stat:' + hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+
+
+class PreprocessManifest(object):
+    """Record of the subjects produced by preprocess mode, such that a rerun only processes subjects that are new or
+    whose source files have changed.
+
+    For every subject, the manifest holds the fingerprint of its source files, the split it was assigned to and, for
+    every side, whether it was valid along with the files written for it
+    """
+
+    def __init__(self, filename, params, params_hash):
+        self.filename = filename
+        self.params = params
+        self.params_hash = params_hash
+        self.subjects = {}
+
+    @classmethod
+    def load(cls, filename, params, params_hash):
+        """Load the manifest, which is only reused if it was written with the same parameters"""
+        manifest = cls(filename, params, params_hash)
+        if os.path.isfile(filename):
+            with open(filename) as file:
+                saved = json.load(file)
+            if saved.get('params_hash') == params_hash:
+                manifest.subjects = saved['subjects']
+        return manifest
+
+    def is_empty(self):
+        return len(self.subjects) == 0
+
+    def clear(self):
+        self.subjects = {}
+
+    def get_subject_ids(self):
+        return [int(subject_id) for subject_id in self.subjects]
+
+    def save(self):
+        Path(self.filename).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.filename + '.tmp', 'w') as file:
+            json.dump({'params': self.params, 'params_hash': self.params_hash, 'subjects': self.subjects}, file,
+                      indent=2)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def get_split(self, subject_id):
+        entry = self.subjects.get(str(subject_id))
+        return None if entry is None else entry['split']
+
+    def is_up_to_date(self, subject_id, side, fingerprint):
+        """Whether the outputs of this subject/side were produced from the same source files and still exist"""
+        entry = self.subjects.get(str(subject_id))
+        if entry is None or entry['source'] != fingerprint or side not in entry['sides']:
+            return False
+        return all(os.path.isfile(output) for output in entry['sides'][side]['outputs'] + entry['outputs'])
+
+    def update(self, subject_id, side, fingerprint, split, valid, outputs):
+        entry = self.subjects.get(str(subject_id))
+        if entry is not None and entry['source'] != fingerprint:
+            # the outputs of the old source files are stale, apart from those that were just written again
+            self._remove_outputs(entry, keep=outputs)
+        if entry is None or entry['source'] != fingerprint:
+            entry = {'source': fingerprint, 'split': split, 'sides': {}, 'outputs': []}
+            self.subjects[str(subject_id)] = entry
+        entry['sides'][side] = {'valid': valid, 'outputs': list(outputs)}
+
+    def set_subject_outputs(self, subject_id, outputs):
+        """Record the files written for both sides together, i.e. the merged HRTFs and SOFA files"""
+        self.subjects[str(subject_id)]['outputs'] = list(outputs)
+
+    def is_valid(self, subject_id, side):
+        return self.subjects[str(subject_id)]['sides'][side]['valid']
+
+    def get_outputs(self, subject_id, side):
+        return self.subjects[str(subject_id)]['sides'][side]['outputs']
+
+    def remove(self, subject_id):
+        """Forget a subject that is no longer in the dataset, deleting the files written for it"""
+        self._remove_outputs(self.subjects.pop(str(subject_id)))
+
+    @staticmethod
+    def _remove_outputs(entry, keep=()):
+        for output in sum((side['outputs'] for side in entry['sides'].values()), entry['outputs']):
+            if output not in keep and os.path.isfile(output):
+                os.remove(output)
+
+
+def get_subject_outputs(config, subject_id, split):
+    """Files that merge_files and gen_sofa_preprocess write for a subject, of which only those that exist are kept"""
+    hrtf_merge_dir = config.train_hrtf_merge_dir if split == 'train' else config.valid_hrtf_merge_dir
+    original_merge_dir = config.train_original_hrtf_merge_dir if split == 'train' \
+        else config.valid_original_hrtf_merge_dir
+    outputs = [f'{hrtf_merge_dir}/{config.dataset}_mag_{subject_id}.pickle',
+               f'{original_merge_dir}/{config.dataset}_mag_{subject_id}.pickle',
+               f'{original_merge_dir}/{config.dataset}_phase_{subject_id}.pickle',
+               f'{hrtf_merge_dir}/sofa_min_phase/{config.dataset}_{subject_id}.sofa',
+               f'{original_merge_dir}/sofa_min_phase/{config.dataset}_{subject_id}.sofa',
+               f'{original_merge_dir}/sofa_with_phase/{config.dataset}_{subject_id}.sofa']
+    outputs += [get_lr_pyramid_filename(outputs[0], upscale_factor)
+                for upscale_factor in get_lr_pyramid_factors(config.hrtf_size)]
+    return [output for output in outputs if os.path.isfile(output)]
+
+
+def assign_splits(manifest, subject_ids, train_samples_ratio):
+    """Assign each subject to 'train' or 'valid'. Subjects in the manifest keep their split, new subjects are split
+    such that the overall ratio stays close to train_samples_ratio. Without a manifest, this is the same random split
+    as a full preprocessing run"""
+    subject_ids = list(set(subject_ids))
+    if manifest.is_empty():
+        train_size = int(len(subject_ids) * train_samples_ratio)
+        train_sample = np.random.choice(subject_ids, train_size, replace=False)
+        return {subject_id: 'train' if subject_id in train_sample else 'valid' for subject_id in subject_ids}
+
+    splits = {subject_id: manifest.get_split(subject_id) for subject_id in subject_ids}
+    new_subject_ids = [subject_id for subject_id, split in splits.items() if split is None]
+    if len(new_subject_ids) > 0:
+        num_train = sum(split == 'train' for split in splits.values())
+        train_size = min(max(int(len(subject_ids) * train_samples_ratio) - num_train, 0), len(new_subject_ids))
+        train_sample = np.random.choice(new_subject_ids, train_size, replace=False)
+        for subject_id in new_subject_ids:
+            splits[subject_id] = 'train' if subject_id in train_sample else 'valid'
+    return splits
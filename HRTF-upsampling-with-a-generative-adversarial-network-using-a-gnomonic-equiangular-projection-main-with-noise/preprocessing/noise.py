@@ -0,0 +1,161 @@
+import math
+import pickle
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from preprocessing.lr_pyramid import write_lr_pyramid
+from preprocessing.storage import load_hrtf_file, save_hrtf_file, set_storage_policy
+from preprocessing.utils import pair_left_right_files
+from preprocessing.validity import ValidityManifest
+
+# exponent of the power law the power spectral density of each noise colour follows (1 / f^exponent), as in
+# colorednoise.powerlaw_psd_gaussian
+NOISE_COLOURS = {'white': 0, 'pink': 1, 'brown': 2}
+SIDES = ('left', 'right')
+
+
+def check_noise_colours(colours):
+    for colour in colours:
+        if colour not in NOISE_COLOURS:
+            raise ValueError(f'Unknown noise colour {colour}, must be one of {", ".join(NOISE_COLOURS)}')
+
+
+def get_noisy_folder(colour, snr_db, split):
+    """Folder of a noisy dataset below hr_merge_noisy, as passed to main.py as train_folder or validation_folder, e.g.
+    brown_noise_-10dB/brown_valid_-10dB"""
+    return f'{colour}_noise_{snr_db:g}dB/{colour}_{split}_{snr_db:g}dB'
+
+
+def get_noise_generator(seed, subject_id, side, colour, device='cpu'):
+    """Generator of the noise added to one ear of a subject, such that every subject gets the same noise however many
+    subjects, colours or SNRs are built together"""
+    entropy = [seed, int(subject_id), SIDES.index(side), list(NOISE_COLOURS).index(colour)]
+    return torch.Generator(device=device).manual_seed(int(np.random.SeedSequence(entropy).generate_state(1)[0]))
+
+
+def generate_coloured_noise(shape, exponent, generator=None, device=None, dtype=torch.float32):
+    """Gaussian noise of unit variance whose power spectral density along the last axis follows 1 / f^exponent (0 for
+    white, 1 for pink and 2 for brown noise), for a whole tensor at once by shaping a random spectrum and taking its
+    inverse FFT. Follows colorednoise.powerlaw_psd_gaussian, which generates the same noise one vector at a time"""
+    samples = shape[-1]
+    f = torch.fft.rfftfreq(samples, dtype=torch.float64)
+    # frequencies below the lowest one that fits in the samples are given its scale
+    f[0] = 1 / samples
+    scale = f ** (-exponent / 2.)
+
+    # standard deviation of the noise before it is normalised
+    w = scale[1:].clone()
+    w[-1] *= (1 + (samples % 2)) / 2.
+    sigma = float(2 * torch.sqrt(torch.sum(w ** 2)) / samples)
+
+    spectrum_shape = (*shape[:-1], len(f))
+    scale = scale.to(device=device, dtype=dtype)
+    real = torch.randn(spectrum_shape, generator=generator, device=device, dtype=dtype) * scale
+    imag = torch.randn(spectrum_shape, generator=generator, device=device, dtype=dtype) * scale
+    # the DC component (and the Nyquist component for an even number of samples) of a real signal is real
+    if samples % 2 == 0:
+        imag[..., -1] = 0
+        real[..., -1] *= math.sqrt(2)
+    imag[..., 0] = 0
+    real[..., 0] *= math.sqrt(2)
+
+    return torch.fft.irfft(torch.complex(real, imag), n=samples, dim=-1) / sigma
+
+
+def add_noise(hrir, noise, snr_db):
+    """Magnitudes of the HRTFs of HRIRs (..., samples) with noise added in the time domain at a signal-to-noise ratio
+    in dB, relative to the RMS of each HRIR. snr_db is a number, or a tensor whose shape broadcasts against the leading
+    dimensions (e.g. (num_snrs, 1, 1, 1, 1) to add noise at several SNRs at once)"""
+    hrir_rms = torch.sqrt(torch.mean(hrir ** 2, dim=-1, keepdim=True))
+    noise_rms = torch.sqrt(torch.mean(noise ** 2, dim=-1, keepdim=True))
+    snr_linear = 10 ** (torch.as_tensor(snr_db, dtype=hrir.dtype, device=hrir.device) / 20)
+    return torch.abs(torch.fft.rfft(hrir + noise * (hrir_rms / (noise_rms * snr_linear)), dim=-1))
+
+
+def build_noisy_subject(output_dirs, file_ext, subj_id, file_names, snrs_db, seed, lr_pyramid_size=None,
+                        storage_policy=None):
+    """Write the merged noisy HRTFs of one subject for every (colour, SNR) in output_dirs, from the magnitudes of the
+    clean HRTF of each ear. The noise of each ear and colour is generated once and scaled to every SNR. Returns
+    (output_dir, file name, HRTF as it was written) of every file"""
+    hrirs = {side: torch.fft.irfft(load_hrtf_file(file_names[side]).float(), dim=-1) for side in SIDES}
+    snrs = torch.tensor(snrs_db, dtype=torch.float).view(-1, 1, 1, 1, 1)
+
+    written = []
+    for colour in dict.fromkeys(colour for colour, _ in output_dirs):
+        # (num_snrs, panels, X, Y, nbins) for each ear, merged along the frequency bins
+        noisy_hrtfs = [add_noise(hrirs[side], generate_coloured_noise(
+            hrirs[side].shape, NOISE_COLOURS[colour], get_noise_generator(seed, subj_id, side, colour)), snrs)
+                       for side in SIDES]
+        noisy_hrtfs = torch.cat(noisy_hrtfs, dim=-1)
+
+        for snr_db, hrtf in zip(snrs_db, noisy_hrtfs):
+            # copied out of the tensor of every SNR, which would otherwise be pickled along with it
+            hrtf = hrtf.clone()
+            output_dir = output_dirs[(colour, snr_db)]
+            file_name = '%s/%s_%s.pickle' % (output_dir, file_ext, subj_id)
+            if storage_policy is not None:
+                stored_hrtf = save_hrtf_file(file_name, hrtf, storage_policy)
+            else:
+                stored_hrtf = hrtf
+                with open(file_name, "wb") as file:
+                    pickle.dump(stored_hrtf, file)
+            if lr_pyramid_size is not None:
+                write_lr_pyramid(file_name, hrtf, lr_pyramid_size, storage_policy)
+            written.append((output_dir, file_name, stored_hrtf))
+    return written
+
+
+def build_noisy_datasets(config, colours=None, snrs_db=None, num_workers=None):
+    """Write the noisy train and valid datasets of every combination of noise colour and SNR into the hr_merge_noisy
+    layout Config reads them from (see get_noisy_folder), from the clean HRTFs of each ear in train_hrtf_dir and
+    valid_hrtf_dir. Each subject is read once for all combinations, and subjects are built on num_workers threads.
+    Returns the directories written"""
+    colours = config.noise_colours if colours is None else colours
+    snrs_db = config.noise_snrs_db if snrs_db is None else snrs_db
+    num_workers = config.num_preprocess_workers if num_workers is None else num_workers
+    check_noise_colours(colours)
+    lr_pyramid_size = config.hrtf_size if config.gen_lr_pyramid_flag else None
+
+    jobs = []
+    validity_manifests = {}
+    for split, input_dir in (('train', config.train_hrtf_dir), ('valid', config.valid_hrtf_dir)):
+        output_dirs = {(colour, snr_db): f'{config.noisy_hrtf_merge_dir}/{get_noisy_folder(colour, snr_db, split)}'
+                       for colour in colours for snr_db in snrs_db}
+        for output_dir in output_dirs.values():
+            # Clear/Create directory
+            shutil.rmtree(Path(output_dir), ignore_errors=True)
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
+            set_storage_policy(output_dir, config.hrtf_storage_policy)
+            validity_manifests[output_dir] = ValidityManifest(output_dir)
+
+        pairs = pair_left_right_files(input_dir)
+        missing_subj_ids = sorted({subj_id for (_, subj_id), file_names in pairs.items() if len(file_names) < 2})
+        if len(missing_subj_ids) > 0:
+            print('Excluding subject IDs where both ears do not exist (IDs: %s)' % ', '.join(map(str, missing_subj_ids)))
+        jobs += [(output_dirs, file_ext, subj_id, file_names) for (file_ext, subj_id), file_names in sorted(pairs.items())
+                 if len(file_names) == 2]
+
+    def record(written):
+        # the manifests are only updated from this thread
+        for output_dir, file_name, stored_hrtf in written:
+            validity_manifests[output_dir].record(file_name, stored_hrtf)
+
+    print(f'Building {len(colours) * len(snrs_db)} noisy datasets from {len(jobs)} subjects')
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        pending = deque()
+        for output_dirs, file_ext, subj_id, file_names in jobs:
+            pending.append(executor.submit(build_noisy_subject, output_dirs, file_ext, subj_id, file_names, snrs_db,
+                                           config.noise_seed, lr_pyramid_size, config.hrtf_storage_policy))
+            if len(pending) >= 2 * num_workers:
+                record(pending.popleft().result())
+        while len(pending) > 0:
+            record(pending.popleft().result())
+
+    for validity_manifest in validity_manifests.values():
+        validity_manifest.save()
+    return list(validity_manifests)
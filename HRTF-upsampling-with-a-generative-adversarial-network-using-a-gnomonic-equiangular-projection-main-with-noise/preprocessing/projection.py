@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse
+
+from preprocessing.barycentric_calcs import SphericalTriangulation
+
+PI_4 = np.pi / 4
+
+PROJECTION_FORMAT = 'cubed_sphere_projection'
+PROJECTION_FORMAT_VERSION = 1
+# how the triangle of each point was found, stored in header.json along with the format version: 1 takes the enclosing
+# triangle of minimal total distance (legacy pickles and projections without a triangulation field), 2 uses a spherical
+# Delaunay triangulation (see SphericalTriangulation), which picks other triangles wherever measured points are
+# cocircular, e.g. in the quads of a regular grid
+PROJECTION_TRIANGULATION_VERSION = 2
+
+# name, dtype and number of columns of every array stored in a projection directory
+PROJECTION_ARRAYS = (('cube', np.float64, 3),
+                     ('sphere', np.float64, 2),
+                     ('measured_coords', np.float64, 2),
+                     ('vertices', np.int32, 3),
+                     ('coeffs', np.float32, 3),
+                     ('cube_indices', np.int32, 3))
+
+
+def get_projection_filename(config):
+    """Location of the legacy pickled projection file"""
+    return f'{config.projection_dir}/{config.dataset}_projection_{config.hrtf_size}'
+
+
+def get_projection_dir(config):
+    """Location of the projection directory, holding a header.json and one .npy file per array"""
+    return get_projection_filename(config) + '.proj'
+
+
+def get_projection_paths(config):
+    """Every location the projection may be loaded from (see load_projection)"""
+    return [get_projection_dir(config), get_projection_filename(config)]
+
+
+def calc_cube_indices(cube, edge_len):
+    """Based on cube coordinates (panel, x, y), get indices (panel, j, k) of each point in a (5, edge_len, edge_len)
+    array, returned as three integer arrays"""
+    cube = np.array(cube, dtype=float).reshape(-1, 3)
+    panels = cube[:, 0].astype(int) - 1
+    j = np.round(edge_len * (cube[:, 1] - (PI_4 / edge_len) + PI_4) / (np.pi / 2)).astype(int)
+    k = np.round(edge_len * (cube[:, 2] - (PI_4 / edge_len) + PI_4) / (np.pi / 2)).astype(int)
+    return panels, j, k
+
+
+class Projection(object):
+    """Barycentric projection from a set of measured positions onto the points of a euclidean cubed sphere, stored as
+    arrays with one row per cubed sphere point:
+
+    cube: (panel, x, y) of each point
+    sphere: (elevation, azimuth) of each point
+    vertices: indices into measured_coords of the (up to) three triangle vertices used to interpolate each point,
+              padded with -1 when a point is interpolated from fewer vertices
+    coeffs: barycentric coefficients (alpha, beta, gamma) matching vertices
+    cube_indices: (panel, j, k) position of each point in a (5, edge_len, edge_len) array
+
+    measured_coords holds the (elevation, azimuth) of the measured positions used as vertices, and triangulation the
+    version of the way the triangles were found (see PROJECTION_TRIANGULATION_VERSION).
+    """
+
+    def __init__(self, edge_len, cube, sphere, measured_coords, vertices, coeffs, cube_indices=None,
+                 triangulation=PROJECTION_TRIANGULATION_VERSION):
+        self.edge_len = edge_len
+        self.triangulation = triangulation
+        self.cube = cube
+        self.sphere = sphere
+        self.measured_coords = measured_coords
+        self.vertices = vertices
+        self.coeffs = coeffs
+        if cube_indices is None:
+            cube_indices = np.stack(calc_cube_indices(cube, edge_len), axis=1).astype(np.int32)
+        self.cube_indices = cube_indices
+        self._legacy = None
+
+    @classmethod
+    def from_measured_coords(cls, edge_len, cube_coords, sphere_coords, measured_coords):
+        """Find the triangle and barycentric coefficients of every point in sphere_coords, using the measured
+        positions as vertices"""
+        triangulation = SphericalTriangulation(measured_coords)
+        sphere = np.array(sphere_coords, dtype=np.float64).reshape(-1, 2)
+        vertices, coeffs = triangulation.find_triangles(sphere[:, 0], sphere[:, 1])
+        return cls(edge_len, np.array(cube_coords, dtype=np.float64).reshape(-1, 3), sphere,
+                   np.array(triangulation.sphere_coords, dtype=np.float64).reshape(-1, 2),
+                   vertices.astype(np.int32), coeffs.astype(np.float32))
+
+    @classmethod
+    def from_legacy(cls, edge_len, cube_coords, sphere_coords, sphere_triangles, sphere_coeffs):
+        """Convert the lists stored in a legacy projection pickle"""
+        vertex_index = {}
+        vertices = np.full((len(sphere_triangles), 3), -1, dtype=np.int32)
+        coeffs = np.zeros((len(sphere_triangles), 3), dtype=np.float32)
+        for i, (triangle, point_coeffs) in enumerate(zip(sphere_triangles, sphere_coeffs)):
+            if len(triangle) == 3:
+                coeffs[i] = (point_coeffs["alpha"], point_coeffs["beta"], point_coeffs["gamma"])
+            else:
+                triangle, coeffs[i, 0] = triangle[:1], 1.
+            for j, vertex in enumerate(triangle):
+                vertices[i, j] = vertex_index.setdefault((vertex[0], vertex[1]), len(vertex_index))
+
+        return cls(edge_len, np.array(cube_coords, dtype=np.float64).reshape(-1, 3),
+                   np.array(sphere_coords, dtype=np.float64).reshape(-1, 2),
+                   np.array(list(vertex_index), dtype=np.float64).reshape(-1, 2), vertices, coeffs, triangulation=1)
+
+    def save(self, path):
+        """Save as a directory of .npy files, which are memory-mapped when loaded, along with a header.json describing
+        them"""
+        header = {'format': PROJECTION_FORMAT, 'version': PROJECTION_FORMAT_VERSION, 'edge_len': self.edge_len,
+                  'triangulation': self.triangulation, 'arrays': {}}
+        tmp_path = str(path) + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        Path(tmp_path).mkdir(parents=True)
+        for name, dtype, num_columns in PROJECTION_ARRAYS:
+            array = np.ascontiguousarray(getattr(self, name), dtype=dtype).reshape(-1, num_columns)
+            np.save(f'{tmp_path}/{name}.npy', array)
+            header['arrays'][name] = {'dtype': np.dtype(dtype).str, 'shape': list(array.shape)}
+        with open(f'{tmp_path}/header.json', 'w') as file:
+            json.dump(header, file, indent=2)
+
+        # swap in the complete directory, so that readers never see a partially written projection
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(f'{path}/header.json') as file:
+            header = json.load(file)
+        if header.get('format') != PROJECTION_FORMAT:
+            raise ValueError(f'{path} is not a projection directory')
+        if header['version'] > PROJECTION_FORMAT_VERSION:
+            raise ValueError(f'Projection format version {header["version"]} of {path} is newer than the supported '
+                             f'version {PROJECTION_FORMAT_VERSION}')
+
+        arrays = {}
+        for name, dtype, _ in PROJECTION_ARRAYS:
+            arrays[name] = np.load(f'{path}/{name}.npy', mmap_mode=mmap_mode)
+            expected = header['arrays'][name]
+            if arrays[name].dtype.str != expected['dtype'] or list(arrays[name].shape) != expected['shape']:
+                raise ValueError(f'{path}/{name}.npy does not match header.json')
+        return cls(header['edge_len'], triangulation=header.get('triangulation', 1), **arrays)
+
+    def get_hash(self):
+        """Hash of the projection's contents, which identifies it regardless of the format it was loaded from"""
+        projection_hash = hashlib.sha256(str(self.edge_len).encode())
+        for name, dtype, num_columns in PROJECTION_ARRAYS:
+            projection_hash.update(np.ascontiguousarray(getattr(self, name), dtype=dtype).tobytes())
+        return projection_hash.hexdigest()
+
+    def get_cube_indices(self):
+        """(panel, j, k) index arrays, in the form used to index a (5, edge_len, edge_len, ...) array"""
+        return tuple(np.asarray(self.cube_indices[:, i], dtype=np.intp) for i in range(3))
+
+    def get_interpolation_matrix(self, cs):
+        """Sparse matrix of shape (number of cubed sphere points, number of points in cs), see
+        calc_interpolation_matrix in preprocessing.utils"""
+        point_index = {}
+        for index in np.flatnonzero(cs.valid):
+            point_index.setdefault(tuple(cs.sphere_array[index].tolist()), index)
+        vertex_columns = np.array([point_index[coords] for coords in map(tuple, np.asarray(self.measured_coords)
+                                                                         .tolist())], dtype=int)
+
+        vertices = np.asarray(self.vertices)
+        used = vertices >= 0
+        rows = np.broadcast_to(np.arange(len(vertices))[:, np.newaxis], vertices.shape)[used]
+        columns = vertex_columns[vertices[used]]
+        return scipy.sparse.csr_matrix((np.asarray(self.coeffs)[used], (rows, columns)),
+                                       shape=(len(vertices), len(cs.sphere_array)))
+
+    def as_legacy(self):
+        """Lists in the form of the legacy projection pickle: (cube_coords, sphere_coords, sphere_triangles,
+        sphere_coeffs)"""
+        if self._legacy is None:
+            measured_coords = list(map(tuple, np.asarray(self.measured_coords).tolist()))
+            sphere_triangles, sphere_coeffs = [], []
+            for point_vertices, point_coeffs in zip(np.asarray(self.vertices).tolist(), np.asarray(self.coeffs)):
+                sphere_triangles.append([measured_coords[v] for v in point_vertices if v >= 0])
+                if point_vertices[-1] >= 0:
+                    sphere_coeffs.append({"alpha": point_coeffs[0], "beta": point_coeffs[1],
+                                          "gamma": point_coeffs[2]})
+                else:
+                    sphere_coeffs.append({"alpha": None, "beta": None, "gamma": None})
+            cube_coords = [(int(panel), x, y) for panel, x, y in np.asarray(self.cube).tolist()]
+            sphere_coords = list(map(tuple, np.asarray(self.sphere).tolist()))
+            self._legacy = (cube_coords, sphere_coords, sphere_triangles, sphere_coeffs)
+        return self._legacy
+
+
+def load_projection(config, mmap_mode='r'):
+    """Load the projection generated for config.dataset and config.hrtf_size, falling back to the legacy pickle if
+    the projection has not been regenerated since. Projections whose triangles were found by an earlier triangulation
+    are still loaded, with a warning"""
+    if os.path.isdir(get_projection_dir(config)):
+        projection = Projection.load(get_projection_dir(config), mmap_mode=mmap_mode)
+    else:
+        with open(get_projection_filename(config), "rb") as file:
+            cube_coords, sphere_coords, sphere_triangles, sphere_coeffs = pickle.load(file)
+        projection = Projection.from_legacy(config.hrtf_size, cube_coords, sphere_coords, sphere_triangles,
+                                            sphere_coeffs)
+
+    if projection.triangulation < PROJECTION_TRIANGULATION_VERSION:
+        print(f'Warning: the projection for {config.dataset} (size {config.hrtf_size}) was generated with the '
+              f'triangles of minimal distance rather than the Delaunay triangulation, run main.py in '
+              f'generate_projection mode to regenerate it')
+    return projection
@@ -0,0 +1,55 @@
+import numpy as np
+import torch
+
+
+class RunningStats(object):
+    """Streaming statistics of a set of HRTFs: per frequency bin mean and variance (Welford's algorithm, with partial
+    results combined as in Chan et al.) along with the overall minimum and maximum.
+
+    HRTFs can be added one at a time, and accumulators built from different subsets of the data (e.g. by different
+    worker processes) can be merged, so the whole set never has to be held in memory
+
+    :param nbins: Number of frequency bins, i.e. the size of the last dimension of every HRTF
+    """
+
+    def __init__(self, nbins):
+        self.count = 0
+        self.mean = np.zeros(nbins)
+        self.m2 = np.zeros(nbins)
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, hrtf):
+        """Add every position of an HRTF (any shape, with frequency bins along the last axis)"""
+        values = np.asarray(hrtf, dtype=np.float64).reshape(-1, len(self.mean))
+        if len(values) == 0:
+            return self
+
+        batch = RunningStats(len(self.mean))
+        batch.count = len(values)
+        batch.mean = np.mean(values, axis=0)
+        batch.m2 = np.sum((values - batch.mean) ** 2, axis=0)
+        batch.min = np.min(values)
+        batch.max = np.max(values)
+        return self.merge(batch)
+
+    def merge(self, other):
+        """Combine the statistics of other into this accumulator"""
+        if other.count == 0:
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def get_stats(self):
+        """Returns (mean, std, min, max) as float tensors, matching torch.mean/torch.std (unbiased) over all positions
+        and torch.min/torch.max over all values"""
+        std = np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.full_like(self.m2, np.nan)
+        return (torch.tensor(self.mean, dtype=torch.float), torch.tensor(std, dtype=torch.float),
+                torch.tensor(self.min, dtype=torch.float), torch.tensor(self.max, dtype=torch.float))
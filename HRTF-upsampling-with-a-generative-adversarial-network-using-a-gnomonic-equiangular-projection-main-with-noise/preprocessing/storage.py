@@ -0,0 +1,95 @@
+import json
+import os
+import pickle
+from pathlib import Path
+
+import torch
+
+# how HRTF magnitudes on the cubed sphere are stored on disk: as magnitudes in a given dtype, or as the natural log of
+# the magnitudes (log_*), which keeps the relative precision of small magnitudes in reduced precision dtypes
+STORAGE_POLICIES = {'float64': (torch.float64, False),
+                    'float32': (torch.float32, False),
+                    'float16': (torch.float16, False),
+                    'bfloat16': (torch.bfloat16, False),
+                    'log_float16': (torch.float16, True),
+                    'log_bfloat16': (torch.bfloat16, True)}
+
+# magnitudes are clamped to this value before taking the log, such that zeros are stored as a finite value
+MIN_LOG_MAGNITUDE = 1e-7
+
+# policies of the directories read by load_hrtf_file, along with the modification time of their policy file
+_storage_policies = {}
+
+
+def get_storage_policy_filename(hrtf_dir):
+    """The policy of a directory of pickled HRTFs is kept in a subdirectory, where it is ignored by everything that
+    only lists the files of the directory"""
+    return f'{hrtf_dir}/storage/policy.json'
+
+
+def check_storage_policy(policy):
+    if policy not in STORAGE_POLICIES:
+        raise ValueError(f'Unknown HRTF storage policy {policy}, must be one of {", ".join(STORAGE_POLICIES)}')
+
+
+def set_storage_policy(hrtf_dir, policy):
+    """Record the policy the HRTFs in a directory are written with, which load_hrtf_file needs to decode them"""
+    check_storage_policy(policy)
+    filename = get_storage_policy_filename(hrtf_dir)
+    if get_storage_policy(hrtf_dir) == policy:
+        return
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'w') as file:
+        json.dump({'policy': policy}, file)
+    os.replace(tmp_filename, filename)
+
+
+def get_storage_policy(hrtf_dir):
+    """Policy recorded for a directory, None for directories written before policies were recorded (or that are not
+    written by preprocessing), whose HRTFs are read as they are"""
+    filename = get_storage_policy_filename(hrtf_dir)
+    try:
+        mtime = os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _storage_policies.get(filename, (None, None))[0] != mtime:
+        with open(filename) as file:
+            _storage_policies[filename] = (mtime, json.load(file)['policy'])
+    return _storage_policies[filename][1]
+
+
+def encode_hrtf(hrtf, policy):
+    """HRTF magnitudes as they are stored with a policy"""
+    check_storage_policy(policy)
+    dtype, log_magnitudes = STORAGE_POLICIES[policy]
+    hrtf = torch.as_tensor(hrtf)
+    if log_magnitudes:
+        hrtf = torch.log(hrtf.double().clamp_min(MIN_LOG_MAGNITUDE))
+    return hrtf.to(dtype)
+
+
+def decode_hrtf(hrtf, policy=None):
+    """HRTF magnitudes from the way they are stored with a policy, upcast to float32 if they are stored in reduced
+    precision. HRTFs stored as float32 or float64 keep their dtype"""
+    hrtf = torch.as_tensor(hrtf)
+    log_magnitudes = policy is not None and STORAGE_POLICIES[policy][1]
+    if hrtf.dtype in (torch.float16, torch.bfloat16):
+        hrtf = hrtf.float()
+    return torch.exp(hrtf) if log_magnitudes else hrtf
+
+
+def save_hrtf_file(file_name, hrtf, policy):
+    """Pickle an HRTF with a policy, which must also be recorded for its directory (see set_storage_policy). Returns the
+    HRTF as stored"""
+    hrtf = encode_hrtf(hrtf, policy)
+    with open(file_name, "wb") as file:
+        pickle.dump(hrtf, file)
+    return hrtf
+
+
+def load_hrtf_file(file_name):
+    """Unpickle an HRTF, decoding it with the policy of its directory"""
+    with open(file_name, "rb") as file:
+        hrtf = pickle.load(file)
+    return decode_hrtf(hrtf, get_storage_policy(os.path.dirname(file_name)))
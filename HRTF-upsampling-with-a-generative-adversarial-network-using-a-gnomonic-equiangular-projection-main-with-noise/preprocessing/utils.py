@@ -1,4 +1,3 @@
-import cmath
 import pickle
 import os
 
@@ -6,16 +5,25 @@ import sofar as sf
 import numpy as np
 import torch
 import scipy
+import scipy.sparse
 from scipy.signal import hilbert
 import scipy.signal as sps
 import shutil
 from pathlib import Path
 import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
-from preprocessing.barycentric_calcs import calc_barycentric_coordinates, get_triangle_vertices
-from preprocessing.convert_coordinates import convert_cube_to_sphere
-from preprocessing.KalmanFilter import KalmanFilter
+from preprocessing.barycentric_calcs import SphericalTriangulation
+from preprocessing.convert_coordinates import convert_cube_to_sphere_array
+from preprocessing.KalmanFilter import KalmanFilter, calc_kalman_gains
+from preprocessing.projection import Projection, calc_cube_indices, get_projection_dir
+from preprocessing.hrtf_store import HRTFStore, get_store_dir, get_file_fingerprint
+from preprocessing.validity import ValidityManifest
+from preprocessing.lr_pyramid import write_lr_pyramid
+from preprocessing.storage import set_storage_policy, save_hrtf_file, load_hrtf_file, decode_hrtf, \
+    get_storage_policy
 
 PI_4 = np.pi / 4
 
@@ -32,76 +40,127 @@ def clear_create_directories(config):
     Path(config.valid_original_hrtf_dir).mkdir(parents=True, exist_ok=True)
 
 
-def merge_left_right_hrtfs(input_dir, output_dir):
+def pair_left_right_files(input_dir, subject_ids=None):
+    """Pair the left and right ear files in input_dir from a single listing, as {(file_ext, subject_id): {side: path}},
+    where file_ext is the part of the name before the subject id (e.g. Sonicom_mag)"""
+    pairs = {}
+    for file_name in os.listdir(input_dir):
+        match = re.match(r'^(.*)_([0-9]+)(left|right)\.pickle$', file_name)
+        if match is None or not os.path.isfile(os.path.join(input_dir, file_name)):
+            continue
+        file_ext, subj_id, side = match.group(1), int(match.group(2)), match.group(3)
+        if subject_ids is None or subj_id in subject_ids:
+            pairs.setdefault((file_ext, subj_id), {})[side] = os.path.join(input_dir, file_name)
+    return pairs
+
+
+def merge_left_right_pair(output_dir, file_ext, subj_id, file_names, lr_pyramid_size=None, storage_policy=None):
+    """Merge the left and right ear files of one subject, returning the merged file name and the HRTF as it was
+    written"""
+    hrtf_l = load_hrtf_file(file_names['left'])
+    hrtf_r = load_hrtf_file(file_names['right'])
+    hrtf_merged = torch.cat((hrtf_l, hrtf_r), dim=hrtf_r.ndim - 1)
+
+    merged_file_name = '%s/%s_%s.pickle' % (output_dir, file_ext, subj_id)
+    if storage_policy is not None:
+        stored_hrtf = save_hrtf_file(merged_file_name, hrtf_merged, storage_policy)
+    else:
+        stored_hrtf = hrtf_merged
+        with open(merged_file_name, "wb") as file:
+            pickle.dump(hrtf_merged, file)
+    if lr_pyramid_size is not None and '_phase' not in file_ext:
+        write_lr_pyramid(merged_file_name, hrtf_merged, lr_pyramid_size, storage_policy)
+    return merged_file_name, stored_hrtf
+
+
+def merge_left_right_hrtfs(input_dir, output_dir, subject_ids=None, use_store=False, lr_pyramid_size=None,
+                           storage_policy=None, num_workers=4):
+    """Merge the left and right ear files of every subject in input_dir. If subject_ids is given, only those subjects
+    are merged and the other files in output_dir are kept. If use_store, the merged HRTFs are also written to the
+    HRTF store of output_dir. If lr_pyramid_size is given, the low resolution HRTFs of the merged magnitudes are
+    written as well (see preprocessing.lr_pyramid). If storage_policy is given, the merged HRTFs are written with it
+    (see preprocessing.storage), otherwise they keep the dtype of the input files.
+
+    Pairs are merged on num_workers threads and written as soon as they are merged, such that at most a few pairs per
+    worker are held in memory"""
     # Clear/Create directory
-    shutil.rmtree(Path(output_dir), ignore_errors=True)
+    if subject_ids is None:
+        shutil.rmtree(Path(output_dir), ignore_errors=True)
+    else:
+        subject_ids = set(map(int, subject_ids))
     Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-    hrtf_file_names = [os.path.join(input_dir, hrtf_file_name) for hrtf_file_name in os.listdir(input_dir)
-                       if os.path.isfile(os.path.join(input_dir, hrtf_file_name))]
+    pairs = pair_left_right_files(input_dir, subject_ids)
+    missing_subj_ids = sorted({subj_id for (_, subj_id), file_names in pairs.items() if len(file_names) < 2})
+    if len(missing_subj_ids) > 0:
+        print('Excluding subject IDs where both ears do not exist (IDs: %s)' % ', '.join(map(str, missing_subj_ids)))
+
+    if use_store:
+        store = HRTFStore(get_store_dir(output_dir))
+    if storage_policy is not None:
+        set_storage_policy(output_dir, storage_policy)
+    validity_manifest = ValidityManifest(output_dir)
+
+    def record(merged_file_name, stored_hrtf):
+        # the manifest and store are only updated from this thread
+        validity_manifest.record(merged_file_name, stored_hrtf)
+        if use_store and '_phase' not in os.path.basename(merged_file_name):
+            store.append(os.path.basename(merged_file_name), stored_hrtf, get_file_fingerprint(merged_file_name))
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        pending = deque()
+        for (file_ext, subj_id), file_names in sorted(pairs.items()):
+            if len(file_names) < 2:
+                continue
+            pending.append(executor.submit(merge_left_right_pair, output_dir, file_ext, subj_id, file_names,
+                                           lr_pyramid_size, storage_policy))
+            if len(pending) >= 2 * num_workers:
+                record(*pending.popleft().result())
+        while len(pending) > 0:
+            record(*pending.popleft().result())
+
+    validity_manifest.save()
+
+
+def merge_files(config, subject_ids=None):
+    # the store, low resolution pyramids and storage policy only apply to the HRTFs on the cubed sphere, the original
+    # HRTFs are stored per measured position and kept at full precision for the SOFA files
+    lr_pyramid_size = config.hrtf_size if config.gen_lr_pyramid_flag else None
+    passes = [(config.train_hrtf_dir, config.train_hrtf_merge_dir, subject_ids, config.use_hrtf_store,
+               lr_pyramid_size, config.hrtf_storage_policy),
+              (config.valid_hrtf_dir, config.valid_hrtf_merge_dir, subject_ids, config.use_hrtf_store,
+               lr_pyramid_size, config.hrtf_storage_policy),
+              (config.train_original_hrtf_dir, config.train_original_hrtf_merge_dir, subject_ids),
+              (config.valid_original_hrtf_dir, config.valid_original_hrtf_merge_dir, subject_ids)]
+
+    # the four passes write to different directories, so they run concurrently, sharing the merge workers
+    num_workers = max(1, config.num_preprocess_workers // len(passes))
+    with ThreadPoolExecutor(max_workers=len(passes)) as executor:
+        futures = [executor.submit(merge_left_right_hrtfs, *merge_pass, num_workers=num_workers)
+                   for merge_pass in passes]
+        for future in futures:
+            future.result()
 
-    data_dict_left = {}
-    data_dict_right = {}
-    for f in hrtf_file_names:
 
-        file_ext = re.findall(re.escape(input_dir) + '/(.*)_[0-9]*[a-z]*.pickle$', f)[0]
-
-        with open(f, "rb") as file:
-            data = pickle.load(file)
-
-        # add to dict for right ears
-        if re.search(re.escape(input_dir)+'/.*_[0-9]*right.pickle$', f):
-            subj_id = int(re.findall(re.escape(input_dir)+'/.*_([0-9]*)right.pickle$', f)[0])
-            if file_ext not in data_dict_right:
-                data_dict_right[file_ext] = {}
-            data_dict_right[file_ext][subj_id] = data
-        # add to dict for left ears
-        elif re.search(re.escape(input_dir)+'/.*_[0-9]*left.pickle$', f):
-            subj_id = int(re.findall(re.escape(input_dir)+'/.*_([0-9]*)left.pickle$', f)[0])
-            if file_ext not in data_dict_left:
-                data_dict_left[file_ext] = {}
-            data_dict_left[file_ext][subj_id] = data
-
-    for file_ext in data_dict_right.keys():
-        missing_subj_ids =  list(set(data_dict_right[file_ext].keys()) - set(data_dict_left[file_ext].keys()))
-        if len(missing_subj_ids) > 0:
-            print('Excluding subject IDs where both ears do not exist (IDs: %s)' % ', '.join(map(str, missing_subj_ids)))
-            for missing_subj_id in missing_subj_ids:
-                data_dict_right[file_ext].pop(missing_subj_id, None)
-                data_dict_left[file_ext].pop(missing_subj_id, None)
-
-        for subj_id in data_dict_right[file_ext].keys():
-            hrtf_r = data_dict_right[file_ext][subj_id]
-            hrtf_l = data_dict_left[file_ext][subj_id]
-            dimension = hrtf_r.ndim-1
-            hrtf_merged = torch.cat((hrtf_l, hrtf_r), dim=dimension)
-            with open('%s/%s_%s.pickle' % (output_dir, file_ext, subj_id), "wb") as file:
-                pickle.dump(hrtf_merged, file)
-
-
-def merge_files(config):
-    merge_left_right_hrtfs(config.train_hrtf_dir, config.train_hrtf_merge_dir)
-    merge_left_right_hrtfs(config.valid_hrtf_dir, config.valid_hrtf_merge_dir)
-    merge_left_right_hrtfs(config.train_original_hrtf_dir, config.train_original_hrtf_merge_dir)
-    merge_left_right_hrtfs(config.valid_original_hrtf_dir, config.valid_original_hrtf_merge_dir)
+def get_hrtf_from_ds(config, ds, index):
+    return get_hrtf_from_features(config, ds[index]['features'], ds.row_angles, ds.column_angles)
 
 
-def get_hrtf_from_ds(config, ds, index):
-    coordinates = ds.row_angles, ds.column_angles
+def get_hrtf_from_features(config, features, row_angles, column_angles):
+    """Compute the HRTF (magnitude and phase) at every measured position of a subject, given their decoded features
+    (ds[index]['features'] from hrtfdata), along with the positions as a list of [elevation, azimuth]"""
+    coordinates = row_angles, column_angles
     position_grid = np.stack(np.meshgrid(*coordinates, indexing='ij'), axis=-1)
 
-    sphere_temp = []
-    hrir_temp = []
-    for row_idx, row in enumerate(ds.row_angles):
-        for column_idx, column in enumerate(ds.column_angles):
-            if not any(np.ma.getmaskarray(ds[index]['features'][row_idx][column_idx].flatten())):
-                az_temp = np.radians(position_grid[row_idx][column_idx][0])
-                el_temp = np.radians(position_grid[row_idx][column_idx][1])
-                sphere_temp.append([el_temp, az_temp])
-                hrir_temp.append(np.ma.getdata(ds[index]['features'][row_idx][column_idx]).flatten())
-    hrtf_temp, phase_temp = calc_hrtf(config, hrir_temp)
+    grid_shape = (len(row_angles), len(column_angles))
+    masked = np.ma.getmaskarray(features).reshape(*grid_shape, -1).any(axis=-1)
 
-    return torch.tensor(np.array(hrtf_temp)), torch.tensor(np.array(phase_temp)), sphere_temp
+    # positions are kept in the same (row, column) order as looping over row_angles then column_angles
+    positions = np.radians(position_grid[~masked])
+    sphere_temp = [[el_temp, az_temp] for az_temp, el_temp in positions]
+    hrir_temp = np.ma.getdata(features).reshape(*grid_shape, -1)[~masked]
+
+    return (*calc_hrtf(config, hrir_temp, as_tensor=True), sphere_temp)
 
 
 def add_itd(az, el, hrir, side, fs=48000, r=0.0875, c=343):
@@ -150,7 +209,7 @@ def gen_sofa_file(config, sphere_coords, left_hrtf, right_hrtf, count, left_phas
     return source_position, full_hrir, delay
 
 
-def save_sofa(clean_hrtf, config, cube_coords, sphere_coords, sofa_path_output, phase=None):
+def save_sofa(clean_hrtf, config, cube_coords, sphere_coords, sofa_path_output, phase=None, cube_indices=None):
     full_hrirs = []
     source_positions = []
     delays = []
@@ -183,13 +242,12 @@ def save_sofa(clean_hrtf, config, cube_coords, sphere_coords, sofa_path_output,
         left_full_hrtf = clean_hrtf[:, :, :, :config.nbins_hrtf]
         right_full_hrtf = clean_hrtf[:, :, :, config.nbins_hrtf:]
 
-        count = 0
-        for panel, x, y in cube_coords:
-            # based on cube coordinates, get indices for magnitudes list of lists
-            i = panel - 1
-            j = round(config.hrtf_size * (x - (PI_4 / config.hrtf_size) + PI_4) / (np.pi / 2))
-            k = round(config.hrtf_size * (y - (PI_4 / config.hrtf_size) + PI_4) / (np.pi / 2))
+        # based on cube coordinates, get indices for magnitudes list of lists (unless already given by the projection)
+        if cube_indices is None:
+            cube_indices = calc_cube_indices(cube_coords, config.hrtf_size)
 
+        count = 0
+        for i, j, k in zip(*cube_indices):
             left_hrtf = np.array(left_full_hrtf[i, j, k])
             right_hrtf = np.array(right_full_hrtf[i, j, k])
             source_position, full_hrir, delay = gen_sofa_file(config, sphere_coords, left_hrtf, right_hrtf, count)
@@ -206,7 +264,10 @@ def save_sofa(clean_hrtf, config, cube_coords, sphere_coords, sofa_path_output,
     sf.write_sofa(sofa_path_output, sofa)
 
 
-def convert_to_sofa(hrtf_dir, config, cube, sphere, phase_ext='_phase', use_phase=False, mag_ext='_mag'):
+def convert_to_sofa(hrtf_dir, config, cube, sphere, phase_ext='_phase', use_phase=False, mag_ext='_mag',
+                    cube_indices=None, subject_ids=None):
+    """Convert every HRTF in hrtf_dir to a SOFA file. If subject_ids is given, only those subjects are converted and
+    the other SOFA files are kept"""
     if use_phase:
         sofa_path_output = hrtf_dir + '/sofa_with_phase/'
     else:
@@ -217,13 +278,19 @@ def convert_to_sofa(hrtf_dir, config, cube, sphere, phase_ext='_phase', use_phas
     phase_file_names = [phase_file_name for phase_file_name in os.listdir(hrtf_dir)
                         if os.path.isfile(os.path.join(hrtf_dir, phase_file_name)) and phase_ext in phase_file_name]
 
+    if subject_ids is not None:
+        subject_ids = set(map(int, subject_ids))
+        hrtf_file_names = [hrtf_file_name for hrtf_file_name in hrtf_file_names
+                           if int(re.findall('_([0-9]*).pickle$', hrtf_file_name)[0]) in subject_ids]
+
     # Clear/Create directories
-    shutil.rmtree(Path(sofa_path_output), ignore_errors=True)
+    if subject_ids is None:
+        shutil.rmtree(Path(sofa_path_output), ignore_errors=True)
     Path(sofa_path_output).mkdir(parents=True, exist_ok=True)
 
     for f in hrtf_file_names:
         with open(os.path.join(hrtf_dir, f), "rb") as hrtf_file:
-            hrtf = pickle.load(hrtf_file)
+            hrtf = decode_hrtf(pickle.load(hrtf_file), get_storage_policy(hrtf_dir))
             sofa_filename_output = os.path.basename(hrtf_file.name).replace('.pickle', '.sofa').replace(mag_ext,'')
             sofa_output = sofa_path_output + sofa_filename_output
 
@@ -233,57 +300,72 @@ def convert_to_sofa(hrtf_dir, config, cube, sphere, phase_ext='_phase', use_phas
                     if f_phase == f:
                         with open(os.path.join(hrtf_dir, f), "rb") as phase_file:
                             phase = pickle.load(phase_file)
-                            save_sofa(hrtf, config, cube, sphere, sofa_output, phase)
+                            save_sofa(hrtf, config, cube, sphere, sofa_output, phase, cube_indices=cube_indices)
             else:
-                save_sofa(hrtf, config, cube, sphere, sofa_output)
+                save_sofa(hrtf, config, cube, sphere, sofa_output, cube_indices=cube_indices)
 
 
-def gen_sofa_preprocess(config, cube, sphere, sphere_original):
-    convert_to_sofa(config.train_hrtf_merge_dir, config, cube, sphere)
-    convert_to_sofa(config.valid_hrtf_merge_dir, config, cube, sphere)
-    convert_to_sofa(config.train_original_hrtf_merge_dir, config, cube=None, sphere=sphere_original)
-    convert_to_sofa(config.valid_original_hrtf_merge_dir, config, cube=None, sphere=sphere_original)
-    convert_to_sofa(config.train_original_hrtf_merge_dir, config, use_phase=True, cube=None, sphere=sphere_original)
-    convert_to_sofa(config.valid_original_hrtf_merge_dir, config, use_phase=True, cube=None, sphere=sphere_original)
+def gen_sofa_preprocess(config, cube, sphere, sphere_original, cube_indices=None, subject_ids=None):
+    convert_to_sofa(config.train_hrtf_merge_dir, config, cube, sphere, cube_indices=cube_indices,
+                    subject_ids=subject_ids)
+    convert_to_sofa(config.valid_hrtf_merge_dir, config, cube, sphere, cube_indices=cube_indices,
+                    subject_ids=subject_ids)
+    convert_to_sofa(config.train_original_hrtf_merge_dir, config, cube=None, sphere=sphere_original,
+                    subject_ids=subject_ids)
+    convert_to_sofa(config.valid_original_hrtf_merge_dir, config, cube=None, sphere=sphere_original,
+                    subject_ids=subject_ids)
+    convert_to_sofa(config.train_original_hrtf_merge_dir, config, use_phase=True, cube=None, sphere=sphere_original,
+                    subject_ids=subject_ids)
+    convert_to_sofa(config.valid_original_hrtf_merge_dir, config, use_phase=True, cube=None, sphere=sphere_original,
+                    subject_ids=subject_ids)
+
+
+def calc_euclidean_cube(edge_len=16):
+    """Get the points of a euclidean cubed sphere with the given edge length (panels 1 through 5), as a list of cube
+    coordinates (panel, x, y) and a list of the corresponding spherical coordinates (elevation, azimuth)"""
+    panel, x, y = np.meshgrid(np.arange(1, 6), np.linspace(-PI_4, PI_4, edge_len, endpoint=False),
+                              np.linspace(-PI_4, PI_4, edge_len, endpoint=False), indexing='ij')
+    panel, x, y = panel.flatten(), x.flatten() + PI_4 / edge_len, y.flatten() + PI_4 / edge_len
+    elevation, azimuth, _ = convert_cube_to_sphere_array(panel, x, y)
+
+    cube_coords = list(zip(panel.tolist(), x.tolist(), y.tolist()))
+    sphere_coords = list(zip(elevation.tolist(), azimuth.tolist()))
+    return cube_coords, sphere_coords
 
 
 def generate_euclidean_cube(config, measured_coords, edge_len=16):
     """Calculate barycentric coordinates for projection based on a specified cube sphere edge length and a set of
     measured coordinates, finally save them to the file"""
-    cube_coords, sphere_coords = [], []
-    for panel in range(1, 6):
-        for x in np.linspace(-PI_4, PI_4, edge_len, endpoint=False):
-            for y in np.linspace(-PI_4, PI_4, edge_len, endpoint=False):
-                x_i, y_i = x + PI_4 / edge_len, y + PI_4 / edge_len
-                cube_coords.append((panel, x_i, y_i))
-                sphere_coords.append(convert_cube_to_sphere(panel, x_i, y_i))
-
-    euclidean_sphere_triangles = []
-    euclidean_sphere_coeffs = []
-
-    for count, p in enumerate(sphere_coords):
-        triangle_vertices = get_triangle_vertices(elevation=p[0], azimuth=p[1], sphere_coords=measured_coords)
-        coeffs = calc_barycentric_coordinates(elevation=p[0], azimuth=p[1], closest_points=triangle_vertices)
-        euclidean_sphere_triangles.append(triangle_vertices)
-        euclidean_sphere_coeffs.append(coeffs)
-
-        print(f"Data point {count+1} out of {len(sphere_coords)} ({round(100 * count / len(sphere_coords))}%)")
-
-    # save euclidean_cube, euclidean_sphere, euclidean_sphere_triangles, euclidean_sphere_coeffs
+    cube_coords, sphere_coords = calc_euclidean_cube(edge_len)
+    projection = Projection.from_measured_coords(edge_len, cube_coords, sphere_coords, measured_coords)
+
+    # save euclidean_cube, euclidean_sphere, euclidean_sphere_triangles, euclidean_sphere_coeffs (see load_projection)
     Path(config.projection_dir).mkdir(parents=True, exist_ok=True)
-    filename = f'{config.projection_dir}/{config.dataset}_projection_{config.hrtf_size}'
-    with open(filename, "wb") as file:
-        pickle.dump((cube_coords, sphere_coords, euclidean_sphere_triangles, euclidean_sphere_coeffs), file)
+    projection.save(get_projection_dir(config))
+
+
+def calc_all_triangles(sphere_coords, measured_coords):
+    """For every point in sphere_coords, find the triangle of measured_coords used for barycentric interpolation and
+    its coefficients, in the list format stored in the projection file (see get_triangle_vertices and
+    calc_barycentric_coordinates)"""
+    triangulation = SphericalTriangulation(measured_coords)
+    elevations, azimuths = np.array(sphere_coords, dtype=float).reshape(-1, 2).T
+    vertices, coeffs = triangulation.find_triangles(elevations, azimuths)
+
+    triangles, all_coeffs = [], []
+    for point_vertices, point_coeffs in zip(vertices, coeffs):
+        triangles.append(triangulation.get_triangle_vertices(point_vertices))
+        if point_vertices[-1] >= 0:
+            all_coeffs.append({"alpha": point_coeffs[0], "beta": point_coeffs[1], "gamma": point_coeffs[2]})
+        else:
+            all_coeffs.append({"alpha": None, "beta": None, "gamma": None})
+
+    return triangles, all_coeffs
 
 
 def save_euclidean_cube(edge_len=16):
     """Save euclidean cube as a txt file for use as input to matlab"""
-    sphere_coords = []
-    for panel in range(1, 6):
-        for x in np.linspace(-PI_4, PI_4, edge_len, endpoint=False):
-            for y in np.linspace(-PI_4, PI_4, edge_len, endpoint=False):
-                x_i, y_i = x + PI_4 / edge_len, y + PI_4 / edge_len
-                sphere_coords.append(convert_cube_to_sphere(panel, x_i, y_i))
+    _, sphere_coords = calc_euclidean_cube(edge_len)
     with open('../projection_coordinates/generated_coordinates.txt', 'w') as f:
         for coord in sphere_coords:
             print(coord)
@@ -330,45 +412,106 @@ def calc_interpolated_feature(time_domain_flag, triangle_vertices, coeffs, all_c
     return interpolated_feature
 
 
-def calc_all_interpolated_features(cs, features, euclidean_sphere, euclidean_sphere_triangles, euclidean_sphere_coeffs):
-    """Essentially a wrapper function for calc_interpolated_features above, calculated interpolated features for all
-    points on the euclidean sphere rather than a single point"""
-    selected_feature_interpolated = []
+def calc_interpolation_matrix(cs, euclidean_sphere, euclidean_sphere_triangles, euclidean_sphere_coeffs):
+    """Compile the triangles and barycentric coefficients of a projection into a sparse matrix of shape
+    (number of points in euclidean_sphere, number of points in cs), such that multiplying it with the features of every
+    point in cs gives the interpolated features (equation 6 in "3D Tune-In Toolkit: An open-source library for
+    real-time binaural spatialisation", see calc_interpolated_feature)
+
+    The matrix only depends on the projection and the measurement grid, so it can be reused for every subject
+    """
+    # look up each measured point once, rather than querying cs.all_coords for every triangle vertex
+    point_index = {}
+    for index in np.flatnonzero(cs.valid):
+        point_index.setdefault(tuple(cs.sphere_array[index].tolist()), index)
+
+    rows, columns, values = [], [], []
     for i, p in enumerate(euclidean_sphere):
-        if p[0] is not None:
-            if 'panel_index' in cs.all_coords.columns:
-                time_domain_flag = False
-            else:
-                time_domain_flag = True
-            features_p = calc_interpolated_feature(time_domain_flag=time_domain_flag,
-                                                   triangle_vertices=euclidean_sphere_triangles[i],
-                                                   coeffs=euclidean_sphere_coeffs[i],
-                                                   all_coords=cs.get_all_coords(),
-                                                   subject_features=features)
-
-            selected_feature_interpolated.append(features_p)
+        if p[0] is None:
+            continue
+        triangle_vertices = euclidean_sphere_triangles[i]
+        if len(triangle_vertices) == 3:
+            coeffs = euclidean_sphere_coeffs[i]
+            weights = (coeffs["alpha"], coeffs["beta"], coeffs["gamma"])
         else:
-            selected_feature_interpolated.append(None)
+            triangle_vertices, weights = triangle_vertices[:1], (1.,)
+        for vertex, weight in zip(triangle_vertices, weights):
+            rows.append(i)
+            columns.append(point_index[(vertex[0], vertex[1])])
+            values.append(weight)
+
+    return scipy.sparse.csr_matrix((values, (rows, columns)),
+                                   shape=(len(euclidean_sphere), len(cs.sphere_array)))
+
 
-    return selected_feature_interpolated
+def calc_vertex_features(cs, subject_features, interpolation_matrix):
+    """Get the features of every point in cs that is used as a triangle vertex by interpolation_matrix, in the same
+    order as the columns of interpolation_matrix (unused points are left as zeros)
 
+    For time domain features (HRIRs) the ITD is removed, otherwise the features are magnitudes that are converted to
+    the time domain (see get_feature_for_point and get_feature_for_point_tensor)"""
+    # measurement grids are indexed by (elevation, azimuth), cubes by (panel, elevation, azimuth)
+    time_domain_flag = cs.indices.shape[1] == 2
+    used_points = np.flatnonzero(interpolation_matrix.getnnz(axis=0))
 
-def calc_hrtf(config, hrirs):
-    """FFT to obtain HRTF from HRIR"""
-    magnitudes = []
-    phases = []
+    if time_domain_flag:
+        hrirs = np.array([subject_features[cs.indices[index][1]][cs.indices[index][0]] for index in used_points])
+        features = remove_itd_batch(hrirs, int(hrirs.shape[-1]*0.04), hrirs.shape[-1])
+    else:
+        features = []
+        for index in used_points:
+            _, elevation_index, azimuth_index = cs.indices[index]
+            panel = cs.cube_array[index, 0]
+            features.append(scipy.fft.irfft(np.concatenate((np.array([0.0]), np.array(
+                subject_features[int(panel - 1)][int(elevation_index)][int(azimuth_index)])))))
+        features = np.array(features)
+
+    vertex_features = np.zeros((interpolation_matrix.shape[1], features.shape[-1]))
+    vertex_features[used_points] = features
+    return vertex_features
+
+
+def apply_interpolation_matrix(interpolation_matrix, vertex_features):
+    """Interpolate features with a single sparse-dense product. vertex_features has the measured points along its first
+    axis; any further axes (e.g. subjects and samples) are interpolated together, so a whole dataset can be projected
+    at once"""
+    vertex_features = np.asarray(vertex_features)
+    interpolated = interpolation_matrix @ vertex_features.reshape(vertex_features.shape[0], -1)
+    return interpolated.reshape(interpolation_matrix.shape[0], *vertex_features.shape[1:])
+
+
+def calc_all_interpolated_features(cs, features, euclidean_sphere, euclidean_sphere_triangles, euclidean_sphere_coeffs,
+                                   interpolation_matrix=None):
+    """Calculate interpolated features for all points on the euclidean sphere (see calc_interpolated_feature for a
+    single point), returns an array with a row for every point in euclidean_sphere
+
+    :param interpolation_matrix: Precomputed result of calc_interpolation_matrix, computed here if not provided
+    """
+    if interpolation_matrix is None:
+        interpolation_matrix = calc_interpolation_matrix(cs, euclidean_sphere, euclidean_sphere_triangles,
+                                                         euclidean_sphere_coeffs)
+    vertex_features = calc_vertex_features(cs, features, interpolation_matrix)
+    return apply_interpolation_matrix(interpolation_matrix, vertex_features)
 
-    for hrir in hrirs:
-        # remove value that corresponds to 0 Hz
-        hrtf = scipy.fft.rfft(hrir, config.nbins_hrtf*2)[1:]
-        magnitude = abs(hrtf)
-        phase = [cmath.phase(x) for x in hrtf]
-        magnitudes.append(magnitude)
-        phases.append(phase)
+
+def calc_hrtf(config, hrirs, as_tensor=False, device=None):
+    """FFT to obtain HRTF from HRIR
+
+    :param hrirs: Array of HRIRs, with time along the last axis
+    :param as_tensor: Return torch tensors (on device, if given) rather than numpy arrays
+    :return: Magnitudes and phases, in arrays of shape (..., config.nbins_hrtf)
+    """
+    # remove value that corresponds to 0 Hz
+    hrtfs = scipy.fft.rfft(np.asarray(hrirs), config.nbins_hrtf*2, axis=-1)[..., 1:]
+    magnitudes = np.abs(hrtfs)
+    phases = np.angle(hrtfs)
+    if as_tensor:
+        return torch.tensor(magnitudes, device=device), torch.tensor(phases, device=device)
     return magnitudes, phases
 
 
-def interpolate_fft(config, cs, features, sphere, sphere_triangles, sphere_coeffs, cube, fs_original, edge_len):
+def interpolate_fft(config, cs, features, sphere, sphere_triangles, sphere_coeffs, cube, fs_original, edge_len,
+                    interpolation_matrix=None, cube_indices=None):
     """Combine all data processing steps into one function
 
     :param cs: Cubed sphere object associated with dataset
@@ -381,34 +524,29 @@ def interpolate_fft(config, cs, features, sphere, sphere_triangles, sphere_coeff
                           described by sphere_triangles
     :param cube: A list of locations of the gridded cubed sphere points to be interpolated, given as (panel, x, y)
     :param edge_len: Edge length of gridded cube
+    :param interpolation_matrix: Result of calc_interpolation_matrix for this projection, pass it in to avoid
+                                 recomputing it for every subject
+    :param cube_indices: Result of calc_cube_indices for cube, computed here if not provided
     """
 
-    # interpolated_hrirs is a list of interpolated HRIRs corresponding to the points specified in load_sphere and
-    # load_cube, all three lists share the same ordering
-    interpolated_hrirs = calc_all_interpolated_features(cs, features, sphere, sphere_triangles, sphere_coeffs)
+    # interpolated_hrirs is an array of interpolated HRIRs corresponding to the points specified in load_sphere and
+    # load_cube, all three share the same ordering
+    interpolated_hrirs = calc_all_interpolated_features(cs, features, sphere, sphere_triangles, sphere_coeffs,
+                                                        interpolation_matrix)
 
     # Resample data so that training and validation sets are created at the same fs ('config.hrir_samplerate').
     # number_of_samples = round(np.shape(interpolated_hrirs)[-1] * float(config.hrir_samplerate) / fs_original)
     # interpolated_hrirs_resampled = sps.resample(np.array(interpolated_hrirs).T, number_of_samples).T
 
-    magnitudes, phases = calc_hrtf(config, interpolated_hrirs)
-
-    # create empty list of lists of lists and initialize counter
-    magnitudes_raw = [[[[] for _ in range(edge_len)] for _ in range(edge_len)] for _ in range(5)]
-    count = 0
+    magnitudes, _ = calc_hrtf(config, interpolated_hrirs)
 
-    for panel, x, y in cube:
-        # based on cube coordinates, get indices for magnitudes list of lists
-        i = panel - 1
-        j = round(edge_len * (x - (PI_4 / edge_len) + PI_4) / (np.pi / 2))
-        k = round(edge_len * (y - (PI_4 / edge_len) + PI_4) / (np.pi / 2))
+    # place each magnitude at its position on the cube
+    if cube_indices is None:
+        cube_indices = calc_cube_indices(cube, edge_len)
+    magnitudes_raw = np.zeros((5, edge_len, edge_len, magnitudes.shape[-1]))
+    magnitudes_raw[cube_indices] = magnitudes
 
-        # add to list of lists of lists and increment counter
-        magnitudes_raw[i][j][k] = magnitudes[count]
-        count += 1
-
-    # convert list of numpy arrays into a single array, such that converting into tensor is faster
-    return torch.tensor(np.array(magnitudes_raw))
+    return torch.tensor(magnitudes_raw)
 
 
 def trim_hrir(hrir, start, stop):
@@ -477,3 +615,71 @@ def remove_itd(hrir, pre_window, length):
         faded_hrir = np.ma.append(faded_hrir, zero_pad)
 
     return faded_hrir
+
+
+def find_onsets(hrirs, threshold=0.005):
+    """Batched version of the onset detection in remove_itd: for each row of hrirs, find the first sample where the
+    post fit residual of the kalman filter exceeds threshold. Returns -1 for rows where this never happens"""
+    # normalize such that max(abs(hrir)) == 1
+    normalized_hrirs = (1 / np.max(np.abs(hrirs), axis=-1, keepdims=True)) * hrirs
+
+    # r and q as in remove_itd, the gains are then the same for every hrir
+    gains = calc_kalman_gains(hrirs.shape[-1], Q=0.01, R=np.sqrt(400))
+
+    state = np.zeros(hrirs.shape[:-1])
+    onsets = np.full(hrirs.shape[:-1], -1)
+    for i, gain in enumerate(gains):
+        post_fit_residual = gain * (normalized_hrirs[..., i] - state)
+        state = state + post_fit_residual
+        onsets[(onsets < 0) & (np.abs(post_fit_residual) > threshold)] = i
+        if np.all(onsets >= 0):
+            break
+    return onsets
+
+
+def calc_fade_windows(lengths, total_length, fadein_len=10, fadeout_len=50):
+    """Fade windows as used in remove_itd for HRIRs of the given (per row) lengths, zero padded to total_length"""
+    fadeout_interval = -1. / fadeout_len
+    fadeout = np.arange(1 + fadeout_interval, fadeout_interval, fadeout_interval)
+    fadein_interval = 1. / fadein_len
+    fadein = np.arange(0.0, 1.0, fadein_interval)
+
+    lengths = np.asarray(lengths)[..., None]
+    t = np.arange(total_length)
+    fadeout_start = lengths - fadeout_len
+    windows = np.ones(lengths.shape[:-1] + (total_length,))
+    windows = np.where(t < fadein_len, fadein[np.minimum(t, fadein_len - 1)], windows)
+    windows = np.where(t >= fadeout_start, fadeout[np.clip(t - fadeout_start, 0, fadeout_len - 1)], windows)
+    return np.where(t < lengths, windows, 0.)
+
+
+def remove_itd_batch(hrirs, pre_window, length):
+    """Remove ITD from an array of HRIRs of shape (..., num_samples), giving the same result as applying remove_itd to
+    every HRIR
+
+    HRIRs where no onset is found are returned unchanged (truncated or zero padded to length)"""
+    hrirs = np.asarray(hrirs, dtype=float)
+    num_samples = hrirs.shape[-1]
+    onsets = find_onsets(hrirs)
+    found = onsets >= 0
+    if not np.all(found):
+        print("RuntimeWarning: ITD not removed for %d HRIRs (Kalman filter did not find a time where post fit residual "
+              "exceeded threshold)." % np.sum(~found))
+
+    # trim HRIR based on first time threshold is exceeded (see trim_hrir)
+    start = onsets - pre_window
+    stop = np.where(start < 0, length, start + length)
+    # when the HRIR is too short, it is trimmed to its second to last sample then faded and zero padded
+    too_short = num_samples < stop
+    last_sample = np.where(too_short, num_samples - 1, num_samples)
+    trimmed_length = np.where(too_short, num_samples - 1 - start, length)
+
+    source_index = start[..., None] + np.arange(length)
+    in_range = (source_index >= 0) & (source_index < last_sample[..., None])
+    trimmed_hrirs = np.where(in_range, np.take_along_axis(hrirs, np.clip(source_index, 0, num_samples - 1), axis=-1),
+                             0.)
+    faded_hrirs = trimmed_hrirs * calc_fade_windows(trimmed_length, length)
+
+    unchanged = np.zeros(hrirs.shape[:-1] + (length,))
+    unchanged[..., :min(length, num_samples)] = hrirs[..., :length]
+    return np.where(found[..., None], faded_hrirs, unchanged)
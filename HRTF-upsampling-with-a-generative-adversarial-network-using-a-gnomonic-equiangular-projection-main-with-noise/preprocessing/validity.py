@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import pickle
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+
+VALIDITY_MANIFEST_VERSION = 1
+
+
+def get_validity_manifest_filename(hrtf_dir):
+    """The manifest of a directory of pickled HRTFs is kept in a subdirectory, where it is ignored by everything that
+    only lists the files of the directory"""
+    return f'{hrtf_dir}/validity/manifest.json'
+
+
+def get_default_num_threads():
+    return min(8, os.cpu_count() or 1)
+
+
+def check_hrtf(hrtf):
+    """Shape, dtype and whether an HRTF is free of nan and inf values"""
+    if torch.is_tensor(hrtf):
+        # torch dtypes such as bfloat16 have no numpy equivalent
+        return {'shape': list(hrtf.shape), 'dtype': str(hrtf.dtype).replace('torch.', ''),
+                'finite': bool(torch.isfinite(hrtf).all())}
+    hrtf = np.asarray(hrtf)
+    return {'shape': list(hrtf.shape), 'dtype': hrtf.dtype.name, 'finite': bool(np.isfinite(hrtf).all())}
+
+
+class ValidityManifest(object):
+    """Record of which pickled HRTFs in a directory are valid (contain no nan or inf values), such that the datasets
+    do not need to unpickle every file each time they are created.
+
+    Every file has an entry with its size, modification time and content hash, along with the shape, dtype and
+    whether it is finite. Files whose size and modification time still match their entry are not read; files that
+    have changed are hashed, and only unpickled if their content has changed as well.
+    """
+
+    def __init__(self, hrtf_dir):
+        self.hrtf_dir = str(hrtf_dir)
+        self.filename = get_validity_manifest_filename(self.hrtf_dir)
+        self.entries = {}
+        if os.path.isfile(self.filename):
+            with open(self.filename) as file:
+                saved = json.load(file)
+            if saved.get('version') == VALIDITY_MANIFEST_VERSION:
+                self.entries = saved['entries']
+
+    def save(self):
+        # write to a temporary file first, as several jobs may read the same directory
+        Path(self.filename).parent.mkdir(parents=True, exist_ok=True)
+        tmp_filename = f'{self.filename}.{os.getpid()}.tmp'
+        with open(tmp_filename, 'w') as file:
+            json.dump({'version': VALIDITY_MANIFEST_VERSION, 'entries': self.entries}, file)
+        os.replace(tmp_filename, self.filename)
+
+    def _is_current(self, file_name, stat):
+        entry = self.entries.get(file_name)
+        return entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns
+
+    def _validate(self, file_name, hrtf=None):
+        """Entry of a file, from its previous entry if only its modification time has changed"""
+        path = os.path.join(self.hrtf_dir, file_name)
+        stat = os.stat(path)
+        with open(path, 'rb') as file:
+            data = file.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+
+        entry = self.entries.get(file_name)
+        if hrtf is None and entry is not None and entry['sha256'] == content_hash:
+            entry = dict(entry)
+        else:
+            entry = check_hrtf(pickle.loads(data) if hrtf is None else hrtf)
+        entry.update({'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': content_hash})
+        return entry
+
+    def record(self, file_name, hrtf):
+        """Add the entry of a file that has just been written, without unpickling it again"""
+        file_name = os.path.basename(file_name)
+        self.entries[file_name] = self._validate(file_name, hrtf)
+
+    def update(self, file_names, num_threads=None):
+        """Revalidate those of file_names that have changed since they were last validated, in a thread pool, and forget
+        files that no longer exist. Returns whether anything has changed"""
+        file_names = [os.path.basename(file_name) for file_name in file_names]
+        changed = [file_name for file_name in file_names
+                   if not self._is_current(file_name, os.stat(os.path.join(self.hrtf_dir, file_name)))]
+        removed = [file_name for file_name in self.entries
+                   if not os.path.isfile(os.path.join(self.hrtf_dir, file_name))]
+        for file_name in removed:
+            del self.entries[file_name]
+
+        if len(changed) > 0:
+            print(f'Validating {len(changed)} changed HRTF files in {self.hrtf_dir}')
+            num_threads = get_default_num_threads() if num_threads is None else num_threads
+            with ThreadPoolExecutor(max_workers=max(1, min(num_threads, len(changed)))) as executor:
+                for file_name, entry in zip(changed, executor.map(self._validate, changed)):
+                    self.entries[file_name] = entry
+        return len(changed) > 0 or len(removed) > 0
+
+    def is_valid(self, file_name):
+        return self.entries[os.path.basename(file_name)]['finite']
+
+
+def filter_valid_hrtf_files(hrtf_file_names, num_threads=None):
+    """Keep the HRTF files without nan or inf values, in the same order, using the validity manifest of each
+    directory so that only new or changed files are read"""
+    file_names_by_dir = defaultdict(list)
+    for hrtf_file_name in hrtf_file_names:
+        file_names_by_dir[os.path.dirname(hrtf_file_name)].append(hrtf_file_name)
+
+    valid = set()
+    for hrtf_dir, file_names in file_names_by_dir.items():
+        manifest = ValidityManifest(hrtf_dir)
+        if manifest.update(file_names, num_threads):
+            manifest.save()
+        valid.update(file_name for file_name in file_names if manifest.is_valid(file_name))
+    return [hrtf_file_name for hrtf_file_name in hrtf_file_names if hrtf_file_name in valid]
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# config fields that each main.py stage depends on, in addition to the artifacts it reads
+STAGE_PARAMS = {
+    'generate_projection': ('dataset', 'hrtf_size', 'hrir_samplerate'),
+    'preprocess': ('dataset', 'hrtf_size', 'nbins_hrtf', 'hrir_samplerate', 'train_samples_ratio', 'merge_flag',
+                   'gen_sofa_flag', 'gen_lr_pyramid_flag', 'hrtf_storage_policy', 'incremental_preprocess',
+                   'use_decode_cache', 'use_hrtf_store'),
+    'barycentric_baseline': ('dataset', 'hrtf_size', 'nbins_hrtf', 'upscale_factor', 'hrir_samplerate',
+                             'gen_sofa_flag'),
+    'hrtf_selection_baseline': ('dataset', 'hrtf_size', 'nbins_hrtf', 'hrir_samplerate', 'gen_sofa_flag'),
+    'build_noisy_datasets': ('dataset', 'hrtf_size', 'nbins_hrtf', 'gen_lr_pyramid_flag', 'hrtf_storage_policy',
+                             'noise_colours', 'noise_snrs_db', 'noise_seed'),
+    'test': ('dataset', 'hrtf_size', 'nbins_hrtf', 'upscale_factor', 'hrir_samplerate', 'merge_flag',
+             'train_folder', 'validation_folder', 'generated_sofa_folder_name', 'inference_backend'),
+    'export_onnx': ('hrtf_size', 'nbins_hrtf', 'upscale_factor', 'merge_flag', 'onnx_opset', 'onnx_parity_tolerance'),
+}
+
+# subdirectories of HRTF directories that only hold data derived from the HRTF pickles: the store, the validity
+# manifest and the LR pyramid. They are left out of the input hashes, as the store and the validity manifest are
+# written by the stages that read the directory, and of the output hashes as well, apart from the LR pyramid
+DERIVED_DIRS = ('store', 'validity', 'lr_pyramid')
+READER_WRITTEN_DIRS = ('store', 'validity')
+
+
+def _list_files(paths, exclude_dirs=()):
+    """All files at or below paths, sorted such that the order does not depend on the file system, leaving out
+    subdirectories named in exclude_dirs"""
+    file_names = []
+    for path in paths:
+        path = str(path)
+        if os.path.isfile(path):
+            file_names.append(path)
+        for root, dirs, names in os.walk(path):
+            dirs[:] = [name for name in dirs if name not in exclude_dirs]
+            file_names += [os.path.join(root, name) for name in names]
+    return sorted(file_names)
+
+
+def _write_json(filename, data):
+    # write to a temporary file first, as several jobs may share the cache
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'w') as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmp_filename, filename)
+
+
+def calc_stat_fingerprint(paths):
+    """Fingerprint of the files at or below paths from their path, size and modification time only, for large inputs
+    such as the raw datasets that are too expensive to hash"""
+    entries = []
+    for file_name in _list_files(paths):
+        stat = os.stat(file_name)
+        entries.append([file_name, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+
+
+class StageCache(object):
+    """Skips main.py stages whose inputs have not changed since they were last run.
+
+    A stage is identified by a key, the hash of its config parameters and of the contents of the artifacts it reads.
+    When a stage completes, a record of its outputs and their content hash is stored under its key; a later run with
+    the same key is skipped as long as the outputs still have that content. Content hashes of files are remembered by
+    path along with their size and modification time, so that unchanged files are only read once.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.file_hashes_filename = f'{cache_dir}/file_hashes.json'
+        self.file_hashes = {}
+        if os.path.isfile(self.file_hashes_filename):
+            with open(self.file_hashes_filename) as file:
+                self.file_hashes = json.load(file)
+
+    def _hash_file(self, file_name):
+        stat = os.stat(file_name)
+        size, mtime, file_hash = self.file_hashes.get(file_name, (None, None, None))
+        if size != stat.st_size or mtime != stat.st_mtime_ns:
+            file_hash = hashlib.sha256()
+            with open(file_name, 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    file_hash.update(block)
+            file_hash = file_hash.hexdigest()
+            self.file_hashes[file_name] = (stat.st_size, stat.st_mtime_ns, file_hash)
+        return file_hash
+
+    def hash_artifacts(self, paths, exclude_dirs=READER_WRITTEN_DIRS):
+        """Content hash of the files at or below paths (files or directories), missing paths are hashed as empty"""
+        artifacts_hash = hashlib.sha256()
+        for path in paths:
+            artifacts_hash.update(str(path).encode())
+            for file_name in _list_files([path], exclude_dirs):
+                artifacts_hash.update(os.path.relpath(file_name, str(path)).encode())
+                artifacts_hash.update(self._hash_file(file_name).encode())
+        _write_json(self.file_hashes_filename, self.file_hashes)
+        return artifacts_hash.hexdigest()
+
+    def get_key(self, stage, params, inputs):
+        """Hash of the stage name, its parameters and the contents of its inputs"""
+        key = {'stage': stage, 'params': params, 'inputs': self.hash_artifacts(inputs, DERIVED_DIRS)}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def _get_record_filename(self, stage, key):
+        return f'{self.cache_dir}/{stage}/{key}.json'
+
+    def is_cached(self, stage, key):
+        """Whether the stage has been run with this key and its outputs are still the ones it produced"""
+        record_filename = self._get_record_filename(stage, key)
+        if not os.path.isfile(record_filename):
+            return False
+        with open(record_filename) as file:
+            record = json.load(file)
+        return all(os.path.exists(output) for output in record['outputs']) \
+            and self.hash_artifacts(record['outputs']) == record['outputs_hash']
+
+    def save(self, stage, key, params, outputs):
+        _write_json(self._get_record_filename(stage, key),
+                    {'stage': stage, 'params': params, 'outputs': [str(output) for output in outputs],
+                     'outputs_hash': self.hash_artifacts(outputs)})
+
+
+def get_stage_params(config, stage, **extra_params):
+    params = {name: getattr(config, name) for name in STAGE_PARAMS[stage]}
+    params.update(extra_params)
+    return json.loads(json.dumps(params, default=str))
+
+
+class CachedStage(object):
+    """A main.py stage that is skipped when it was already run with the same parameters and inputs (see StageCache),
+    used as:
+
+        stage = CachedStage(config, 'preprocess', inputs, outputs)
+        if not stage.is_cached():
+            ...
+            stage.save()
+
+    The key is computed from the inputs as they are before the stage runs. Turned off by config.use_stage_cache
+
+    :param inputs: Files or directories read by the stage, hashed by content
+    :param outputs: Files or directories written by the stage
+    :param extra_params: Parameters of the stage that are not part of config (e.g. the noise argument of main.py) or
+                         fingerprints of inputs too large to hash by content (see calc_stat_fingerprint)
+    """
+
+    def __init__(self, config, stage, inputs, outputs, **extra_params):
+        self.stage = stage
+        self.outputs = outputs
+        self.enabled = config.use_stage_cache
+        if self.enabled:
+            self.stage_cache = StageCache(config.stage_cache_dir)
+            self.params = get_stage_params(config, stage, **extra_params)
+            self.key = self.stage_cache.get_key(stage, self.params, inputs)
+
+    def is_cached(self):
+        if self.enabled and self.stage_cache.is_cached(self.stage, self.key):
+            print(f'Skipping {self.stage}, inputs are unchanged since it was last run (key {self.key[:12]})')
+            return True
+        return False
+
+    def save(self):
+        if self.enabled:
+            self.stage_cache.save(self.stage, self.key, self.params, self.outputs)
@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from model.custom_conv import CubeSphereConv2D, CubeSpherePadding2D, _pad_cube_sphere
+
+
+@pytest.mark.parametrize('padding', [1, 2, 3, 5])
+def test_padding_matches_sliced_padding(padding):
+    # the index tables give the same padding as slicing the panels, which the layer uses scripted or compiled
+    torch.manual_seed(0)
+    inputs = torch.rand(2, 3, 5, 8, 8, dtype=torch.float64, requires_grad=True)
+    reference_inputs = inputs.detach().clone().requires_grad_(True)
+
+    outputs = CubeSpherePadding2D(padding)(inputs)
+    reference = _pad_cube_sphere(reference_inputs, padding)
+    assert outputs.shape == (2, 3, 5, 8 + 2 * padding, 8 + 2 * padding)
+    assert torch.equal(outputs, reference)
+
+    grad_outputs = torch.rand_like(outputs)
+    outputs.backward(grad_outputs)
+    reference.backward(grad_outputs)
+    torch.testing.assert_close(inputs.grad, reference_inputs.grad)
+
+
+@pytest.mark.parametrize('padding_mode', ['zeros', 'replicate'])
+@pytest.mark.parametrize('stride', [1, 2])
+def test_folded_conv_matches_per_panel_conv(padding_mode, stride):
+    torch.manual_seed(0)
+    conv = CubeSphereConv2D(3, 4, 3, stride=stride, padding=1, padding_mode=padding_mode, dtype=torch.float64)
+    per_panel_conv = CubeSphereConv2D(3, 4, 3, stride=stride, padding=1, padding_mode=padding_mode,
+                                      dtype=torch.float64, fold_panels=False)
+    per_panel_conv.load_state_dict(conv.state_dict())
+
+    inputs = torch.rand(2, 3, 5, 8, 8, dtype=torch.float64, requires_grad=True)
+    reference_inputs = inputs.detach().clone().requires_grad_(True)
+    outputs = conv(inputs)
+    reference = per_panel_conv(reference_inputs)
+    torch.testing.assert_close(outputs, reference)
+
+    grad_outputs = torch.rand_like(outputs)
+    outputs.backward(grad_outputs)
+    reference.backward(grad_outputs)
+    torch.testing.assert_close(inputs.grad, reference_inputs.grad)
+    for name, parameter in conv.named_parameters():
+        torch.testing.assert_close(parameter.grad, dict(per_panel_conv.named_parameters())[name].grad)
@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+from model.dataset import NoiseAugmentPrefetcher, ThreadPrefetcher
+
+
+class CountingLoader(object):
+    """Iterable of batches counting how often it is iterated"""
+
+    def __init__(self, num_batches):
+        self.num_batches = num_batches
+        self.iterations = 0
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        self.iterations += 1
+        return iter([{'hr': torch.full((1, ), float(i))} for i in range(self.num_batches)])
+
+
+def read_all(prefetcher):
+    batches = []
+    batch_data = prefetcher.next()
+    while batch_data is not None:
+        batches.append(float(batch_data['hr']))
+        batch_data = prefetcher.next()
+    return batches
+
+
+def test_thread_prefetcher_starts_lazily():
+    loader = CountingLoader(3)
+    prefetcher = ThreadPrefetcher(loader, torch.device('cpu'))
+    assert prefetcher.thread is None and loader.iterations == 0
+
+    # read without a reset first
+    assert read_all(prefetcher) == [0., 1., 2.]
+    assert prefetcher.next() is None
+    assert loader.iterations == 1
+
+    prefetcher.reset()
+    assert read_all(prefetcher) == [0., 1., 2.]
+    assert loader.iterations == 2
+
+
+class FailingLoader(CountingLoader):
+    """Iterable whose batches fail to load after the first"""
+
+    def __iter__(self):
+        yield next(super().__iter__())
+        raise OSError('cannot read batch')
+
+
+def test_thread_prefetcher_keeps_raising_loader_errors():
+    prefetcher = ThreadPrefetcher(FailingLoader(3), torch.device('cpu'))
+    prefetcher.reset()
+    assert float(prefetcher.next()['hr']) == 0.
+    for _ in range(2):
+        with pytest.raises(OSError, match='cannot read batch'):
+            prefetcher.next()
+
+
+@pytest.mark.parametrize('clean_hrtf_ratio, num_clean', [(1, 3), (0.5, 2), (0, 0)])
+def test_noise_augment_keeps_share_of_each_batch_clean(clean_hrtf_ratio, num_clean):
+    nbins = 8
+    prefetcher = NoiseAugmentPrefetcher(None, torch.device('cpu'), hrtf_size=4, upscale_factor=2, nbins=nbins,
+                                        colours=['white', 'pink'], snrs_db=[10, 0], clean_hrtf_ratio=clean_hrtf_ratio)
+    for _ in range(5):
+        hr = torch.rand(6, 2 * nbins, 5, 4, 4) + 0.1
+        noisy = prefetcher.augment(hr)
+        clean = (noisy == hr).flatten(1).all(dim=1)
+        assert int(clean.sum()) == num_clean
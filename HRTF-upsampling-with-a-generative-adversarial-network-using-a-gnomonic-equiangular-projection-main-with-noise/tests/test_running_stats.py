@@ -0,0 +1,31 @@
+import numpy as np
+import torch
+
+from preprocessing.running_stats import RunningStats
+
+
+def test_merging_halves_matches_adding_all():
+    rng = np.random.default_rng(0)
+    hrtfs = [rng.normal(loc=i, scale=1 + i, size=(5, 4, 4, 6)) for i in range(6)]
+
+    everything = RunningStats(6)
+    for hrtf in hrtfs:
+        everything.add(hrtf)
+
+    first_half, second_half = RunningStats(6), RunningStats(6)
+    for hrtf in hrtfs[:3]:
+        first_half.add(hrtf)
+    for hrtf in hrtfs[3:]:
+        second_half.add(hrtf)
+    merged = first_half.merge(second_half).merge(RunningStats(6))
+
+    assert merged.count == everything.count
+    np.testing.assert_allclose(merged.mean, everything.mean)
+    np.testing.assert_allclose(merged.m2, everything.m2)
+    assert merged.min == everything.min and merged.max == everything.max
+
+    values = torch.tensor(np.concatenate([hrtf.reshape(-1, 6) for hrtf in hrtfs]))
+    mean, std, min_value, max_value = merged.get_stats()
+    torch.testing.assert_close(mean, values.mean(0).float())
+    torch.testing.assert_close(std, values.std(0).float())
+    assert min_value == values.min().float() and max_value == values.max().float()
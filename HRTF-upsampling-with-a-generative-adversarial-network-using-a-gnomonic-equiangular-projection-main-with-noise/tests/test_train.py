@@ -0,0 +1,102 @@
+import pickle
+
+import matplotlib
+import pytest
+import torch
+
+matplotlib.use('Agg')
+
+import model.train as train_module
+from config import Config
+from model.util import forward_is_finite
+
+
+class ListPrefetcher(object):
+    """Prefetcher over a list of batches, as the train loop reads them"""
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.index = 0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def reset(self):
+        self.index = 0
+
+    def next(self):
+        if self.index >= len(self.batches):
+            return None
+        self.index += 1
+        return self.batches[self.index - 1]
+
+
+def get_config(tmp_path):
+    config = Config('test', False, str(tmp_path), str(tmp_path), generated_sofa_folder_name='')
+    config.path = str(tmp_path)
+    config.ngpu = 0
+    config.nbins_hrtf = 4
+    config.batch_size = 2
+    config.num_epochs = 1
+    config.critic_iters = 1
+    config.mixed_precision = True
+    return config
+
+
+def get_batch(config):
+    nbins = config.nbins_hrtf * 2
+    lr_size = config.hrtf_size // config.upscale_factor
+    return {'lr': torch.rand(2, nbins, 5, lr_size, lr_size) + 0.1,
+            'hr': torch.rand(2, nbins, 5, config.hrtf_size, config.hrtf_size) + 0.1,
+            'filename': ['hrtf/subject_1.pickle', 'hrtf/subject_2.pickle']}
+
+
+def test_train_step_bfloat16(tmp_path, monkeypatch):
+    # plotting the magnitude spectrums needs the full number of frequency bins
+    monkeypatch.setattr(train_module, 'plot_magnitude_spectrums', lambda *args, **kwargs: None)
+    monkeypatch.setattr(train_module, 'plot_losses', lambda *args, **kwargs: None)
+
+    torch.manual_seed(0)
+    config = get_config(tmp_path)
+    batch = get_batch(config)
+    train_module.train(config, ListPrefetcher([batch]))
+
+    with open(tmp_path / 'train_losses.pickle', 'rb') as file:
+        losses = pickle.load(file)
+    for loss in losses:
+        assert len(loss) == 1
+        assert torch.isfinite(torch.tensor(loss)).all()
+
+    for model_file in ('Gen.pt', 'Disc.pt'):
+        state_dict = torch.load(tmp_path / model_file)
+        assert {value.dtype for value in state_dict.values() if value.is_floating_point()} == {torch.float32}
+
+
+def test_forward_is_finite():
+    overflow = torch.tensor([1., float('inf')])
+    assert forward_is_finite(torch.ones(2), 'x', skip_overflow=True)
+    assert not forward_is_finite(overflow, 'x', skip_overflow=True)
+    with pytest.raises(AssertionError):
+        forward_is_finite(overflow, 'x', skip_overflow=False)
+
+
+def test_train_falls_back_to_float32_after_overflows(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(train_module, 'plot_magnitude_spectrums', lambda *args, **kwargs: None)
+    monkeypatch.setattr(train_module, 'plot_losses', lambda *args, **kwargs: None)
+    # train as with float16, where every forward pass run with autocast overflows
+    monkeypatch.setattr(train_module, 'get_grad_scaler',
+                        lambda config, device: torch.amp.GradScaler('cpu', enabled=True))
+    monkeypatch.setattr(train_module, 'forward_is_finite',
+                        lambda tensor, name, skip_overflow: not (skip_overflow and tensor.dtype == torch.bfloat16))
+
+    config = get_config(tmp_path)
+    config.max_consecutive_overflows = 2
+    train_module.train(config, ListPrefetcher([get_batch(config) for _ in range(4)]))
+
+    assert 'Skipped 2 discriminator and 0 generator steps whose float16 forward pass overflowed, ' \
+           'ran 2 of 4 batches in float32' in capsys.readouterr().out
+    with open(tmp_path / 'train_losses.pickle', 'rb') as file:
+        losses = pickle.load(file)
+    # the averages are over the two batches run in float32
+    assert len(losses[-1]) == 2
+    assert torch.isfinite(torch.tensor(losses[0])).all()